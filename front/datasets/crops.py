@@ -0,0 +1,150 @@
+import math
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image as PImage
+
+"""
+Crop extraction engine
+
+Crops are grouped by source image so that each image is decoded once, and
+images are spread over a process pool. Kept free of Django imports so that
+it can run in spawned worker processes.
+"""
+
+# output format of the crops, part of the crop cache key (see Dataset.apply_cropping)
+CROP_FORMAT = "jpg"
+
+# JPEG quality of the crops (PIL's default)
+CROP_QUALITY = 75
+
+# below this number of source images, a process pool costs more than it saves
+POOL_MIN_IMAGES = 8
+
+
+@dataclass
+class CropJob:
+    """
+    All the crops to extract from one source image
+    """
+
+    source: str  # image path
+    target_dir: str
+    # (crop_id, (x1, y1, x2, y2)) with relative coordinates
+    crops: List[Tuple[str, Tuple[float, float, float, float]]] = field(
+        default_factory=list
+    )
+
+
+def _draft_size(
+    size: Tuple[int, int], boxes: List[Tuple[float, ...]], max_size: int
+) -> Optional[Tuple[int, int]]:
+    """
+    Smallest decoding size keeping every crop at least max_size pixels wide/high
+    (None if full resolution is needed)
+    """
+    width, height = size
+    scale = 0
+    for x1, y1, x2, y2 in boxes:
+        longest = max((x2 - x1) * width, (y2 - y1) * height)
+        if longest <= 0:
+            continue
+        scale = max(scale, max_size / longest)
+    if scale == 0 or scale >= 1:
+        return None
+    return math.ceil(width * scale), math.ceil(height * scale)
+
+
+def crop_image(
+    job: CropJob, max_size: int = None, quality: int = CROP_QUALITY
+) -> Tuple[List[str], List[str]]:
+    """
+    Decodes job.source once and writes all its crops as JPEG
+
+    Returns:
+        (paths of the crops written, list of errors)
+    """
+    written, errors = [], []
+    try:
+        with PImage.open(job.source) as img:
+            if max_size:
+                draft_size = _draft_size(img.size, [b for _, b in job.crops], max_size)
+                if draft_size:
+                    # only JPEG supports reduced decoding, no-op otherwise
+                    img.draft("RGB", draft_size)
+            img.load()
+            width, height = img.size
+            target_dir = Path(job.target_dir)
+            target_dir.mkdir(parents=True, exist_ok=True)
+
+            for crop_id, (x1, y1, x2, y2) in job.crops:
+                try:
+                    cropped = img.crop(
+                        (x1 * width, y1 * height, x2 * width, y2 * height)
+                    ).convert("RGB")
+                    if cropped.size[0] == 0 or cropped.size[1] == 0:
+                        continue
+                    if max_size:
+                        cropped.thumbnail((max_size, max_size))
+                    crop_file = target_dir / f"{crop_id}.jpg"
+                    cropped.save(crop_file, "JPEG", quality=quality)
+                    written.append(str(crop_file))
+                except Exception:
+                    errors.append(
+                        f"Error cropping {crop_id}: {traceback.format_exc(limit=1)}"
+                    )
+    except Exception:
+        errors.append(
+            f"Error during {job.source} processing: {traceback.format_exc(limit=2)}"
+        )
+    return written, errors
+
+
+def _crop_image_star(args) -> Tuple[List[str], List[str]]:
+    return crop_image(*args)
+
+
+def extract_crops(
+    jobs: List[CropJob],
+    workers: int = None,
+    max_size: int = None,
+    quality: int = CROP_QUALITY,
+) -> Dict:
+    """
+    Runs all crop jobs, in parallel if there are enough of them
+
+    Returns:
+        {"extracted": int, "written": List[str], "images": int, "errors": List[str],
+         "duration": float, "throughput": float}
+    """
+    start = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+    args = [(job, max_size, quality) for job in jobs if job.crops]
+
+    if workers > 1 and len(args) >= POOL_MIN_IMAGES:
+        # spawn: the caller may be a multi-threaded dramatiq worker
+        with ProcessPoolExecutor(
+            max_workers=min(workers, len(args)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            chunksize = max(1, len(args) // (workers * 4))
+            results = list(executor.map(_crop_image_star, args, chunksize=chunksize))
+    else:
+        results = [crop_image(*a) for a in args]
+
+    duration = time.monotonic() - start
+    written = [p for paths, _ in results for p in paths]
+    return {
+        "extracted": len(written),
+        "written": written,
+        "images": len(args),
+        "errors": [e for _, errs in results for e in errs],
+        "duration": duration,
+        "throughput": len(args) / duration if duration else 0.0,
+    }
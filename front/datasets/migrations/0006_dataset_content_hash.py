@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-17 20:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("datasets", "0005_delete_zippeddataset_remove_dataset_format_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dataset",
+            name="content_hash",
+            field=models.CharField(
+                blank=True, db_index=True, editable=False, max_length=64, null=True
+            ),
+        ),
+    ]
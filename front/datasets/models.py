@@ -1,13 +1,18 @@
+import os
 import shutil
-import requests
 import uuid
 import json
+import hashlib
+import threading
+import time
 import traceback
 
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
-from PIL import Image as PImage
+from typing import Dict, List, Optional, Tuple
 
 from django.contrib.auth import get_user_model
 from django.urls import reverse
@@ -16,8 +21,17 @@ from django.conf import settings
 from django.db.models.signals import pre_delete
 from django.dispatch.dispatcher import receiver
 
+from shared.api import api_get
 from shared.utils import pprint
-from .utils import PathAndRename, IMG_EXTENSIONS, unzip_on_the_fly, sanitize_str
+from .crops import CropJob, extract_crops, CROP_FORMAT
+from .utils import (
+    PathAndRename,
+    IMG_EXTENSIONS,
+    unzip_on_the_fly,
+    sanitize_str,
+    file_lock,
+    held_locks,
+)
 from .fields import URLListModelField
 
 
@@ -51,6 +65,26 @@ class AbstractDataset(models.Model):
         abstract = True
 
 
+# bump when the format of Document.index_path changes
+IMAGE_INDEX_VERSION = 1
+
+# per-process LRU of document image lists:
+# {(document path, extracted mtime): (images, {image_id: image})}
+_image_index_cache = OrderedDict()
+_image_index_lock = threading.Lock()
+
+
+def get_extractions_in_progress() -> List[Dict]:
+    """
+    Documents currently being extracted, by any process
+    """
+    extractions = held_locks(Path(settings.MEDIA_ROOT) / "documents" / ".locks")
+    for extraction in extractions:
+        if "started" in extraction:
+            extraction["started"] = datetime.fromtimestamp(extraction["started"])
+    return extractions
+
+
 class Document:
     """
     A document is a set of images that can be processed together
@@ -96,6 +130,14 @@ class Document:
         """
         return self.path / "images"
 
+    @property
+    def index_path(self):
+        """
+        JSON file listing the document images, written after extraction
+        (hidden, so that it can't collide with extracted files)
+        """
+        return self.path / ".index.json"
+
     def to_dict(self) -> Dict:
         return {
             "type": self.dtype,
@@ -109,29 +151,152 @@ class Document:
             return False
         return (self.path / "extracted").exists()
 
+    @property
+    def partial_path(self) -> Path:
+        """
+        Temporary folder the document is extracted to, moved to self.path when complete
+        """
+        return self.path.with_name(f".{self.path.name}.partial")
+
+    @property
+    def lock_path(self) -> Path:
+        """
+        Lock held while the document is being extracted
+        """
+        return self.path.parent / ".locks" / f"{self.path.name}.lock"
+
     def extract_from_zip(self, source_zip: str | Path):
         """
         Extract the content of the zip file
+
+        Single-flight: concurrent callers (threads or processes) wait for the
+        extraction in progress instead of extracting the document again
         """
-        extracted = self.path / "extracted"
         if self.is_extracted():
             return
 
-        extracted_files = unzip_on_the_fly(
-            source_zip, self.path, [".json", *IMG_EXTENSIONS]
-        )
+        lock_info = {
+            "document": self.uid,
+            "source": str(source_zip),
+            "pid": os.getpid(),
+            "started": time.time(),
+        }
+        with file_lock(
+            self.lock_path,
+            info=lock_info,
+            timeout=getattr(settings, "EXTRACTION_LOCK_TIMEOUT", 3600),
+        ):
+            # extracted by someone else while we were waiting
+            if self.is_extracted():
+                return
+            self._extract_from_zip(source_zip)
+
+    def _extract_from_zip(self, source_zip: str | Path):
+        """
+        Files are extracted in partial_path, along with a journal of the files
+        written: if interrupted, the next call streams the whole archive again
+        (no partial download is kept) but does not rewrite the files in the journal
+        """
+        partial = self.partial_path
+        partial.mkdir(parents=True, exist_ok=True)
+        journal = partial / ".journal"
+        done = set(journal.read_text().splitlines()) if journal.exists() else set()
+        if done:
+            print(f"Restarting extraction of {self.uid} ({len(done)} files kept)")
+
+        with open(journal, "a") as j:
+
+            def log_extracted(file_name: str):
+                j.write(f"{file_name}\n")
+                j.flush()
+
+            extracted_files = unzip_on_the_fly(
+                source_zip,
+                partial,
+                [".json", *IMG_EXTENSIONS],
+                skip=done,
+                on_extracted=log_extracted,
+            )
 
         if len(extracted_files) == 0:
             raise Exception("No files were extracted")
 
-        extracted.touch()
+        journal.unlink()
+        (partial / "extracted").touch()
+        # self.path only holds leftovers of a previous extraction at this point
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(partial, self.path)
+
+        extracted = self.path / "extracted"
+        self.write_image_index(self._list_images(), extracted.stat().st_mtime)
+
+    def write_image_index(self, images: List["Image"], extracted_mtime: float):
+        """
+        Persists the image list, valid as long as the extracted marker is not touched
+        """
+        index = {
+            "version": IMAGE_INDEX_VERSION,
+            "extracted_mtime": extracted_mtime,
+            "images": [im.to_dict() for im in images],
+        }
+        tmp_path = self.index_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _read_image_index(self, extracted_mtime: float) -> Optional[List["Image"]]:
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if (
+            index.get("version") != IMAGE_INDEX_VERSION
+            or index.get("extracted_mtime") != extracted_mtime
+        ):
+            return None
+        return [Image.from_dict(im, self) for im in index["images"]]
+
+    def _load_images(self) -> Tuple[List["Image"], Dict[str, "Image"]]:
+        try:
+            extracted_mtime = (self.path / "extracted").stat().st_mtime
+        except FileNotFoundError:
+            # not extracted (yet): nothing worth caching
+            images = self._list_images()
+            return images, {im.id: im for im in images}
+
+        key = (str(self.path), extracted_mtime)
+        with _image_index_lock:
+            if key in _image_index_cache:
+                _image_index_cache.move_to_end(key)
+                return _image_index_cache[key]
+
+        images = self._read_image_index(extracted_mtime)
+        if images is None:
+            images = self._list_images()
+            self.write_image_index(images, extracted_mtime)
+
+        entry = (images, {im.id: im for im in images})
+        with _image_index_lock:
+            _image_index_cache[key] = entry
+            while len(_image_index_cache) > getattr(
+                settings, "IMAGE_INDEX_CACHE_SIZE", 32
+            ):
+                _image_index_cache.popitem(last=False)
+        return entry
 
     @property
     def images(self) -> List["Image"]:
         if not hasattr(self, "_images"):
-            self._images = self._list_images()
+            self._images, self._images_by_id = self._load_images()
         return self._images
 
+    @property
+    def images_by_id(self) -> Dict[str, "Image"]:
+        if not hasattr(self, "_images_by_id"):
+            self._images, self._images_by_id = self._load_images()
+        return self._images_by_id
+
     def _list_img_dir(self):
         return [
             Image(
@@ -222,6 +387,11 @@ class Dataset(AbstractDataset):
         help_text="The URL where the dataset can be accessed through the API",
     )
 
+    # sha256 of the uploaded zip/pdf: identical archives share one extracted Document
+    content_hash = models.CharField(
+        max_length=64, null=True, blank=True, editable=False, db_index=True
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._images = None
@@ -251,17 +421,127 @@ class Dataset(AbstractDataset):
         if not self.name:
             self.name = f"Dataset #{self.id}"
 
-        super().save()
+        # only hash new uploads: legacy rows keep the uid derived from their
+        # URL, which their extracted documents and annotations are keyed by
+        uploaded = self.zip_file or self.pdf_file
+        if uploaded and (self._state.adding or not uploaded._committed):
+            self.content_hash = self.compute_content_hash()
+
+        super().save(*args, **kwargs)
+
+    def compute_content_hash(self) -> Optional[str]:
+        """
+        Hashes the uploaded archive (read by chunks, works before it is saved to disk)
+        """
+        uploaded = self.zip_file or self.pdf_file
+        try:
+            sha = hashlib.sha256()
+            for chunk in uploaded.chunks():
+                sha.update(chunk)
+            uploaded.seek(0)
+        except Exception as e:
+            print(f"Error hashing {uploaded.name}: {e}")
+            return None
+        return sha.hexdigest()
+
+    def _file_document_uid(self, dtype: str) -> Optional[str]:
+        # legacy datasets (no hash) keep the uid derived from their URL
+        return f"{dtype}_{self.content_hash}" if self.content_hash else None
 
     @property
     def crops_path(self) -> Path:
         return self.full_path / "crops"
 
+    @property
+    def crops_manifest_path(self) -> Path:
+        """
+        JSON file of the crops already extracted: {"<doc_uid>/<crop_id>.jpg": [key, mtime]}
+        """
+        return self.crops_path / "manifest.json"
+
+    @property
+    def crops_manifest(self) -> Dict[str, List]:
+        if not hasattr(self, "_crops_manifest"):
+            # folders checked against the mtime of the manifest, see is_crop_extracted
+            self._crop_dirs_changed = {}
+            try:
+                with open(self.crops_manifest_path, "r") as f:
+                    self._crops_manifest = json.load(f)
+                    self._crops_manifest_mtime = os.fstat(f.fileno()).st_mtime_ns
+            except (FileNotFoundError, ValueError):
+                self._crops_manifest = {}
+                self._crops_manifest_mtime = None
+        return self._crops_manifest
+
+    def update_crops_manifest(self, entries: Dict[str, List]):
+        """
+        Merges entries into the manifest on disk (re-read under a lock, other tasks
+        may crop the same dataset concurrently) and replaces it atomically
+
+        The first manifest also lists the crops already on disk (with no key, so
+        that they are cropped again when requested): unlisted means not extracted
+        """
+        with file_lock(self.crops_path / ".manifest.lock"):
+            if hasattr(self, "_crops_manifest"):
+                del self._crops_manifest
+            manifest = self.crops_manifest
+            if not self.crops_manifest_path.exists():
+                manifest = {
+                    p.relative_to(self.crops_path).as_posix(): ["", p.stat().st_mtime]
+                    for p in self.crops_path.glob("*/*.jpg")
+                    if not p.name.startswith(".")
+                }
+            manifest = {**manifest, **entries}
+            tmp_path = self.crops_manifest_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.crops_manifest_path)
+            mtime = self.crops_manifest_path.stat().st_mtime_ns
+        self._crops_manifest = manifest
+        self._crops_manifest_mtime = mtime
+        self._crop_dirs_changed = {}
+
+    def is_crop_extracted(self, crop_file: Path, key: str = None) -> bool:
+        """
+        Whether crop_file is extracted (with this crop key, if given)
+
+        The manifest is trusted, except for the folders modified after it was
+        written (crops deleted, or written by a task not done yet), whose crops
+        are checked on disk: one stat per folder instead of one per crop
+        """
+        manifest = self.crops_manifest
+        entry = manifest.get(crop_file.relative_to(self.crops_path).as_posix())
+        if key is not None and (entry is None or entry[0] != key):
+            return False
+
+        crop_dir = crop_file.parent
+        if crop_dir not in self._crop_dirs_changed:
+            try:
+                self._crop_dirs_changed[crop_dir] = (
+                    self._crops_manifest_mtime is None
+                    or crop_dir.stat().st_mtime_ns > self._crops_manifest_mtime
+                )
+            except FileNotFoundError:
+                self._crop_dirs_changed[crop_dir] = True
+        if self._crop_dirs_changed[crop_dir]:
+            return crop_file.exists()
+        return entry is not None
+
+    @staticmethod
+    def get_crop_key(doc_uid: str, image_id: str, bbox: Dict, fmt: str) -> str:
+        """
+        Identifies the content of a crop: same image, same (quantized) box and
+        same output format give the same file
+        """
+        box = ",".join(f"{bbox[k]:.4f}" for k in ("x1", "y1", "x2", "y2"))
+        return hashlib.sha1(f"{doc_uid}/{image_id}|{box}|{fmt}".encode()).hexdigest()
+
     @property
     def zip_document(self) -> Document:
         if not hasattr(self, "_zip_document"):
             self._zip_document = Document(
                 dtype="zip",
+                uid=self._file_document_uid("zip"),
                 src=f"{settings.BASE_URL}{self.zip_file.url}",
                 # path=self.full_path / "unzipped",
             )
@@ -272,6 +552,7 @@ class Dataset(AbstractDataset):
         if not hasattr(self, "_pdf_document"):
             self._pdf_document = Document(
                 dtype="pdf",
+                uid=self._file_document_uid("pdf"),
                 src=f"{settings.BASE_URL}{self.pdf_file.url}",
                 # path=self.full_path / "pdf",
             )
@@ -333,17 +614,34 @@ class Dataset(AbstractDataset):
         }
         """
         try:
-            api_info = requests.get(self.api_url).json()
+            api_info = api_get(self.api_url).json()
         except Exception as e:
             print(f"Error fetching dataset info: {e}")
             return
 
-        for doc in api_info.get("documents", []):
-            if doc["uid"] not in doc_to_extract:
-                continue
+        downloads = {
+            doc["uid"]: doc["download"]
+            for doc in api_info.get("documents", [])
+            if doc["uid"] in doc_to_extract
+        }
+        if not downloads:
+            print(f"Could not extract {doc_to_extract.keys()}")
+            return
 
-            doc_to_extract[doc["uid"]].extract_from_zip(doc["download"])
-            del doc_to_extract[doc["uid"]]
+        # documents are downloaded and extracted concurrently (I/O bound)
+        workers = min(getattr(settings, "EXTRACTION_WORKERS", 4), len(downloads))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(doc_to_extract[uid].extract_from_zip, url): uid
+                for uid, url in downloads.items()
+            }
+            for future in as_completed(futures):
+                uid = futures[future]
+                try:
+                    future.result()
+                    del doc_to_extract[uid]
+                except Exception as e:
+                    print(f"Error extracting document {uid}: {e}")
 
         if doc_to_extract:
             print(f"Could not extract {doc_to_extract.keys()}")
@@ -393,16 +691,22 @@ class Dataset(AbstractDataset):
         """
         return f"{settings.MEDIA_URL}{self.get_path_for_crop(crop, i, doc_uid).relative_to(settings.MEDIA_ROOT)}"
 
-    def get_paths_for_crops(self, crops: List[Dict]) -> List[Path]:
+    def get_paths_for_crops(
+        self, crops: List[Dict], only_extracted: bool = False
+    ) -> List[Path]:
         """
         Args:
             crops: A list of dictionaries with the following format: {source, doc_id, crops: List[Dict]}
+            only_extracted: Keep only the crops extracted (see is_crop_extracted)
         """
-        return [
+        paths = [
             self.get_path_for_crop(crop, i, im.get("doc_uid", None))
             for im in crops
             for i, crop in enumerate(im.get("crops", []))
         ]
+        if only_extracted:
+            paths = [p for p in paths if self.is_crop_extracted(p)]
+        return paths
 
     def get_doc_image_mapping(self) -> Dict[str, Dict[str, Image]]:
         """
@@ -411,12 +715,37 @@ class Dataset(AbstractDataset):
         if not self._images:
             self.get_images()
 
-        return {doc.uid: {im.id: im for im in doc.images} for doc in self.documents}
+        return {doc.uid: doc.images_by_id for doc in self.documents}
+
+    def get_document_references(self) -> Dict[str, int]:
+        """
+        Returns {doc_uid: number of other datasets using this document}
+        """
+        references = {doc.uid: 0 for doc in self.documents}
+        others = Dataset.objects.exclude(pk=self.pk)
+
+        candidates = others.none()
+        if self.content_hash:
+            candidates |= others.filter(content_hash=self.content_hash)
+        if self.iiif_manifests:
+            candidates |= others.filter(iiif_manifests__isnull=False)
+
+        for other in candidates.only(
+            "id", "zip_file", "pdf_file", "iiif_manifests", "content_hash"
+        ):
+            for doc in other.documents:
+                if doc.uid in references:
+                    references[doc.uid] += 1
+        return references
 
     def clear_dataset(self) -> Dict:
         """
         Delete the dataset files (crops included)
         """
+        # list documents before their source files are deleted
+        documents = self.documents
+        references = self.get_document_references()
+
         if zipf := self.zip_file:
             zipf.delete(save=False)
         if pdf := self.pdf_file:
@@ -425,7 +754,10 @@ class Dataset(AbstractDataset):
             # TODO check if it works
             [img.delete(save=False) for img in imgs]
 
-        for doc in self.documents:
+        for doc in documents:
+            if references.get(doc.uid, 0) > 0:
+                # still used by another dataset
+                continue
             shutil.rmtree(doc.path, ignore_errors=True)
             # TODO delete effectively (do not work for certain type of document)
 
@@ -460,83 +792,77 @@ class Dataset(AbstractDataset):
                 "error": f"Error extracting images " + traceback.format_exc(limit=2)
             }
 
-        extracted = 0
-
-        try:
-            try:
-                for image in crops:
-                    image = image.get(0, image)  # Legacy format : single-item lists
-                    img_name, crops = image.get("source", ""), image.get("crops", [])
-                    doc_uid = image.get("doc_uid", None)
-                    imgs = docs.get(doc_uid, None)
-
-                    if imgs is None:
-                        return {"error": f"Document {doc_uid} not found"}
-
-                    img = imgs.get(img_name, None)
+        # crops already extracted with the same key are kept as is
+        fmt = f"{CROP_FORMAT}:{getattr(settings, 'CROP_MAX_SIZE', None) or 'full'}"
+        keys, cached = {}, 0
+
+        # group crops by source image, so that each image is decoded once
+        jobs: Dict[Path, CropJob] = {}
+        errors = []
+        for image in crops:
+            image = image.get(0, image)  # Legacy format : single-item lists
+            img_name, img_crops = image.get("source", ""), image.get("crops", [])
+            doc_uid = image.get("doc_uid", None)
+            imgs = docs.get(doc_uid, None)
+
+            if imgs is None:
+                errors.append(f"Document {doc_uid} not found")
+                continue
 
-                    if img is None:
-                        return {
-                            "error": f"Image {img_name} not found in document {doc_uid}"
-                        }
+            img = imgs.get(img_name, None)
+            if img is None:
+                errors.append(f"Image {img_name} not found in document {doc_uid}")
+                continue
 
-                    crops_path = self.crops_path / img.document.uid
-                    crops_path.mkdir(parents=True, exist_ok=True)
-
-                    try:
-                        with PImage.open(img.path) as img:
-                            for idx, crop in enumerate(crops):
-                                crop_id = crop.get("crop_id", "")
-
-                                if not crop_id:
-                                    crop_id = f"{Path(img_name).stem}_crop_{idx + 1}"
-
-                                bbox = crop["relative"]
-                                x1, y1, x2, y2 = (
-                                    bbox["x1"],
-                                    bbox["y1"],
-                                    bbox["x2"],
-                                    bbox["y2"],
-                                )
-                                cropped = img.crop(
-                                    (
-                                        x1 * img.size[0],
-                                        y1 * img.size[1],
-                                        x2 * img.size[0],
-                                        y2 * img.size[1],
-                                    )
-                                ).convert("RGB")
-                                if cropped.size[0] == 0 or cropped.size[1] == 0:
-                                    continue
-
-                                crop_file = crops_path / f"{crop_id}.jpg"
-                                crop_file.parent.mkdir(parents=True, exist_ok=True)
-
-                                cropped.save(
-                                    crop_file,
-                                    "JPEG",
-                                )
-                                extracted += 1
-
-                    except Exception as e:
-                        return {
-                            "error": f"Error during {img_name} processing: {traceback.format_exc(limit=2)}"
-                        }
-            except Exception as e:
-                return {
-                    "error": f"Error during images processing: {traceback.format_exc(limit=2)}"
-                }
+            target_dir = self.crops_path / img.document.uid
+            for idx, crop in enumerate(img_crops):
+                crop_id = crop.get("crop_id", "")
+                if not crop_id:
+                    crop_id = f"{Path(img_name).stem}_crop_{idx + 1}"
+                bbox = crop["relative"]
+
+                crop_file = target_dir / f"{crop_id}.jpg"
+                key = self.get_crop_key(doc_uid, img.id, bbox, fmt)
+                if self.is_crop_extracted(crop_file, key):
+                    cached += 1
+                    continue
+                keys[str(crop_file)] = key
+
+                if img.path not in jobs:
+                    jobs[img.path] = CropJob(
+                        source=str(img.path), target_dir=str(target_dir)
+                    )
+                jobs[img.path].crops.append(
+                    (crop_id, (bbox["x1"], bbox["y1"], bbox["x2"], bbox["y2"]))
+                )
 
-            # Check if any crops were created
-            if extracted == 0:
-                return {"error": "No regions were successfully processed"}
+        result = extract_crops(
+            list(jobs.values()),
+            workers=getattr(settings, "CROP_WORKERS", None),
+            max_size=getattr(settings, "CROP_MAX_SIZE", None),
+        )
+        errors += result["errors"]
+
+        if result["written"]:
+            entries = {}
+            for p in result["written"]:
+                name = Path(p).relative_to(self.crops_path).as_posix()
+                entries[name] = [keys[p], os.path.getmtime(p)]
+            self.update_crops_manifest(entries)
+
+        report = {
+            "extracted": result["extracted"] + cached,
+            "cached": cached,
+            "errors": errors,
+            "throughput": f"{result['images']} images in {result['duration']:.1f}s "
+            f"({result['throughput']:.1f} images/s), {cached} crops already extracted",
+        }
 
-        except Exception as e:
-            return {
-                "error": f"Error during image processing: {traceback.format_exc(limit=2)}"
-            }
+        # Check if any crops were created
+        if report["extracted"] == 0:
+            return {"error": "No regions were successfully processed", **report}
 
-        return {"success": "Regions processed successfully"}
+        return {"success": "Regions processed successfully", **report}
 
     @property
     def tasks(self):
@@ -1,12 +1,25 @@
 from django.utils.deconstruct import deconstructible
+import fcntl
+import json
 import os
+import time
 import uuid
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from typing import List
-import requests
+from typing import (
+    BinaryIO,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+)
 from stream_unzip import stream_unzip
 import re
 
+from shared.api import api_get
 from shared.utils import pprint
 
 IMG_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".tiff"}
@@ -28,62 +41,187 @@ class PathAndRename(object):
         return os.path.join(self.path, filename)
 
 
+# streamed archives are read with chunks growing from CHUNK_SIZE_MIN to CHUNK_SIZE_MAX
+CHUNK_SIZE_MIN = 64 * 1024
+CHUNK_SIZE_MAX = 1024 * 1024
+
+
+def read_chunks(read: Callable[[int], bytes]) -> Iterator[bytes]:
+    """
+    Yields chunks from read(size), doubling size every time a chunk comes back full
+    (small first reads for a quick start, large ones for throughput)
+    """
+    size = CHUNK_SIZE_MIN
+    while True:
+        chunk = read(size)
+        if not chunk:
+            break
+        yield chunk
+        if len(chunk) >= size and size < CHUNK_SIZE_MAX:
+            size = min(size * 2, CHUNK_SIZE_MAX)
+
+
+def zipped_chunks(zip_url_or_path: str | Path) -> Iterator[bytes]:
+    """
+    Streams the bytes of a local or remote (URL) file
+    """
+    if isinstance(zip_url_or_path, str) and "://" in zip_url_or_path:
+        with api_get(zip_url_or_path, stream=True) as r:
+            r.raise_for_status()
+            yield from read_chunks(lambda size: r.raw.read(size, decode_content=True))
+    else:
+        with open(zip_url_or_path, "rb") as f:
+            yield from read_chunks(f.read)
+
+
+def tee_to_file(
+    chunks: Iterator[bytes],
+    path: str | Path,
+    on_complete: Callable[[], None] = None,
+) -> Iterator[bytes]:
+    """
+    Yields chunks while writing them to path (renamed into place once complete,
+    then on_complete is called; discarded if the iteration is interrupted)
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    os.replace(tmp_path, path)
+    if on_complete:
+        on_complete()
+
+
 def unzip_on_the_fly(
-    zip_url_or_path: str | Path, target_path: str | Path, allowed_extensions=None
+    zip_url_or_path: str | Path,
+    target_path: str | Path,
+    allowed_extensions=None,
+    skip: Set[str] = None,
+    on_extracted: Callable[[str], None] = None,
+    archive_path: str | Path = None,
+    copy_to: Callable[[str], Optional[ContextManager[BinaryIO]]] = None,
 ) -> List[Path]:
     """
     Unzip an internet file in a streaming fashion
 
-    Ignores hidden files (starting with a dot or in a folder starting with a dot)
+    Ignores hidden files (starting with a dot or in a folder starting with a dot).
+    Each file is written to a temporary name then renamed, so that a file present
+    under its final name is always complete.
 
     Args:
         zip_url_or_path: The URL of the ZIP file
         target_path: The path where the files are extracted
         allowed_extensions: A list of allowed extensions (default: None)
+        skip: Names of files already extracted, read from the archive but not written
+        on_extracted: Called with the name of each file once it is written
+        archive_path: Where to also save the archive itself (default: not saved)
+        copy_to: Called with the name of each file, returns a stream the file
+            content is also written to, or None (e.g. ZipFile.open(name, "w"))
 
     Returns:
-        A list of all the files extracted
+        A list of all the files extracted (including skipped ones)
     """
-    if isinstance(zip_url_or_path, str) and "://" in zip_url_or_path:
-
-        def zipped_chunks():
-            with requests.get(zip_url_or_path, stream=True) as r:
-                r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=8192):
-                    yield chunk
-
-    else:
-
-        def zipped_chunks():
-            with open(zip_url_or_path, "rb") as f:
-                while True:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    yield chunk
-
     target_path = Path(target_path)
+    skip = skip or set()
     all_files = []
 
-    for file_name, file_size, unzipped_chunks in stream_unzip(zipped_chunks()):
+    chunks = zipped_chunks(zip_url_or_path)
+    if archive_path is not None:
+        chunks = tee_to_file(chunks, archive_path)
+
+    for file_name, file_size, unzipped_chunks in stream_unzip(chunks):
         file_name = file_name.decode("utf-8")
         path = target_path / file_name
-        if "/." in "/" + file_name.replace("\\", "/"):  # hidden file
-            continue
-        if (
+        if "/." in "/" + file_name.replace("\\", "/") or (  # hidden file
             allowed_extensions is not None
             and path.suffix.lower() not in allowed_extensions
         ):
+            # stream_unzip requires each file to be consumed before the next one
+            for _ in unzipped_chunks:
+                pass
             continue
         all_files.append(path)
+        if file_name in skip:
+            for _ in unzipped_chunks:
+                pass
+            continue
         path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "wb") as f:
+        tmp_path = path.with_name(f".{path.name}.part")
+        copy = copy_to(file_name) if copy_to is not None else None
+        with open(tmp_path, "wb") as f, copy or nullcontext() as c:
             for chunk in unzipped_chunks:
                 f.write(chunk)
+                if c is not None:
+                    c.write(chunk)
+        os.replace(tmp_path, path)
+        if on_extracted is not None:
+            on_extracted(file_name)
 
     return all_files
 
 
+# seconds between two attempts to acquire a lock held by someone else
+LOCK_POLL_INTERVAL = 0.5
+
+
+@contextmanager
+def file_lock(path: str | Path, info: Dict = None, timeout: float = None):
+    """
+    Exclusive lock shared by all threads and processes of the host (fcntl.flock,
+    released by the OS if the holder dies). The lock file holds `info` while held.
+
+    Raises:
+        TimeoutError if the lock could not be acquired within timeout seconds
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+") as f:
+        start = time.monotonic()
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise TimeoutError(f"Could not lock {path} within {timeout}s")
+                time.sleep(LOCK_POLL_INTERVAL)
+        try:
+            f.truncate(0)
+            json.dump(info or {}, f)
+            f.flush()
+            yield
+        finally:
+            f.truncate(0)
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def held_locks(folder: str | Path) -> List[Dict]:
+    """
+    Lists the locks of folder currently held, with the info of their holder
+    """
+    held = []
+    for path in sorted(Path(folder).glob("*.lock")):
+        with open(path, "r") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                try:
+                    info = json.loads(f.read() or "{}")
+                except ValueError:
+                    info = {}
+                held.append({"name": path.stem, **info})
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return held
+
+
 def sanitize_str(string: str) -> str:
     """
     Sanitize a URL string to make it a valid filename
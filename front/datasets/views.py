@@ -40,10 +40,7 @@ class DatasetListView(DatasetMixin, LoginRequiredIfConfProtectedMixin, ListView)
     def get_queryset(self):
         # if user doesn't have task.monitor right, only show their own experiments
         qset = (
-            super()
-            .get_queryset()
-            .order_by("-created_on")
-            .prefetch_related("created_by")
+            super().get_queryset().order_by("-created_on").select_related("created_by")
         )
         if not self.request.user.is_authenticated:
             return qset.none()
@@ -101,6 +101,56 @@ DRAMATIQ_BROKER = {
     "MIDDLEWARE": [],
 }
 
+# Shared cache (task progress, notifications dedup...), on the same redis server as dramatiq
+# Required: the progress of running tasks is shared between processes through it
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": ENV("CACHE_REDIS_URL", default="redis:///3"),
+    }
+}
+
+# Seconds during which an API progress response is served to all pollers of a task
+# (whole seconds, as cache backends truncate timeouts; at least 1)
+PROGRESS_CACHE_TTL = ENV.int("PROGRESS_CACHE_TTL", default=2)
+
+# Front → API HTTP client (see shared.api)
+API_CONNECT_TIMEOUT = ENV.float("API_CONNECT_TIMEOUT", default=3.05)
+API_READ_TIMEOUT = ENV.float("API_READ_TIMEOUT", default=30)
+API_MAX_RETRIES = ENV.int("API_MAX_RETRIES", default=3)
+API_RETRY_BACKOFF = ENV.float("API_RETRY_BACKOFF", default=0.5)
+API_POOL_SIZE = ENV.int("API_POOL_SIZE", default=10)
+# consecutive connection failures to a host before failing fast, and seconds before retrying it
+API_BREAKER_THRESHOLD = ENV.int("API_BREAKER_THRESHOLD", default=5)
+API_BREAKER_RESET = ENV.int("API_BREAKER_RESET", default=30)
+
+# Crop extraction (see datasets.crops): number of processes (default: all CPUs), and
+# max size in pixels of the saved crops (default: full resolution)
+CROP_WORKERS = ENV.int("CROP_WORKERS", default=None)
+CROP_MAX_SIZE = ENV.int("CROP_MAX_SIZE", default=None)
+
+# Max seconds a crop archive download waits for the same archive being cached by
+# another request, before streaming it without caching it
+CROPS_ZIP_LOCK_TIMEOUT = ENV.int("CROPS_ZIP_LOCK_TIMEOUT", default=60)
+
+# Number of document image lists kept in memory by each process
+IMAGE_INDEX_CACHE_SIZE = ENV.int("IMAGE_INDEX_CACHE_SIZE", default=32)
+
+# Number of DTI clustering results kept in memory by each process
+EXPANDED_RESULTS_CACHE_SIZE = ENV.int("EXPANDED_RESULTS_CACHE_SIZE", default=16)
+
+# Number of logged edits after which a saved clustering is compacted into a snapshot
+SAVED_CLUSTERING_COMPACTION = ENV.int("SAVED_CLUSTERING_COMPACTION", default=100)
+
+# Number of best matches kept per image in the similarity neighbor index
+SIMILARITY_TOP_K = ENV.int("SIMILARITY_TOP_K", default=100)
+# Number of similarity results whose browsing metadata is kept in memory by each process
+BROWSE_METADATA_CACHE_SIZE = ENV.int("BROWSE_METADATA_CACHE_SIZE", default=32)
+
+# Number of documents of a dataset downloaded and extracted at the same time
+EXTRACTION_WORKERS = ENV.int("EXTRACTION_WORKERS", default=4)
+# Max seconds to wait for a document being extracted by another process
+EXTRACTION_LOCK_TIMEOUT = ENV.int("EXTRACTION_LOCK_TIMEOUT", default=3600)
 
 MAX_UPLOAD_SIZE = ENV("MAX_UPLOAD_SIZE", default=250 * 1024 * 1024)  # 250MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = ENV(
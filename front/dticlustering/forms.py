@@ -1,3 +1,5 @@
+import copy
+
 from django import forms
 
 from .models import DTIClustering, SavedClustering
@@ -127,29 +129,62 @@ class DTIClusteringForm(AbstractTaskOnDatasetForm):
 
 
 class SavedClusteringForm(forms.ModelForm):
+    # edits made in the viewer (see SavedClustering.apply_operation)
+    operations = forms.JSONField(required=False, widget=forms.HiddenInput())
+
     class Meta:
         model = SavedClustering
-        fields = (
-            "name",
-            "clustering_data",
-        )
-        widgets = {"clustering_data": forms.HiddenInput()}
+        fields = ("name",)
 
     def __init__(self, *args, **kwargs):
         self.__from_task = kwargs.pop("from_task", None)
+        self.__clustering_data = None
 
         super().__init__(*args, **kwargs)
 
         if self.__from_task:
             self.fields["name"].initial = self.__from_task.name
 
+    def clean_operations(self):
+        operations = self.cleaned_data.get("operations")
+        if operations is None:
+            return []
+        if not isinstance(operations, list):
+            raise forms.ValidationError("Operations must be a list")
+        return operations
+
+    def clean(self):
+        cleaned_data = super().clean()
+        operations = cleaned_data.get("operations") or []
+        if not self.__from_task and not operations:
+            return cleaned_data
+
+        # edits apply to the task results when creating, to the current data otherwise
+        data = copy.deepcopy(
+            self.__from_task.expanded_results
+            if self.__from_task
+            else self.instance.current_data
+        )
+        try:
+            for operation in operations:
+                SavedClustering.apply_operation(data, operation)
+        except (ValueError, KeyError, TypeError) as e:
+            self.add_error("operations", f"Invalid operations: {e}")
+        self.__clustering_data = data
+        return cleaned_data
+
     def save(self, commit=True):
         instance = super().save(commit=False)
 
         if self.__from_task:
             instance.from_task = self.__from_task
+            # the snapshot already includes the submitted edits
+            instance.clustering_data = self.__clustering_data
+            instance.operations = []
 
         if commit:
             instance.save()
+            if not self.__from_task and self.cleaned_data.get("operations"):
+                instance.patch(self.cleaned_data["operations"])
 
         return instance
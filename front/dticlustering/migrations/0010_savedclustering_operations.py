@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("dticlustering", "0009_dticlustering_pipeline"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="savedclustering",
+            name="operations",
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
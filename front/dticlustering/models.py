@@ -1,28 +1,117 @@
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
 from django.utils.functional import cached_property
 from django.utils import timezone
 from django.urls import reverse
 from pathlib import Path
-import requests
+import os
+import threading
 import uuid
+import copy
 import json
-import csv
-import io
 import traceback
 import shutil
 
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
 
 from datasets.models import Dataset
 from tasking.models import AbstractAPITaskOnDataset
+from datasets.utils import unzip_on_the_fly
+from shared.utils import glob_to_regex, stream_table
 
 User = get_user_model()
 
+# per-process LRU of expanded results: {(task id, file mtime): result dict},
+# and of edited clusterings: {(saved clustering id, date): clustering data}
+_expanded_results_cache = OrderedDict()
+_expanded_results_lock = threading.Lock()
+
 API_URL = getattr(settings, "API_URL", "http://localhost:5000")
 BASE_URL = getattr(settings, "BASE_URL", "http://localhost:8000")
 
+# content of summary.zip, cherry-picked from results.zip
+SUMMARY_PATTERNS = [
+    glob_to_regex(p)
+    for p in [
+        "*.csv",
+        "clusters.html",
+        "clusters/**/*_raw.*",
+        "backgrounds/*",
+        "masked_prototypes/*",
+        "prototypes/*",
+    ]
+]
+
+
+EXPORT_HEADER = ["image_id", "image_path", "cluster_id", "cluster_name"]
+
+
+def cached_clustering_data(key: Tuple, load) -> Dict:
+    """
+    Returns load() through the per-process LRU (shared: do not modify)
+    """
+    with _expanded_results_lock:
+        if key in _expanded_results_cache:
+            _expanded_results_cache.move_to_end(key)
+            return _expanded_results_cache[key]
+
+    data = load()
+
+    with _expanded_results_lock:
+        _expanded_results_cache[key] = data
+        while len(_expanded_results_cache) > getattr(
+            settings, "EXPANDED_RESULTS_CACHE_SIZE", 16
+        ):
+            _expanded_results_cache.popitem(last=False)
+    return data
+
+
+def clusters_summary(clustering_data: Dict) -> Dict:
+    """
+    Returns the clusters without their images, with their size instead
+    """
+    return {
+        "clusters": [
+            {
+                **{k: v for k, v in cluster.items() if k != "images"},
+                "size": len(cluster["images"]),
+            }
+            for cluster in (clustering_data.get("clusters") or {}).values()
+        ],
+        "background_urls": clustering_data.get("background_urls", []),
+    }
+
+
+def cluster_images_page(
+    clustering_data: Dict, cluster_id: int, page: int = 1, page_size: int = 100
+) -> Optional[Dict]:
+    """
+    Returns one page of the images of a cluster (None if it doesn't exist)
+    """
+    cluster = (clustering_data.get("clusters") or {}).get(str(cluster_id))
+    if cluster is None:
+        return None
+    images = cluster["images"]
+    start = (page - 1) * page_size
+    return {
+        "id": cluster["id"],
+        "count": len(images),
+        "page": page,
+        "next_page": page + 1 if start + page_size < len(images) else None,
+        "images": images[start : start + page_size],
+    }
+
+
+def iter_export_rows(clustering_data: Dict) -> Iterator[Tuple]:
+    """
+    Yields one (image_id, image_path, cluster_id, cluster_name) row per image
+    """
+    for cluster_id, cluster in (clustering_data.get("clusters") or {}).items():
+        for img in cluster["images"]:
+            yield img["id"], img["path"], cluster_id, cluster["name"]
+
 
 class DTIClustering(AbstractAPITaskOnDataset("dticlustering")):
     """
@@ -68,44 +157,52 @@ class DTIClustering(AbstractAPITaskOnDataset("dticlustering")):
         self.save()
 
         # start collecting results
-        # from .tasks import collect_results
-        # collect_results.send(str(self.pk), data["output"]["result_url"])
-        self.retrieve_results(data["output"]["result_url"])
+        from .tasks import collect_results
+
+        collect_results.send(str(self.pk), data["output"]["result_url"])
 
     def retrieve_results(self, result_url: str):
-        # TODO find why the task is not starting
+        """
+        Downloads results.zip in a single pass: the archive is saved and extracted
+        while being downloaded, and the cherry-picked files are copied to
+        summary.zip on the way
+        """
         from zipfile import ZipFile
 
         try:
-            # download the results from the API
-            res = requests.get(result_url, stream=True)
-            res.raise_for_status()
             self.result_full_path.mkdir(parents=True, exist_ok=True)
-            zip_result_file = self.result_full_path / "results.zip"
-
-            with open(zip_result_file, "wb") as f:
-                for chunk in res.iter_content(chunk_size=8192):
-                    f.write(chunk)
-
-            # unzip the results
-            with ZipFile(zip_result_file, "r") as zip_obj:
-                zip_obj.extractall(self.result_full_path)
-
-            # create a summary.zip file, with cherry-picked content
             summary_zip = self.result_full_path / "summary.zip"
-            cherrypick = [
-                "*.csv",
-                "clusters.html",
-                "clusters/**/*_raw.*",
-                "backgrounds/*",
-                "masked_prototypes/*",
-                "prototypes/*",
-            ]
-
-            with ZipFile(summary_zip, "w") as zipObj:
-                for cp in cherrypick:
-                    for f in self.result_full_path.glob(cp):
-                        zipObj.write(f, f.relative_to(self.result_full_path))
+            summary_files = []
+
+            with ZipFile(summary_zip, "w") as summary:
+
+                def copy_to_summary(file_name: str):
+                    if not any(p.match(file_name) for p in SUMMARY_PATTERNS):
+                        return None
+                    summary_files.append(file_name)
+                    return summary.open(file_name, "w")
+
+                extracted_files = unzip_on_the_fly(
+                    result_url,
+                    self.result_full_path,
+                    archive_path=self.result_full_path / "results.zip",
+                    copy_to=copy_to_summary,
+                )
+
+            # record what was extracted, to avoid listing the result folder
+            with open(self.result_full_path / "manifest.json", "w") as f:
+                json.dump(
+                    {
+                        "files": [
+                            str(p.relative_to(self.result_full_path))
+                            for p in extracted_files
+                        ],
+                        "summary": summary_files,
+                    },
+                    f,
+                )
+
+            self.write_expanded_results()
 
             # mark the self as finished
             self.terminate_task()
@@ -151,10 +248,71 @@ class DTIClustering(AbstractAPITaskOnDataset("dticlustering")):
         # TODO delete
         return cls.get_frontend_monitoring()
 
+    @property
+    def expanded_results_path(self) -> Path:
+        """
+        JSON file holding expanded_results, written when the results are ingested
+        """
+        return self.result_full_path / "expanded_results.json"
+
+    def write_expanded_results(self) -> Dict:
+        """
+        Computes the result data and persists it to expanded_results_path
+        """
+        result_dict = self.compute_expanded_results()
+        tmp_path = self.expanded_results_path.with_suffix(".json.part")
+        with open(tmp_path, "w") as f:
+            json.dump(result_dict, f, separators=(",", ":"))
+        os.replace(tmp_path, self.expanded_results_path)
+        return result_dict
+
     @cached_property
-    def expanded_results(self):
+    def expanded_results(self) -> Dict:
         """
-        Returns a dict with all the result data
+        Returns a dict with all the result data (shared by the process: do not modify)
+
+        Read from expanded_results_path, which is written for results ingested
+        before it existed once the task is finished
+        """
+        try:
+            mtime = self.expanded_results_path.stat().st_mtime
+        except FileNotFoundError:
+            if self.status != "SUCCESS" or not self.result_zip_exists:
+                return self.compute_expanded_results()
+            self.write_expanded_results()
+            mtime = self.expanded_results_path.stat().st_mtime
+
+        def load():
+            with open(self.expanded_results_path, "r") as f:
+                return json.load(f)
+
+        return cached_clustering_data((str(self.pk), mtime), load)
+
+    def stream_export(self, fmt: str = "csv") -> Iterator[str]:
+        """
+        Yields the clustering result as CSV, JSON Lines or TSV, by chunks
+        """
+        return stream_table(
+            EXPORT_HEADER, iter_export_rows(self.expanded_results), fmt=fmt
+        )
+
+    def get_clusters_summary(self) -> Dict:
+        """
+        Returns the clusters without their images, with their size instead
+        """
+        return clusters_summary(self.expanded_results)
+
+    def get_cluster_images(
+        self, cluster_id: int, page: int = 1, page_size: int = 100
+    ) -> Optional[Dict]:
+        """
+        Returns one page of the images of a cluster (None if it doesn't exist)
+        """
+        return cluster_images_page(self.expanded_results, cluster_id, page, page_size)
+
+    def compute_expanded_results(self) -> Dict:
+        """
+        Builds the result data from the content of the result folder
         """
 
         path = self.result_full_path
@@ -225,7 +383,8 @@ class DTIClustering(AbstractAPITaskOnDataset("dticlustering")):
                 "name": f"Cluster {p}",
                 "images": [],
             }
-            result_dict["clusters"][p] = cluster
+            # string keys, as once persisted in JSON
+            result_dict["clusters"][str(p)] = cluster
 
             # add mask
             cluster["mask_url"] = try_and_get_url(
@@ -276,7 +435,10 @@ class SavedClustering(models.Model):
         help_text="An optional name to identify this clustering",
     )
     date = models.DateTimeField(auto_now=True, editable=False)
+    # snapshot of the clustering, as of the last compaction
     clustering_data = models.JSONField(null=True)
+    # edits made since the snapshot (see apply_operation)
+    operations = models.JSONField(default=list, blank=True, editable=False)
 
     class Meta:
         ordering = ["-date"]
@@ -288,19 +450,147 @@ class SavedClustering(models.Model):
             kwargs={"pk": self.pk, "from_pk": self.from_task_id},  # self.from_task_id}
         )
 
-    def format_as_csv(self) -> str:
+    @staticmethod
+    def apply_operation(data: Dict, operation: Dict):
         """
-        Returns a CSV string with the clustering data
+        Applies an edit to clustering data (in place), the way the ClusterApp editor does:
+        - {"type": "rename", "cluster_id": id, "name": str}
+        - {"type": "merge", "cluster_id": id, "other": id}: moves the images of
+          other to cluster_id and deletes other
+        - {"type": "move", "cluster_id": id, "other": id, "images": [image ids]}:
+          moves images from cluster_id to other (-1 for a new cluster)
+
+        Raises:
+            ValueError if the operation is invalid
+        """
+        clusters = data["clusters"]
+
+        def get_cluster(cluster_id) -> Dict:
+            try:
+                return clusters[str(int(cluster_id))]
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Unknown cluster {cluster_id}")
+
+        def erase_metadata(images: List[Dict]) -> List[Dict]:
+            # transformed images and distances don't apply to another cluster
+            return [
+                {
+                    **{k: v for k, v in img.items() if k != "tsf_url"},
+                    "distance": img["id"] + 10,
+                }
+                for img in images
+            ]
+
+        op_type = operation.get("type")
+        if op_type == "rename":
+            get_cluster(operation.get("cluster_id"))["name"] = str(operation["name"])
+
+        elif op_type == "merge":
+            cluster = get_cluster(operation.get("cluster_id"))
+            other = get_cluster(operation.get("other"))
+            if other is cluster:
+                raise ValueError("Can't merge a cluster with itself")
+            cluster["images"] += erase_metadata(other["images"])
+            del clusters[str(other["id"])]
+
+        elif op_type == "move":
+            cluster = get_cluster(operation.get("cluster_id"))
+            image_ids = set(operation.get("images") or [])
+            moved = [img for img in cluster["images"] if img["id"] in image_ids]
+            if operation.get("other") == -1:
+                new_id = max(int(k) for k in clusters) + 1
+                other = clusters[str(new_id)] = {
+                    "id": new_id,
+                    "name": f"Cluster {new_id}",
+                    "images": [],
+                }
+            else:
+                other = get_cluster(operation.get("other"))
+            cluster["images"] = [
+                img for img in cluster["images"] if img["id"] not in image_ids
+            ]
+            other["images"] += erase_metadata(moved)
+
+        else:
+            raise ValueError(f"Unknown operation {op_type}")
+
+    def materialize(self) -> Dict:
+        """
+        Returns the current clustering data: the snapshot with the operations applied
+        """
+        data = copy.deepcopy(self.clustering_data)
+        for operation in self.operations:
+            self.apply_operation(data, operation)
+        return data
+
+    @property
+    def current_data(self) -> Dict:
+        """
+        materialize(), memoized by the process until the clustering is saved again
+        (shared: do not modify)
+        """
+        return cached_clustering_data(
+            (str(self.pk), self.date.isoformat()), self.materialize
+        )
+
+    def get_clusters_summary(self) -> Dict:
+        """
+        Returns the clusters without their images, with their size instead
+        """
+        return clusters_summary(self.current_data)
+
+    def get_cluster_images(
+        self, cluster_id: int, page: int = 1, page_size: int = 100
+    ) -> Optional[Dict]:
+        """
+        Returns one page of the images of a cluster (None if it doesn't exist)
+        """
+        return cluster_images_page(self.current_data, cluster_id, page, page_size)
+
+    def patch(self, operations: List[Dict]) -> bool:
         """
-        output = io.StringIO()
-        writer = csv.writer(output)
+        Validates and logs operations, compacting the log into the snapshot
+        when it grows over SAVED_CLUSTERING_COMPACTION (default 100 operations)
 
-        writer.writerow(["image_id", "image_path", "cluster_id", "cluster_name"])
+        Returns:
+            True if the log was compacted
 
-        for cluster_id, cluster in self.clustering_data["clusters"].items():
-            for img in cluster["images"]:
-                writer.writerow([img["id"], img["path"], cluster_id, cluster["name"]])
+        Raises:
+            ValueError if an operation is invalid (nothing is saved)
+        """
+        with transaction.atomic():
+            locked = SavedClustering.objects.select_for_update().get(pk=self.pk)
+            self.clustering_data, self.operations = (
+                locked.clustering_data,
+                locked.operations,
+            )
+            data = self.materialize()
+            for operation in operations:
+                self.apply_operation(data, operation)
+            self.operations = self.operations + list(operations)
 
-        return output.getvalue()
+            compact = len(self.operations) >= getattr(
+                settings, "SAVED_CLUSTERING_COMPACTION", 100
+            )
+            if compact:
+                self.clustering_data, self.operations = data, []
+                self.save(update_fields=["clustering_data", "operations", "date"])
+            else:
+                self.save(update_fields=["operations", "date"])
+        return compact
+
+    def stream_export(self, fmt: str = "csv") -> Iterator[str]:
+        """
+        Yields the clustering as CSV, JSON Lines or TSV, by chunks
+        """
+        return stream_table(
+            EXPORT_HEADER, iter_export_rows(self.materialize()), fmt=fmt
+        )
+
+    def format_as_csv(self) -> str:
+        """
+        Returns a CSV string with the clustering data
+        """
+        return "".join(self.stream_export("csv"))
 
     # TODO do we need a pre_delete method for SavedClustering
@@ -8,6 +8,18 @@ urlpatterns = [
     path("start", DTIClusteringStart.as_view(), name="start"),
     path("<uuid:pk>", DTIClusteringStatus.as_view(), name="status"),
     path("<uuid:pk>/progress", DTIClusteringProgress.as_view(), name="progress"),
+    path(
+        "<uuid:pk>/progress/stream",
+        DTIClusteringProgressStream.as_view(),
+        name="progress_stream",
+    ),
+    path("<uuid:pk>/clusters", DTIClusteringClusters.as_view(), name="clusters"),
+    path(
+        "<uuid:pk>/clusters/<int:cluster_id>",
+        DTIClusteringClusterImages.as_view(),
+        name="cluster_images",
+    ),
+    path("<uuid:pk>/export", DTIClusteringExport.as_view(), name="export"),
     path("<uuid:pk>/cancel", DTIClusteringCancel.as_view(), name="cancel"),
     path("<uuid:pk>/watch", DTIClusteringWatcher.as_view(), name="notify"),
     path("<uuid:pk>/restart", DTIClusteringStartFrom.as_view(), name="restart"),
@@ -18,6 +30,21 @@ urlpatterns = [
         name="saved_create",
     ),
     path("<uuid:from_pk>/saved/<uuid:pk>", SavedClusteringEdit.as_view(), name="saved"),
+    path(
+        "<uuid:from_pk>/saved/<uuid:pk>/clusters",
+        SavedClusteringClusters.as_view(),
+        name="saved_clusters",
+    ),
+    path(
+        "<uuid:from_pk>/saved/<uuid:pk>/clusters/<int:cluster_id>",
+        SavedClusteringClusterImages.as_view(),
+        name="saved_cluster_images",
+    ),
+    path(
+        "<uuid:from_pk>/saved/<uuid:pk>/patch",
+        SavedClusteringPatch.as_view(),
+        name="saved_patch",
+    ),
     path(
         "<uuid:from_pk>/saved/<uuid:pk>/delete",
         SavedClusteringDelete.as_view(),
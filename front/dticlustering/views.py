@@ -11,11 +11,16 @@ from django.views.generic.detail import SingleObjectMixin
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.contrib import messages
 from django.shortcuts import redirect
-from django.http import JsonResponse, Http404, HttpResponse
+from django.http import JsonResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.gzip import gzip_page
 from typing import Any
+import json
 
 from tasking.views import *
 
+from shared.utils import EXPORT_FORMATS
 from .models import DTIClustering, SavedClustering
 from .forms import DTIClusteringForm, SavedClusteringForm
 
@@ -50,6 +55,10 @@ class DTIClusteringProgress(DTIClusteringMixin, TaskProgressView):
     pass
 
 
+class DTIClusteringProgressStream(DTIClusteringMixin, TaskProgressStreamView):
+    pass
+
+
 class DTIClusteringCancel(DTIClusteringMixin, TaskCancelView):
     pass
 
@@ -65,14 +74,54 @@ class DTIClusteringDelete(DTIClusteringMixin, TaskDeleteView):
 class DTIClusteringList(DTIClusteringMixin, TaskListView):
     permission_see_all = "dticlustering.monitor_dticlustering"
 
-    def get_queryset(self):
-        return super().get_queryset().prefetch_related("dataset")
-
 
 class DTIClusteringByDatasetList(DTIClusteringMixin, TaskByDatasetList):
     permission_see_all = "dticlustering.monitor_dticlustering"
 
 
+# images per page of the cluster API, and max page size a client can ask for
+CLUSTER_PAGE_SIZE = 100
+CLUSTER_PAGE_SIZE_MAX = 1000
+
+
+class DTIClusteringClusters(
+    DTIClusteringMixin, LoginRequiredIfConfProtectedMixin, SingleObjectMixin, View
+):
+    """
+    Clusters of a result, without their images (AJAX)
+    """
+
+    def get(self, *args, **kwargs):
+        self.object = self.get_object()
+        return JsonResponse(self.object.get_clusters_summary())
+
+
+class DTIClusteringClusterImages(
+    DTIClusteringMixin, LoginRequiredIfConfProtectedMixin, SingleObjectMixin, View
+):
+    """
+    One page of the images of a cluster (AJAX), ?page=1&page_size=100
+    """
+
+    def get(self, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            page = max(1, int(self.request.GET.get("page", 1)))
+            page_size = min(
+                max(1, int(self.request.GET.get("page_size", CLUSTER_PAGE_SIZE))),
+                CLUSTER_PAGE_SIZE_MAX,
+            )
+        except ValueError:
+            return JsonResponse({"error": "Invalid page"}, status=400)
+
+        images = self.object.get_cluster_images(
+            self.kwargs["cluster_id"], page, page_size
+        )
+        if images is None:
+            raise Http404()
+        return JsonResponse(images)
+
+
 # TODO add DTIClusteringMixin
 class SavedClusteringFromDTI(LoginRequiredMixin, CreateView):
     """
@@ -91,8 +140,6 @@ class SavedClusteringFromDTI(LoginRequiredMixin, CreateView):
         except DTIClustering.DoesNotExist:
             raise Http404()
 
-        initial = kwargs.get("initial", {})
-        initial["clustering_data"] = self.from_task.expanded_results
         kwargs["from_task"] = self.from_task
 
         return kwargs
@@ -102,6 +149,10 @@ class SavedClusteringFromDTI(LoginRequiredMixin, CreateView):
 
         context["from_task"] = self.from_task
         context["editing"] = True
+        # edits are made on the task results, and submitted with the form
+        context["clusters_url"] = reverse(
+            "dticlustering:clusters", kwargs={"pk": self.from_task.pk}
+        )
 
         return context
 
@@ -123,10 +174,66 @@ class SavedClusteringEdit(LoginRequiredMixin, UpdateView):
         context = super().get_context_data(**kwargs)
 
         context["from_task"] = self.object.from_task
+        context["clusters_url"] = reverse(
+            "dticlustering:saved_clusters",
+            kwargs={"from_pk": self.object.from_task_id, "pk": self.object.pk},
+        )
+        context["patch_url"] = reverse(
+            "dticlustering:saved_patch",
+            kwargs={"from_pk": self.object.from_task_id, "pk": self.object.pk},
+        )
 
         return context
 
 
+class SavedClusteringClusters(LoginRequiredMixin, DTIClusteringClusters):
+    """
+    Clusters of a saved clustering, edits included, without their images (AJAX)
+    """
+
+    model = SavedClustering
+
+    def get_queryset(self):
+        return SavedClustering.objects.filter(from_task=self.kwargs["from_pk"])
+
+
+class SavedClusteringClusterImages(LoginRequiredMixin, DTIClusteringClusterImages):
+    """
+    One page of the images of a cluster of a saved clustering (AJAX)
+    """
+
+    model = SavedClustering
+
+    def get_queryset(self):
+        return SavedClustering.objects.filter(from_task=self.kwargs["from_pk"])
+
+
+class SavedClusteringPatch(LoginRequiredMixin, SingleObjectMixin, View):
+    """
+    Applies edits to a clustering (AJAX): POST {"operations": [...]}
+    (see SavedClustering.apply_operation)
+    """
+
+    model = SavedClustering
+
+    def get_queryset(self):
+        return super().get_queryset().filter(from_task=self.kwargs["from_pk"])
+
+    def post(self, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            operations = json.loads(self.request.body)["operations"]
+            if not isinstance(operations, list):
+                raise ValueError("operations must be a list")
+            compacted = self.object.patch(operations)
+        except (ValueError, KeyError, TypeError) as e:
+            return JsonResponse({"error": f"Invalid operations: {e}"}, status=400)
+
+        return JsonResponse(
+            {"operations": len(self.object.operations), "compacted": compacted}
+        )
+
+
 class SavedClusteringDelete(LoginRequiredMixin, DeleteView):
     """
     Delete a saved clustering
@@ -148,9 +255,25 @@ class SavedClusteringDelete(LoginRequiredMixin, DeleteView):
         return self.object.from_task.get_absolute_url()
 
 
+def export_response(obj, fmt: str, filename: str):
+    """
+    Streams obj.stream_export(fmt) as an attachment
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise Http404(f"Unknown export format {fmt}")
+    content_type, extension = EXPORT_FORMATS[fmt]
+    response = StreamingHttpResponse(
+        obj.stream_export(fmt), content_type=f"{content_type}; charset=utf-8"
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{extension}"'
+    return response
+
+
+# gzip_page compresses the stream when the client accepts it
+@method_decorator(gzip_page, name="get")
 class SavedClusteringCSVExport(LoginRequiredMixin, SingleObjectMixin, View):
     """
-    Export a clustering as CSV
+    Export a clustering as CSV (or ?format=jsonl|tsv)
     """
 
     model = SavedClustering
@@ -164,13 +287,24 @@ class SavedClusteringCSVExport(LoginRequiredMixin, SingleObjectMixin, View):
         if not hasattr(self, "object"):
             self.object = self.get_object()
 
-        # create CSV response
-        response = HttpResponse(content_type="text/csv")
-        response["Content-Disposition"] = 'attachment; filename="clustering.csv"'
-        data = self.object.format_as_csv()
-        response.write(data)
+        return export_response(
+            self.object, self.request.GET.get("format", "csv"), "clustering"
+        )
 
-        return response
+
+@method_decorator(gzip_page, name="get")
+class DTIClusteringExport(
+    DTIClusteringMixin, LoginRequiredIfConfProtectedMixin, SingleObjectMixin, View
+):
+    """
+    Export a clustering result as CSV (or ?format=jsonl|tsv)
+    """
+
+    def get(self, *args, **kwargs):
+        self.object = self.get_object()
+        return export_response(
+            self.object, self.request.GET.get("format", "csv"), "clustering_result"
+        )
 
 
 # SuperUser views
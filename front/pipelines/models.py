@@ -82,7 +82,7 @@ class Pipeline(AbstractTaskOnDataset("pipelines")):
         for k, t in enumerate(reversed(self.tasks)):
             task = self.get_task(t)
             if task:
-                return task.get_progress()
+                return task.get_cached_progress()
                 return f"RUNNING SUBTASK {len(self.tasks) - k} OF {len(self.tasks)} ({t.upper()})\n\n{task.get_progress()}"
         return {}
 
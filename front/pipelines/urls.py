@@ -4,10 +4,15 @@ from .views import *
 app_name = "pipelines"
 
 urlpatterns = [
-    path("", PipelineList.as_view(), name="list"),
+    path("", PipelineMixin.List.as_view(), name="list"),
     path("start", PipelineMixin.Start.as_view(), name="start"),
     path("<uuid:pk>", PipelineMixin.Status.as_view(), name="status"),
     path("<uuid:pk>/progress", PipelineMixin.Progress.as_view(), name="progress"),
+    path(
+        "<uuid:pk>/progress/stream",
+        PipelineMixin.ProgressStream.as_view(),
+        name="progress_stream",
+    ),
     path("<uuid:pk>/cancel", PipelineMixin.Cancel.as_view(), name="cancel"),
     path("<uuid:pk>/watch", PipelineMixin.Watcher.as_view(), name="notify"),
     path("<uuid:pk>/restart", PipelineMixin.StartFrom.as_view(), name="restart"),
@@ -19,8 +19,3 @@ class PipelineMixin:
     app_name = "Pipeline"
     # NOTE: set task_data to "dataset" in order to use dataset form template
     task_data = "dataset"
-
-
-class PipelineList(PipelineMixin.List):
-    def get_queryset(self):
-        return super().get_queryset().prefetch_related("dataset")
@@ -0,0 +1,74 @@
+# Generated by Django 4.2.30 on 2026-10-17 21:23
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def annotations_path(regions) -> Path:
+    return Path(settings.MEDIA_ROOT) / "regions" / str(regions.id) / "annotations.json"
+
+
+def count_regions(annotations) -> int:
+    return sum(
+        len(image.get(0, image).get("crops", []))
+        for images in annotations.values()
+        for image in images
+    )
+
+
+def move_annotations_to_files(apps, schema_editor):
+    Regions = apps.get_model("regions", "Regions")
+    queryset = Regions.objects.exclude(regions=None).only("id", "regions")
+    for regions in queryset.iterator(chunk_size=50):
+        content = json.dumps(regions.regions).encode()
+        path = annotations_path(regions)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.part")
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        regions.regions_count = count_regions(regions.regions)
+        regions.regions_checksum = hashlib.sha256(content).hexdigest()
+        regions.save(update_fields=["regions_count", "regions_checksum"])
+
+
+def move_annotations_to_rows(apps, schema_editor):
+    Regions = apps.get_model("regions", "Regions")
+    for regions in Regions.objects.only("id").iterator(chunk_size=50):
+        try:
+            with open(annotations_path(regions), "rb") as f:
+                regions.regions = json.loads(f.read())
+        except FileNotFoundError:
+            continue
+        regions.save(update_fields=["regions"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("regions", "0005_regions_pipeline"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="regions",
+            name="regions_checksum",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="regions",
+            name="regions_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(move_annotations_to_files, move_annotations_to_rows),
+        migrations.RemoveField(
+            model_name="regions",
+            name="regions",
+        ),
+    ]
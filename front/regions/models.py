@@ -1,18 +1,92 @@
-import json
-from typing import List, Dict, Iterable, Any
+import hashlib
+import os
+import shutil
+import uuid
+from collections.abc import Sequence
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List, Dict, Iterable, Any, Optional
+
+import orjson
 
 from django.urls import reverse
 from django.db import models
 from django.conf import settings
-import requests
 
+from datasets.utils import file_lock, read_chunks, tee_to_file
+from shared.api import api_get
 from shared.utils import zip_on_the_fly
 from tasking.models import AbstractAPITaskOnDataset
 
+# number of source images per page of regions results
+DISPLAY_PAGE_SIZE = 20
+
+
+class DisplayPages(Sequence):
+    """
+    Source images of the display payload, loading only the pages that are sliced
+    (e.g. by a django.core.paginator.Paginator)
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.meta = self.read_meta()
+
+    def read_meta(self) -> Dict:
+        try:
+            with open(self.path / "meta.json", "rb") as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return {"count": 0, "boxes": 0, "page_size": DISPLAY_PAGE_SIZE}
+
+    @property
+    def pages_path(self) -> Path:
+        # payloads written before versioning have their pages next to meta.json
+        return self.path / self.meta.get("version", "")
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def load_page(self, page: int) -> List[Dict]:
+        try:
+            with open(self.pages_path / f"{page}.json", "rb") as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            # the payload was rewritten twice meanwhile: read the current version
+            meta = self.read_meta()
+            if meta.get("version") == self.meta.get("version"):
+                return []
+            self.meta = meta
+            return self.load_page(page)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self[key : key + 1][0]
+        start, stop, _ = key.indices(len(self))
+        if start >= stop:
+            return []
+        page_size = self.meta["page_size"]
+        first, last = start // page_size + 1, (stop - 1) // page_size + 1
+        items = sum((self.load_page(p) for p in range(first, last + 1)), [])
+        offset = (first - 1) * page_size
+        return items[start - offset : stop - offset]
+
+
+def count_regions(annotations: Dict[str, List[Dict]]) -> int:
+    """
+    Number of boxes in {doc_uid: [{source, doc_uid, crops: List[Dict]}]} annotations
+    """
+    return sum(
+        len(image.get(0, image).get("crops", []))
+        for images in annotations.values()
+        for image in images
+    )
+
 
 class Regions(AbstractAPITaskOnDataset("regions")):
-    # Results
-    regions = models.JSONField(null=True, blank=True)
+    # Results: annotations are stored in annotations_path, summarized here
+    regions_count = models.PositiveIntegerField(default=0, editable=False)
+    regions_checksum = models.CharField(max_length=64, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Regions Extraction"
@@ -34,29 +108,84 @@ class Regions(AbstractAPITaskOnDataset("regions")):
                 self.on_task_error({"error": "No output data"})
                 return
 
-            self.regions = output.get("annotations", {})
-            with open(self.task_full_path / f"{self.dataset.id}.json", "w") as f:
-                json.dump(self.regions, f)
+            self.set_annotations(output.get("annotations", {}))
 
             dataset_url = output.get("dataset_url")
             if dataset_url:
                 self.dataset.api_url = dataset_url
                 self.dataset.save()
-
-            result = self.dataset.apply_cropping(self.get_bounding_boxes())
-            if "error" in result:
-                # self.terminate_task(status="ERROR", error=traceback.format_exc())
-                self.on_task_error(result)
-                return
         else:
             self.on_task_error({"error": "No output data"})
             return
 
-        return super().on_task_success(data)
+        self.save()
+
+        # cropping can take a while: done by the dramatiq worker
+        from .tasks import collect_results
+
+        collect_results.send(str(self.pk))
+
+    def collect_results(self):
+        """
+        Crops the regions found by the API (called by regions.tasks.collect_results)
+        """
+        result = self.dataset.apply_cropping(self.get_bounding_boxes())
+        if result.get("errors"):
+            self.write_log("\n".join(result["errors"]) + "\n")
+        if "error" in result:
+            self.on_task_error(result)
+            return
+        self.write_log(
+            f"Cropped {result['extracted']} regions: {result['throughput']}\n"
+        )
+        self.write_bounding_boxes_for_display()
+
+        self.terminate_task()
+
+    @property
+    def annotations_path(self) -> Path:
+        return self.task_full_path / "annotations.json"
+
+    def set_annotations(self, annotations: Dict[str, List[Dict]]):
+        """
+        Writes the annotations to annotations_path and updates their summary
+        (the row still has to be saved)
+        """
+        content = orjson.dumps(annotations)
+        self.task_full_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.annotations_path.with_name(f".{uuid.uuid4().hex}.part")
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, self.annotations_path)
+
+        self.regions_count = count_regions(annotations)
+        self.regions_checksum = hashlib.sha256(content).hexdigest()
+        self._annotations = annotations
+        self.__dict__.pop("_bounding_boxes", None)
+
+    @property
+    def annotations(self) -> Dict[str, List[Dict]]:
+        """
+        {doc_uid: [{source, doc_uid, crops: List[Dict]}]}, loaded on first access
+        """
+        if not hasattr(self, "_annotations"):
+            try:
+                with open(self.annotations_path, "rb") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                if self.regions_count:
+                    print(f"Annotations of {self.pk} are missing")
+                content = b"{}"
+            else:
+                checksum = hashlib.sha256(content).hexdigest()
+                if self.regions_checksum and checksum != self.regions_checksum:
+                    print(f"Annotations of {self.pk} do not match their checksum")
+            self._annotations = orjson.loads(content)
+        return self._annotations
 
     @property
     def has_crops(self):
-        return bool(self.regions)
+        return self.regions_count > 0
 
     @property
     def crop_paths(self):
@@ -64,14 +193,82 @@ class Regions(AbstractAPITaskOnDataset("regions")):
             return []
         return self.dataset.get_paths_for_crops(self.get_bounding_boxes())
 
-    def zip_crops(self) -> Iterable[bytes]:
+    def zip_crops(self) -> Optional[Iterable[bytes]]:
         """Zip the crops"""
-        paths = self.crop_paths
-        if not paths:
+        if not self.has_crops:
             return None
-        return zip_on_the_fly(
-            [(str(p.relative_to(self.dataset.crops_path)), p) for p in paths]
+        crops_path = self.dataset.crops_path
+        paths = self.dataset.get_paths_for_crops(
+            self.get_bounding_boxes(), only_extracted=True
         )
+        if not paths:
+            return None
+        # crops listed in the manifest are known to exist, with their mtime
+        manifest = self.dataset.crops_manifest
+        files = []
+        for p in paths:
+            name = p.relative_to(crops_path).as_posix()
+            if name in manifest:
+                files.append((name, p, manifest[name][1]))
+            else:
+                files.append((name, p))
+        return zip_on_the_fly(files)
+
+    def get_crops_zip_path(self) -> Optional[Path]:
+        """
+        Path of the cached crop archive, named after the crops it contains
+        (crop keys from the dataset manifest), so that it changes with them
+        """
+        if not self.has_crops:
+            return None
+        crops_path = self.dataset.crops_path
+        manifest = self.dataset.crops_manifest
+        digest = hashlib.sha1()
+        for p in self.dataset.get_paths_for_crops(
+            self.get_bounding_boxes(), only_extracted=True
+        ):
+            name = p.relative_to(crops_path).as_posix()
+            digest.update(f"{name}|{manifest.get(name, [''])[0]}\n".encode())
+        return self.result_full_path / f"crops_{digest.hexdigest()[:16]}.zip"
+
+    def stream_crops_zip(self, zip_path: Path) -> Optional[Iterable[bytes]]:
+        """
+        Streams the crop archive while caching it to zip_path, one request at a
+        time: the others wait for it and stream the cached archive (or, after
+        CROPS_ZIP_LOCK_TIMEOUT seconds, the archive without caching it)
+        """
+        content = self.zip_crops()
+        if content is None:
+            return None
+
+        def remove_older_archives():
+            for old in zip_path.parent.glob("crops_*.zip"):
+                if old != zip_path:
+                    old.unlink(missing_ok=True)
+
+        def stream():
+            with ExitStack() as stack:
+                try:
+                    stack.enter_context(
+                        file_lock(
+                            self.result_full_path / ".crops_zip.lock",
+                            timeout=getattr(settings, "CROPS_ZIP_LOCK_TIMEOUT", 60),
+                        )
+                    )
+                except TimeoutError:
+                    yield from content
+                    return
+
+                # cached by another request while we were waiting
+                if zip_path.exists():
+                    with open(zip_path, "rb") as f:
+                        yield from read_chunks(f.read)
+                    return
+                yield from tee_to_file(
+                    content, zip_path, on_complete=remove_older_archives
+                )
+
+        return stream()
 
     def get_download_zip_url(self):
         """Get the URL for downloading cropped images in a zip"""
@@ -89,16 +286,23 @@ class Regions(AbstractAPITaskOnDataset("regions")):
         """
         Returns a list of {source, doc_id, crops: List[Dict]} dictionaries
         """
-        if self.regions is None:
-            return []
-        return sum(self.regions.values(), [])
+        if not hasattr(self, "_bounding_boxes"):
+            self._bounding_boxes = [
+                image for images in self.annotations.values() for image in images
+            ]
+        return self._bounding_boxes
 
-    def get_bounding_boxes_for_display(self):
+    def get_bounding_boxes_for_display(self) -> List[Dict]:
+        """
+        Returns [{image: {url, name}, crops: [{x, y, width, height, url}]}] for
+        each source image (computed; see get_display_pages for the cached version)
+        """
         bbox = []
         dataset = self.dataset
         if not dataset:
             return bbox
         doc_image_map = dataset.get_doc_image_mapping()
+        media_root = Path(settings.MEDIA_ROOT)
         for image in self.get_bounding_boxes():
             image = image.get(0, image)  # Old format : single-item lists
             img_name, crops = image.get("source", ""), image.get("crops", [])
@@ -109,10 +313,8 @@ class Regions(AbstractAPITaskOnDataset("regions")):
 
             formatted_crops = []
             for idx, crop in enumerate(crops):
-                crop_path = self.dataset.get_path_for_crop(crop, doc_uid=doc_uid, i=idx)
-                crop_url = settings.MEDIA_URL + str(
-                    crop_path.relative_to(settings.MEDIA_ROOT)
-                )
+                crop_path = dataset.get_path_for_crop(crop, doc_uid=doc_uid, i=idx)
+                crop_url = settings.MEDIA_URL + str(crop_path.relative_to(media_root))
                 relative = crop["relative"]
                 formatted_crops.append(
                     {
@@ -128,7 +330,7 @@ class Regions(AbstractAPITaskOnDataset("regions")):
                 {
                     "image": {
                         "url": source_url,
-                        "path": source_img,
+                        "name": img_name,
                     },
                     "crops": formatted_crops,
                 }
@@ -136,10 +338,79 @@ class Regions(AbstractAPITaskOnDataset("regions")):
 
         return bbox
 
+    @property
+    def display_path(self) -> Path:
+        """
+        Folder of the display payload: meta.json, pointing to the <version>
+        folder of <page>.json files of DISPLAY_PAGE_SIZE source images
+        """
+        return self.result_full_path / "display"
+
+    @property
+    def display_lock_path(self) -> Path:
+        return self.result_full_path / ".display.lock"
+
+    def _write_display_pages(self):
+        """
+        Writes the pages in a new version folder, then switches meta.json to it
+        at once; the previous version is kept for the requests reading it
+        """
+        items = self.get_bounding_boxes_for_display()
+        previous = DisplayPages(self.display_path).meta.get("version", "")
+        version = uuid.uuid4().hex
+        pages_path = self.display_path / version
+        pages_path.mkdir(parents=True)
+        for page, start in enumerate(range(0, len(items), DISPLAY_PAGE_SIZE), 1):
+            with open(pages_path / f"{page}.json", "wb") as f:
+                f.write(orjson.dumps(items[start : start + DISPLAY_PAGE_SIZE]))
+
+        tmp_path = self.display_path / f".meta.{version}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(
+                orjson.dumps(
+                    {
+                        "version": version,
+                        "count": len(items),
+                        "boxes": sum(len(item["crops"]) for item in items),
+                        "page_size": DISPLAY_PAGE_SIZE,
+                    }
+                )
+            )
+        os.replace(tmp_path, self.display_path / "meta.json")
+
+        for path in self.display_path.iterdir():
+            if path.is_dir() and path.name not in (version, previous):
+                shutil.rmtree(path, ignore_errors=True)
+            elif previous and path.suffix == ".json" and path.stem.isdigit():
+                # pages of a payload written before versioning
+                path.unlink(missing_ok=True)
+
+    def write_bounding_boxes_for_display(self):
+        """
+        Writes the display payload, page by page
+        """
+        with file_lock(self.display_lock_path):
+            self._write_display_pages()
+
+    def get_display_pages(self) -> "DisplayPages":
+        """
+        Display payload as a lazy sequence of source images (written on first
+        use for older results, by a single request)
+        """
+        if (
+            self.status == "SUCCESS"
+            and self.dataset
+            and not (self.display_path / "meta.json").exists()
+        ):
+            with file_lock(self.display_lock_path):
+                if not (self.display_path / "meta.json").exists():
+                    self._write_display_pages()
+        return DisplayPages(self.display_path)
+
     @classmethod
     def get_available_models(cls):
         try:
-            response = requests.get(f"{cls.api_endpoint_prefix}/models")
+            response = api_get(f"{cls.api_endpoint_prefix}/models")
             response.raise_for_status()
             models = response.json()
         except Exception as e:
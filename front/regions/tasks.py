@@ -1,7 +1,4 @@
 import dramatiq
-import requests
-from zipfile import ZipFile
-import traceback
 
 from .models import Regions
 
@@ -11,5 +8,20 @@ All dramatiq tasks related to images regions extraction
 
 
 @dramatiq.actor
-def collect_results(experiment_id: str, result_url: str):
-    pass
+def collect_results(experiment_id: str):
+    """
+    Crop the regions returned by the API once the task succeeded
+    """
+    try:
+        regions = Regions.objects.get(id=experiment_id)
+    except Regions.DoesNotExist as e:
+        print(
+            f"[regions.collect_results] Unknown Regions: experiment_id doesn't match any record {e}"
+        )
+        return
+
+    if regions.is_finished:
+        # message delivered twice: results were already collected
+        return
+
+    regions.collect_results()
@@ -4,10 +4,15 @@ from .views import *
 app_name = "regions"
 
 urlpatterns = [
-    path("", RegionsList.as_view(), name="list"),
+    path("", RegionsMixin.List.as_view(), name="list"),
     path("start", RegionsMixin.Start.as_view(), name="start"),
-    path("<uuid:pk>", RegionsMixin.Status.as_view(), name="status"),
+    path("<uuid:pk>", RegionsStatus.as_view(), name="status"),
     path("<uuid:pk>/progress", RegionsMixin.Progress.as_view(), name="progress"),
+    path(
+        "<uuid:pk>/progress/stream",
+        RegionsMixin.ProgressStream.as_view(),
+        name="progress_stream",
+    ),
     path("<uuid:pk>/cancel", RegionsMixin.Cancel.as_view(), name="cancel"),
     path("<uuid:pk>/watch", RegionsMixin.Watcher.as_view(), name="notify"),
     path("<uuid:pk>/restart", RegionsMixin.StartFrom.as_view(), name="restart"),
@@ -1,8 +1,14 @@
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+from django.core.paginator import Paginator
 from django.views.generic import View
-from django.http import FileResponse, Http404, HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header
 
 from .forms import RegionsForm
-from .models import Regions
+from .models import DISPLAY_PAGE_SIZE, Regions
 from tasking.views import task_view_set
 
 
@@ -21,27 +27,136 @@ class RegionsMixin:
     task_data = "dataset"
 
 
-class RegionsList(RegionsMixin.List):
-    def get_queryset(self):
-        return super().get_queryset().prefetch_related("dataset")
+class RegionsStatus(RegionsMixin.Status):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.object.status == "SUCCESS":
+            # only the requested page of the display payload is loaded
+            context["page_obj"] = Paginator(
+                self.object.get_display_pages(), DISPLAY_PAGE_SIZE
+            ).get_page(self.request.GET.get("page"))
+        return context
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_byte_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (first, last) byte of a single "bytes=" Range header, None to send the whole
+    file (no header, malformed or multiple ranges)
+
+    Raises:
+        RangeNotSatisfiable if the range starts past the end of the file
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes=") :].strip().partition("-")
+    try:
+        if not first:
+            # suffix range: the last bytes of the file
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - length), size - 1
+        first, last = int(first), int(last) if last else size - 1
+    except RangeNotSatisfiable:
+        raise
+    except ValueError:
+        return None
+    if first >= size:
+        raise RangeNotSatisfiable(header)
+    if last < first:
+        return None
+    return first, min(last, size - 1)
+
+
+def read_byte_range(
+    path: Path, first: int, last: int, chunk_size: int = 65536
+) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
 
 
 class RegionsDownloadZip(View):
+    """
+    Downloads the crops as a zip: streamed the first time while being cached,
+    then served from the cached archive (with Content-Length, ETag and support
+    for Range requests, so that downloads can be resumed)
+    """
+
     def get(self, request, pk):
         try:
             region = Regions.objects.get(pk=pk)
-            zip_content = region.zip_crops()
+        except Regions.DoesNotExist:
+            raise Http404("Crops not found")
+
+        zip_path = region.get_crops_zip_path()
+        filename = f"crops_{region.pk}.zip"
+        if zip_path and zip_path.exists():
+            stat = zip_path.stat()
+            etag = f'"{zip_path.stem}-{stat.st_size:x}"'
+            response = get_conditional_response(request, etag=etag)
+            if response is None:
+                response = self.file_response(
+                    request, zip_path, stat.st_size, etag, filename
+                )
+                response["Accept-Ranges"] = "bytes"
+            response["ETag"] = etag
+            return response
+
+        zip_content = region.stream_crops_zip(zip_path) if zip_path else None
+        if zip_content is None:
+            raise Http404("Crops not found")
+        return FileResponse(
+            zip_content,
+            content_type="application/zip",
+            filename=filename,
+            as_attachment=True,
+        )
+
+    @staticmethod
+    def file_response(
+        request, path: Path, size: int, etag: str, filename: str
+    ) -> HttpResponse:
+        if_range = request.headers.get("If-Range")
+        try:
+            # a resumed download only gets a part of the same archive
+            byte_range = (
+                parse_byte_range(request.headers.get("Range"), size)
+                if not if_range or if_range == etag
+                else None
+            )
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+        if byte_range is None:
             return FileResponse(
-                zip_content,
+                open(path, "rb"),
                 content_type="application/zip",
-                filename=f"crops_{region.pk}.zip",
+                filename=filename,
                 as_attachment=True,
             )
-
-        except Regions.DoesNotExist:
-            pass
-
-        raise Http404("Crops not found")
+        first, last = byte_range
+        response = StreamingHttpResponse(
+            read_byte_range(path, first, last),
+            status=206,
+            content_type="application/zip",
+        )
+        response["Content-Disposition"] = content_disposition_header(True, filename)
+        response["Content-Length"] = str(last - first + 1)
+        response["Content-Range"] = f"bytes {first}-{last}/{size}"
+        return response
 
 
 class RegionsDownloadJson(View):
@@ -51,13 +166,13 @@ class RegionsDownloadJson(View):
 
             # Return the file as a downloadable response
             return FileResponse(
-                open(region.task_full_path / f"{region.dataset.id}.json", "rb"),
+                open(region.annotations_path, "rb"),
                 as_attachment=True,
                 content_type="application/json",
                 filename=f"crops_{region.pk}.json",
             )
 
-        except Regions.DoesNotExist:
+        except (Regions.DoesNotExist, FileNotFoundError):
             pass
 
         raise Http404("Crops not found")
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+"""
+Shared HTTP client for all front → API calls
+
+One requests.Session per process (keep-alive + connection pool), with
+connect/read timeouts, bounded retries with backoff and a circuit breaker
+per host (failures of an external host, e.g. IIIF, do not block the API).
+"""
+
+
+class APIUnavailable(RequestException):
+    """
+    Raised without any network call when the circuit breaker is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive connection failures, then lets a single
+    probe request through every `reset_timeout` seconds until one succeeds
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise APIUnavailable("API circuit breaker is open, not sending request")
+            # half-open: let this request probe the API, keep the others out
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class APIClient:
+    """
+    Thin wrapper around a pooled requests.Session
+    """
+
+    def __init__(
+        self,
+        timeout: Tuple[float, float] = (3.05, 30),
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 10,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # {host: CircuitBreaker}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._breakers_lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            # POST is not idempotent: only retried on connection errors,
+            # i.e. when the request never reached the API
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "DELETE"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def max_request_time(self) -> float:
+        """
+        Upper bound of the seconds a request can take, retries and their backoff
+        (factor * 2 ** (retry - 1)) included
+        """
+        attempts = self.retries + 1
+        backoff = self.backoff_factor * (2**self.retries - 1)
+        return attempts * sum(self.timeout) + backoff
+
+    def get_breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    threshold=self.breaker_threshold,
+                    reset_timeout=self.breaker_reset,
+                )
+            return self.breakers[host]
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        breaker = self.get_breaker(url)
+        breaker.before_request()
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except (ConnectionError, Timeout):
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+_client: Optional[APIClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def get_api_client() -> APIClient:
+    """
+    Returns the client of the current process (sockets are not shared across forks)
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = APIClient(
+                    timeout=(
+                        getattr(settings, "API_CONNECT_TIMEOUT", 3.05),
+                        getattr(settings, "API_READ_TIMEOUT", 30),
+                    ),
+                    retries=getattr(settings, "API_MAX_RETRIES", 3),
+                    backoff_factor=getattr(settings, "API_RETRY_BACKOFF", 0.5),
+                    pool_size=getattr(settings, "API_POOL_SIZE", 10),
+                    breaker_threshold=getattr(settings, "API_BREAKER_THRESHOLD", 5),
+                    breaker_reset=getattr(settings, "API_BREAKER_RESET", 30),
+                )
+                _client_pid = pid
+    return _client
+
+
+def api_get(url: str, **kwargs) -> requests.Response:
+    return get_api_client().get(url, **kwargs)
+
+
+def api_post(url: str, **kwargs) -> requests.Response:
+    return get_api_client().post(url, **kwargs)
+
+
+def api_max_request_time() -> float:
+    return get_api_client().max_request_time
@@ -1,7 +1,27 @@
+import csv
 import json
+import re
 from stat import S_IFREG
-from stream_zip import ZIP_32, stream_zip
-from typing import List, Tuple, Iterable, Generator, Union
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from stream_zip import (
+    NO_COMPRESSION_32,
+    NO_COMPRESSION_64,
+    ZIP_64,
+    ZIP_AUTO,
+    stream_zip,
+)
+from typing import (
+    List,
+    Optional,
+    Tuple,
+    Iterable,
+    Iterator,
+    Generator,
+    Sequence,
+    Union,
+)
 
 from pathlib import Path
 import os
@@ -10,32 +30,200 @@ from datetime import datetime
 TPath = Union[str, Path]
 
 
-def zip_on_the_fly(files: List[Tuple[str, TPath]]) -> Iterable[bytes]:
+# already compressed formats, stored as is in zip archives
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".zip", ".gz"}
+# files above this size are streamed by chunks instead of being prefetched
+PREFETCH_MAX_SIZE = 8 * 1024 * 1024
+# ZIP_32 offsets and sizes must stay below 4 GiB (kept with a margin for headers)
+ZIP_32_MAX_OFFSET = 0xFFFFFFFF - 64 * 1024 * 1024
+ZIP_32_MAX_ENTRIES = 0xFFFF
+
+
+def _prefetch_file(path: TPath, mtime: Optional[float]) -> Optional[Tuple]:
+    """
+    Returns (mtime, size, crc32, content), content being None for large files,
+    or None if the file does not exist
+    """
+    try:
+        with open(path, "rb") as f:
+            if mtime is None:
+                mtime = os.fstat(f.fileno()).st_mtime
+            content = f.read(PREFETCH_MAX_SIZE + 1)
+            if len(content) > PREFETCH_MAX_SIZE:
+                return mtime, os.fstat(f.fileno()).st_size, None, None
+    except FileNotFoundError:
+        return None
+    return mtime, len(content), zlib.crc32(content), content
+
+
+def zip_on_the_fly(
+    files: List[Union[Tuple[str, TPath], Tuple[str, TPath, float]]],
+    workers: int = 4,
+    prefetch: int = 32,
+) -> Iterable[bytes]:
     """
     Zip files on the fly
 
+    Upcoming files are read on a thread pool while the current one is sent.
+    Already compressed formats are stored without deflate, and the archive
+    switches to ZIP64 once it would exceed the ZIP_32 limits.
+
     Args:
-        files: List of tuples (filename, path)
+        files: List of tuples (filename, path) or (filename, path, mtime);
+            files with a known mtime are not stat-ed beforehand
+        workers: number of reading threads
+        prefetch: max number of files read ahead
     """
+    zip64 = len(files) > ZIP_32_MAX_ENTRIES
 
     def contents(path: TPath) -> Generator[bytes, None, None]:
         with open(path, "rb") as f:
             while chunk := f.read(65536):
                 yield chunk
 
-    def iter_files() -> Generator[
-        Tuple[str, int, int, int, Generator[bytes, None, None]], None, None
-    ]:
-        for name, path in files:
-            if not os.path.exists(path):
-                print(f"File {path} does not exist")
-                continue
-            dt = datetime.fromtimestamp(os.path.getmtime(path))
-            yield (name, dt, S_IFREG | 0o600, ZIP_32, contents(path))
+    def iter_files() -> Generator[Tuple, None, None]:
+        nonlocal zip64
+        offset = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            entries = iter(files)
+            try:
+                while True:
+                    while len(pending) < prefetch:
+                        entry = next(entries, None)
+                        if entry is None:
+                            break
+                        name, path, *mtime = entry
+                        mtime = mtime[0] if mtime else None
+                        pending.append(
+                            (name, path, executor.submit(_prefetch_file, path, mtime))
+                        )
+                    if not pending:
+                        break
+
+                    name, path, future = pending.popleft()
+                    prefetched = future.result()
+                    if prefetched is None:
+                        print(f"File {path} does not exist")
+                        continue
+                    mtime, size, crc, content = prefetched
+
+                    # local header, data descriptor and central directory entry
+                    offset += size + 2 * len(name.encode()) + 256
+                    zip64 = zip64 or offset > ZIP_32_MAX_OFFSET
+                    stored = Path(name).suffix.lower() in STORED_EXTENSIONS
+                    if content is None:
+                        method = ZIP_64 if zip64 else ZIP_AUTO(size)
+                        data = contents(path)
+                    elif stored:
+                        method = (NO_COMPRESSION_64 if zip64 else NO_COMPRESSION_32)(
+                            size, crc
+                        )
+                        data = (content,)
+                    else:
+                        method = ZIP_64 if zip64 else ZIP_AUTO(size)
+                        data = (content,)
+                    dt = datetime.fromtimestamp(mtime)
+                    yield name, dt, S_IFREG | 0o600, method, data
+            finally:
+                for *_, future in pending:
+                    future.cancel()
 
     return stream_zip(iter_files())
 
 
+def glob_to_regex(pattern: str) -> re.Pattern:
+    """
+    Compiles a glob pattern matching relative paths the way Path.glob does:
+    "*" and "?" don't cross "/", "**/" matches any number of folders
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+
+# export format: (content type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "tsv": ("text/tab-separated-values", "tsv"),
+}
+
+
+class _LineBuffer:
+    """
+    File-like object for csv.writer, returning what is written instead of storing it
+    """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def _tsv_escape(value) -> str:
+    return (
+        ("" if value is None else str(value))
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def stream_table(
+    header: List[str],
+    rows: Iterable[Sequence],
+    fmt: str = "csv",
+    chunk_size: int = 65536,
+) -> Iterator[str]:
+    """
+    Serializes rows as CSV, JSON Lines or TSV, yielding chunks of about chunk_size
+    characters (for a StreamingHttpResponse)
+    """
+    if fmt == "csv":
+        writer = csv.writer(_LineBuffer())
+        format_row = writer.writerow
+    elif fmt == "jsonl":
+
+        def format_row(row: Sequence) -> str:
+            return json.dumps(dict(zip(header, row)), ensure_ascii=False) + "\n"
+
+    elif fmt == "tsv":
+
+        def format_row(row: Sequence) -> str:
+            return "\t".join(_tsv_escape(v) for v in row) + "\n"
+
+    else:
+        raise ValueError(f"Unknown export format {fmt}")
+
+    buffer = [] if fmt == "jsonl" else [format_row(header)]
+    size = 0
+    for row in rows:
+        line = format_row(row)
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
 def pprint(o):
     if isinstance(o, str):
         try:
@@ -0,0 +1,99 @@
+import tempfile
+import time
+
+import numpy as np
+import orjson
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from similarity.models import Similarity
+from similarity.pairs import write_pairs
+
+
+def legacy_matrix_for_display(images, pairs):
+    """
+    Former pure-Python implementation of get_similarity_matrix_for_display
+    """
+    similarities = {}
+    for q_idx, s_idx, score, *tr in pairs:
+        for img1, img2 in [
+            (images[q_idx], images[s_idx]),
+            (images[s_idx], images[q_idx]),
+        ]:
+            if img1["id"] not in similarities:
+                similarities[img1["id"]] = {"query": img1.copy(), "sim": []}
+            sim_img = img2.copy()
+            sim_img["score"] = float(score)
+            similarities[img1["id"]]["sim"].append(sim_img)
+
+    for img in similarities.values():
+        img["sim"].sort(key=lambda x: x["score"], reverse=True)
+    return list(similarities.values())
+
+
+class Command(BaseCommand):
+    help = "Compares get_similarity_matrix_for_display with the former Python loop on a synthetic result"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pairs", type=int, default=1_000_000)
+        parser.add_argument("--images", type=int, default=20_000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def timed(self, label, fn):
+        start = time.perf_counter()
+        result = fn()
+        self.stdout.write(f"{label}: {time.perf_counter() - start:.2f}s")
+        return result
+
+    def handle(self, *args, **options):
+        n_pairs, n_images = options["pairs"], options["images"]
+        rng = np.random.default_rng(options["seed"])
+
+        images = [
+            {"id": f"img_{i}", "src": f"doc/img_{i}.jpg", "num": i}
+            for i in range(n_images)
+        ]
+        # 6 decimals, so that scores are not altered by the float32 storage
+        pairs = np.stack(
+            [
+                rng.integers(0, n_images, n_pairs),
+                rng.integers(0, n_images, n_pairs),
+                rng.random(n_pairs).round(6),
+                np.zeros(n_pairs),
+            ],
+            axis=1,
+        ).tolist()
+        pairs = [[int(q), int(s), score, int(tr)] for q, s, score, tr in pairs]
+        self.stdout.write(f"{n_pairs} pairs between {n_images} images")
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+            MEDIA_ROOT=media_root
+        ):
+            similarity = Similarity()
+            result_path = similarity.result_full_path
+            result_path.mkdir(parents=True)
+            (result_path / "index.json").write_bytes(orjson.dumps({"images": images}))
+            (result_path / "pairs.json").write_bytes(orjson.dumps(pairs))
+            write_pairs(result_path / "pairs.bin", pairs)
+
+            def run_legacy():
+                with open(result_path / "pairs.json", "rb") as f:
+                    return legacy_matrix_for_display(images, orjson.loads(f.read()))
+
+            expected = self.timed("legacy", run_legacy)
+            matrix = self.timed(
+                "vectorized (cold)", similarity.get_similarity_matrix_for_display
+            )
+            self.timed(
+                "vectorized (warm)", similarity.get_similarity_matrix_for_display
+            )
+            subset = [img["id"] for img in images[:50]]
+            self.timed(
+                "vectorized (50 images)",
+                lambda: similarity.get_similarity_matrix_for_display(image_ids=subset),
+            )
+
+        if matrix == expected:
+            self.stdout.write(self.style.SUCCESS("Outputs are identical"))
+        else:
+            self.stdout.write(self.style.ERROR("Outputs differ"))
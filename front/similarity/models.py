@@ -1,17 +1,45 @@
-import requests
 import orjson
+import os
+import threading
 import traceback
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
+
+from django.conf import settings
 from django.urls import reverse
+from django.utils.functional import cached_property
 
+from datasets.utils import file_lock
 from regions.models import AbstractAPITaskOnCrops
+from shared.api import api_get
+from .pairs import (
+    NeighborIndex,
+    SimilarityPairs,
+    read_neighbors,
+    read_pairs,
+    write_neighbors,
+    write_pairs,
+)
+
+# per-process LRU of browsing metadata:
+# {(task id, pairs.bin mtime): (doc_uid of each image, (min score, max score))}
+_browse_metadata_cache = OrderedDict()
+_browse_metadata_lock = threading.Lock()
+
+
+def _score_list(scores: np.ndarray) -> List[float]:
+    # scores are stored as float32
+    return np.round(scores.astype(np.float64), 6).tolist()
 
 
 class Similarity(AbstractAPITaskOnCrops("similarity")):
     @classmethod
     def get_available_models(cls):
         try:
-            response = requests.get(f"{cls.api_endpoint_prefix}/models")
+            response = api_get(f"{cls.api_endpoint_prefix}/models")
             response.raise_for_status()
             models = response.json()
             if not models:
@@ -60,21 +88,34 @@ class Similarity(AbstractAPITaskOnCrops("similarity")):
                 self.dataset.api_url = dataset_url
                 self.dataset.save()
 
-            try:
-                if self.crops:
-                    self.dataset.apply_cropping(self.crops.get_bounding_boxes())
+        else:
+            self.on_task_error({"error": "No output data"})
+            return
 
-                self.prepare_sim_browser()
+        self.save()
 
-            except Exception as e:
-                self.on_task_error({"error": traceback.format_exc()})
-                return
+        # cropping and indexing can take a while: done by the dramatiq worker
+        from .tasks import collect_results
 
-        else:
-            self.on_task_error({"error": "No output data"})
+        collect_results.send(str(self.pk))
+
+    def collect_results(self):
+        """
+        Prepares the similarity browser (called by similarity.tasks.collect_results)
+        """
+        try:
+            if self.crops:
+                result = self.dataset.apply_cropping(self.crops.get_bounding_boxes())
+                if result.get("errors"):
+                    self.write_log("\n".join(result["errors"]) + "\n")
+
+            self.prepare_sim_browser()
+
+        except Exception as e:
+            self.on_task_error({"error": traceback.format_exc()})
             return
 
-        return super().on_task_success(data)
+        self.terminate_task()
 
     @property
     def index_url(self):
@@ -85,35 +126,330 @@ class Similarity(AbstractAPITaskOnCrops("similarity")):
         return f"{self.result_media_url}/pairs.json"
 
     @property
+    def similarity_pairs_url(self):
+        return f"{self.result_media_url}/pairs.bin"
+
+    @property
+    def similarity_pairs(self) -> SimilarityPairs:
+        """
+        Memory-mapped pairs, from pairs.bin (written from pairs.json if missing)
+        """
+        if not hasattr(self, "_similarity_pairs"):
+            path = self.result_full_path / "pairs.bin"
+            if not path.exists():
+                # older results: converted by the first request only
+                with file_lock(self.result_full_path / ".pairs.lock"):
+                    if not path.exists():
+                        write_pairs(
+                            path,
+                            self.similarity_matrix,
+                            self.similarity_index.get("transpositions"),
+                        )
+            self._similarity_pairs = read_pairs(path)
+        return self._similarity_pairs
+
+    @property
+    def neighbors_path(self) -> Path:
+        return self.result_full_path / "neighbors.bin"
+
+    def write_neighbor_index(self):
+        """
+        Writes the SIMILARITY_TOP_K best matches of each image
+        """
+        write_neighbors(
+            self.neighbors_path,
+            self.neighbor_index,
+            getattr(settings, "SIMILARITY_TOP_K", 100),
+        )
+
+    @cached_property
+    def top_neighbors(self) -> tuple[NeighborIndex, int]:
+        """
+        Memory-mapped top-k neighbor index and its k (written if missing)
+        """
+        if not self.neighbors_path.exists():
+            with file_lock(self.result_full_path / ".neighbors.lock"):
+                if not self.neighbors_path.exists():
+                    self.write_neighbor_index()
+        return read_neighbors(self.neighbors_path)
+
+    def get_neighbors(self, image_idx: int, k: int = None) -> Optional[dict]:
+        """
+        Best matches of an image, as indices in index.json
+
+        Returns:
+            {"image": int, "k": int, "neighbors": List[int], "scores": List[float]}
+            or None if there is no such image
+        """
+        index, max_k = self.top_neighbors
+        if not 0 <= image_idx < len(index.offsets) - 1:
+            return None
+        k = max_k if k is None else min(k, max_k)
+        targets, scores = index.neighbors(image_idx)
+        return {
+            "image": image_idx,
+            "k": k,
+            "neighbors": targets[:k].tolist(),
+            "scores": _score_list(scores[:k]),
+        }
+
+    def _browse_metadata(self) -> Tuple[np.ndarray, Tuple[float, float]]:
+        """
+        Parsed from index.json and the pair scores once per process and result,
+        instead of on each page request
+        """
+        pairs = self.similarity_pairs
+        key = (str(self.pk), (self.result_full_path / "pairs.bin").stat().st_mtime)
+        with _browse_metadata_lock:
+            if key in _browse_metadata_cache:
+                _browse_metadata_cache.move_to_end(key)
+                return _browse_metadata_cache[key]
+
+        sources = np.array(
+            [im.get("doc_uid") for im in self.similarity_index.get("images", [])],
+            dtype=object,
+        )
+        score_range = (
+            tuple(_score_list(np.array([pairs.score.min(), pairs.score.max()])))
+            if len(pairs)
+            else (0.0, 0.0)
+        )
+        metadata = (sources, score_range)
+
+        with _browse_metadata_lock:
+            _browse_metadata_cache[key] = metadata
+            while len(_browse_metadata_cache) > getattr(
+                settings, "BROWSE_METADATA_CACHE_SIZE", 32
+            ):
+                _browse_metadata_cache.popitem(last=False)
+        return metadata
+
+    @cached_property
+    def image_sources(self) -> np.ndarray:
+        """
+        doc_uid of each image of the similarity index (shared: do not modify)
+        """
+        return self._browse_metadata()[0]
+
+    @cached_property
+    def score_range(self) -> Tuple[float, float]:
+        """
+        (min, max) score of the pairs
+        """
+        return self._browse_metadata()[1]
+
+    def browse_matches(
+        self,
+        page: int = 1,
+        page_size: int = 30,
+        source: str = None,
+        threshold: float = None,
+        group_by_source: bool = False,
+        image_idx: int = None,
+        k: int = None,
+    ) -> dict:
+        """
+        One page of query images with their best matches (top-k index),
+        queries sorted by decreasing best score
+
+        Only the SIMILARITY_TOP_K best matches of each image are indexed: matches,
+        counts and thresholds apply to those
+
+        source: only queries from this document
+        threshold: drops the matches below it, and the queries left without any
+        group_by_source: also returns the matches grouped by document
+        image_idx: returns the page where this image is (instead of page)
+        k: only the k best matches of each query (the others can be fetched
+           with get_neighbors), "count" still gives the number of matches
+
+        Returns:
+            {"page", "num_pages", "count", "min_score", "max_score",
+             "results": [{"image", "count", "neighbors", "scores"[, "groups"]}]}
+        """
+        index, _ = self.top_neighbors
+        counts = np.diff(index.offsets)
+        candidates = counts > 0
+        best = np.full(len(counts), -np.inf, dtype=np.float32)
+        best[candidates] = index.scores[index.offsets[:-1][candidates]]
+
+        if source:
+            sources = self.image_sources
+            in_source = np.zeros(len(counts), dtype=bool)
+            in_source[: len(sources)] = sources[: len(counts)] == source
+            candidates &= in_source
+        if threshold is not None:
+            candidates &= best >= threshold
+
+        queries = np.flatnonzero(candidates)
+        queries = queries[np.argsort(-best[queries], kind="stable")]
+
+        count = len(queries)
+        num_pages = max(1, -(-count // page_size))
+        if image_idx is not None:
+            position = np.flatnonzero(queries == image_idx)
+            if len(position):
+                page = int(position[0]) // page_size + 1
+        page = min(max(1, page), num_pages)
+
+        results = []
+        for q_idx in queries[(page - 1) * page_size : page * page_size].tolist():
+            targets, scores = index.neighbors(q_idx)
+            if threshold is not None:
+                kept = scores >= threshold
+                targets, scores = targets[kept], scores[kept]
+            n_matches = len(targets)
+            if k is not None:
+                targets, scores = targets[:k], scores[:k]
+            result = {
+                "image": q_idx,
+                "count": n_matches,
+                "neighbors": targets.tolist(),
+                "scores": _score_list(scores),
+            }
+            if group_by_source:
+                groups = {}
+                for s_idx, score in zip(result["neighbors"], result["scores"]):
+                    group = groups.setdefault(
+                        self.image_sources[s_idx],
+                        {
+                            "source": self.image_sources[s_idx],
+                            "neighbors": [],
+                            "scores": [],
+                        },
+                    )
+                    group["neighbors"].append(s_idx)
+                    group["scores"].append(score)
+                result["groups"] = list(groups.values())
+            results.append(result)
+
+        min_score, max_score = self.score_range
+        return {
+            "page": page,
+            "num_pages": num_pages,
+            "count": count,
+            "min_score": min_score,
+            "max_score": max_score,
+            "results": results,
+        }
+
+    @cached_property
     def similarity_index(self):
         with open(self.result_full_path / "index.json", "r") as f:
             return orjson.loads(f.read())
 
-    @property
+    @cached_property
     def similarity_matrix(self):
         with open(self.result_full_path / "pairs.json", "r") as f:
             return orjson.loads(f.read())
 
-    def get_similarity_matrix_for_display(self, as_list=True):
+    @cached_property
+    def neighbor_index(self) -> NeighborIndex:
+        return NeighborIndex.from_pairs(
+            self.similarity_pairs, len(self.similarity_index.get("images", []))
+        )
+
+    def iter_similarity_matrix(
+        self, image_ids: Optional[Iterable[str]] = None
+    ) -> Iterator[Tuple[str, dict]]:
+        """
+        Yields (image_id, {"query": image, "sim": [{**image, "score": float}, ...]})
+        for each image having matches, best matches first
+
+        Each image_id is yielded once: the matches of images sharing an id are
+        merged (the ids are used as JSON keys)
+        """
         images = self.similarity_index.get("images", [])
-        similarities = {}
-
-        for q_idx, s_idx, score, *tr in self.similarity_matrix:
-            for img1, img2 in [
-                (images[q_idx], images[s_idx]),
-                (images[s_idx], images[q_idx]),
-            ]:
-                if img1["id"] not in similarities:
-                    similarities[img1["id"]] = {"query": img1.copy(), "sim": []}
-                sim_img = img2.copy()
-                sim_img["score"] = float(score)
-                similarities[img1["id"]]["sim"].append(sim_img)
-
-        for img in similarities.values():
-            img["sim"].sort(key=lambda x: x["score"], reverse=True)
+        index = self.neighbor_index
+
+        queries = index.order.tolist()
+        if image_ids is not None:
+            image_ids = set(image_ids)
+            queries = [i for i in queries if images[i]["id"] in image_ids]
 
+        # {image_id: [image index, ...]}, in the order of the best matches
+        queries_by_id = {}
+        for q_idx in queries:
+            queries_by_id.setdefault(images[q_idx]["id"], []).append(q_idx)
+
+        for image_id, q_idxs in queries_by_id.items():
+            sim = []
+            for q_idx in q_idxs:
+                targets, scores = index.neighbors(q_idx)
+                for s_idx, score in zip(targets.tolist(), _score_list(scores)):
+                    sim_img = images[s_idx].copy()
+                    sim_img["score"] = score
+                    sim.append(sim_img)
+            yield image_id, {"query": images[q_idxs[0]].copy(), "sim": sim}
+
+    def get_similarity_matrix_for_display(
+        self, as_list=True, image_ids: Optional[Iterable[str]] = None
+    ):
+        """
+        Returns the matches of each image, best first:
+        [{"query": image, "sim": [{**image, "score": float}, ...]}, ...]
+        ({image_id: ...} if not as_list), restricted to image_ids if given
+        """
+        similarities = dict(self.iter_similarity_matrix(image_ids))
         return list(similarities.values()) if as_list else similarities
 
+    def stream_similarity_matrix(self, chunk_size: int = 65536) -> Iterator[bytes]:
+        """
+        Serializes the matrix for display as a JSON object {image_id: matches},
+        one image per line, in chunks of about chunk_size bytes
+        """
+        buffer = bytearray(b"{")
+        separator = b"\n"
+        for image_id, entry in self.iter_similarity_matrix():
+            buffer += separator + orjson.dumps(image_id) + b": " + orjson.dumps(entry)
+            separator = b",\n"
+            if len(buffer) >= chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        buffer += b"\n}\n"
+        yield bytes(buffer)
+
+    @property
+    def matrix_download_path(self) -> Path:
+        return self.result_full_path / "similarity_matrix.json"
+
+    def write_matrix_download(self):
+        """
+        Writes the downloadable matrix (to a temporary file renamed into place)
+        """
+        path = self.matrix_download_path
+        tmp_path = path.with_name(f".{path.name}.part")
+        with open(tmp_path, "wb") as f:
+            for chunk in self.stream_similarity_matrix():
+                f.write(chunk)
+        os.replace(tmp_path, path)
+
+    def get_matrix_download(self) -> Path:
+        """
+        Path of the downloadable matrix, written on first use for older results
+        """
+        path = self.matrix_download_path
+        if not path.exists():
+            if self.status != "SUCCESS":
+                raise FileNotFoundError(f"No similarity results for {self.pk}")
+            with file_lock(self.result_full_path / ".matrix.lock"):
+                if not path.exists():
+                    self.write_matrix_download()
+        return path
+
+    def get_neighbors_url(self, image_idx: int) -> str:
+        return reverse(
+            "similarity:neighbors", kwargs={"pk": self.pk, "image_idx": image_idx}
+        )
+
+    @property
+    def neighbors_url(self):
+        """URL of the neighbors endpoint, to be followed by /<image_idx>"""
+        return self.get_neighbors_url(0).rsplit("/", 1)[0]
+
+    @property
+    def browse_url(self):
+        return reverse("similarity:browse", kwargs={"pk": self.pk})
+
     def get_download_json_url(self):
         """Get the URL for downloading crops in a json format"""
         return reverse("similarity:download_json", kwargs={"pk": self.pk})
@@ -139,3 +475,24 @@ class Similarity(AbstractAPITaskOnCrops("similarity")):
 
         with open(self.result_full_path / "pairs.json", "wb") as f:
             f.write(orjson.dumps(sim_pairs))
+
+        # compact version of pairs.json, for the similarity browser
+        write_pairs(
+            self.result_full_path / "pairs.bin",
+            sim_pairs,
+            sim_index.get("transpositions"),
+        )
+
+        # forget results loaded before this run
+        for attr in (
+            "_similarity_pairs",
+            "similarity_index",
+            "similarity_matrix",
+            "neighbor_index",
+            "top_neighbors",
+            "image_sources",
+            "score_range",
+        ):
+            self.__dict__.pop(attr, None)
+        self.write_neighbor_index()
+        self.write_matrix_download()
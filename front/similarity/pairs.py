@@ -0,0 +1,320 @@
+import json
+import os
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+"""
+Binary storage of similarity pairs
+
+Layout (little-endian):
+    magic "SIMPAIRS" | uint32 version | uint32 header length | JSON header
+    (padded to 8 bytes) | int32 q[n] | int32 s[n] | float32 score[n] | uint8 tr[n, n_tr]
+
+The JSON header holds n, n_tr (transposition codes per pair), tr_none (the code
+of "no transposition", padding pairs with fewer codes) and the table of
+transposition names the codes refer to. Columns can be memory-mapped on the
+server and viewed as typed arrays in the browser without parsing.
+
+Top-k neighbor indexes use the same layout (magic "SIMNEIGH") with the columns
+of a NeighborIndex: int64 offsets[n_images + 1] | int32 targets[n] |
+float32 scores[n] | int32 order[n_order]
+"""
+
+PAIRS_MAGIC = b"SIMPAIRS"
+NEIGHBORS_MAGIC = b"SIMNEIGH"
+PAIRS_VERSION = 1
+_PREFIX_SIZE = len(PAIRS_MAGIC) + 8
+# transposition code of "no transposition" (0 is the first transposition)
+TR_NONE = 255
+
+
+@dataclass
+class SimilarityPairs:
+    q: np.ndarray  # int32, index of the first image in the similarity index
+    s: np.ndarray  # int32, index of the second image
+    score: np.ndarray  # float32
+    tr: np.ndarray  # uint8 (n, n_tr), transposition codes
+    transpositions: List[str]  # names of the transposition codes
+    # code of "no transposition" (None for older files, padded with 0)
+    tr_none: Optional[int] = TR_NONE
+
+    def __len__(self) -> int:
+        return len(self.score)
+
+    def get_transpositions(self, i: int) -> List[Optional[str | int]]:
+        """
+        Transpositions of pair i: names (indices if there is no name for them),
+        None for no transposition
+        """
+        names = []
+        for code in self.tr[i].tolist():
+            if code == self.tr_none:
+                names.append(None)
+            elif code < len(self.transpositions):
+                names.append(self.transpositions[code])
+            else:
+                names.append(code)
+        return names
+
+
+def _transposition_codes(
+    pairs: List[list], transpositions: Optional[List[str]]
+) -> tuple[np.ndarray, List[str]]:
+    """
+    Encodes the trailing values of each pair, given either as indices in
+    transpositions or as transposition names (None or a negative index for no
+    transposition; missing trailing values are encoded as TR_NONE)
+
+    Raises:
+        ValueError if an index or the number of names doesn't fit in a code
+    """
+    table = list(transpositions or [])
+    n_tr = max(map(len, pairs), default=3) - 3
+    tr = np.full((len(pairs), n_tr), TR_NONE, dtype=np.uint8)
+    try:
+        # fast path: valid indices only, same number per pair
+        for j in range(n_tr):
+            codes = np.fromiter(
+                (p[3 + j] for p in pairs), dtype=np.int64, count=len(pairs)
+            )
+            if len(codes) and (codes.min() < 0 or codes.max() >= TR_NONE):
+                raise ValueError("Transposition index out of range")
+            tr[:, j] = codes
+        return tr, table
+    except (IndexError, TypeError, ValueError, OverflowError):
+        tr.fill(TR_NONE)
+
+    codes = {name: i for i, name in enumerate(table)}
+
+    def encode(value) -> int:
+        if isinstance(value, str):
+            if value not in codes:
+                if len(table) >= TR_NONE:
+                    raise ValueError(f"More than {TR_NONE} transpositions")
+                codes[value] = len(table)
+                table.append(value)
+            return codes[value]
+        if value is None or value < 0:
+            return TR_NONE
+        if value >= TR_NONE:
+            raise ValueError(f"Transposition index {value} out of range")
+        return value
+
+    for i, pair in enumerate(pairs):
+        for j, value in enumerate(pair[3:]):
+            tr[i, j] = encode(value)
+    return tr, table
+
+
+def _write_binary(
+    path: Path, magic: bytes, header: dict, columns: List[np.ndarray]
+) -> Path:
+    """
+    Writes magic | version | header | columns to a temporary file renamed into place
+    """
+    header = json.dumps(header).encode()
+    header += b" " * (-(_PREFIX_SIZE + len(header)) % 8)
+
+    # unique name: concurrent writers of the same file do not mix their bytes
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.part")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(magic)
+            f.write(np.array([PAIRS_VERSION, len(header)], dtype="<u4").tobytes())
+            f.write(header)
+            for column in columns:
+                f.write(column.tobytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return path
+
+
+class _BinaryReader:
+    """
+    Reads the header, then the consecutive columns of a binary file
+    """
+
+    def __init__(self, path: str | Path, magic: bytes, mmap: bool = True):
+        self.path, self.mmap = path, mmap
+        with open(path, "rb") as f:
+            prefix = f.read(_PREFIX_SIZE)
+            if len(prefix) < _PREFIX_SIZE or prefix[: len(magic)] != magic:
+                raise ValueError(f"{path} is not a {magic.decode().lower()} file")
+            version, header_size = np.frombuffer(prefix[len(magic) :], dtype="<u4")
+            if version != PAIRS_VERSION:
+                raise ValueError(
+                    f"Unsupported {magic.decode().lower()} version {version}"
+                )
+            self.header = json.loads(f.read(header_size))
+        self.offset = _PREFIX_SIZE + int(header_size)
+
+    def column(self, dtype: str, shape: tuple) -> np.ndarray:
+        count = int(np.prod(shape))
+        size = count * np.dtype(dtype).itemsize
+        if size == 0:
+            array = np.zeros(shape, dtype=dtype)
+        elif self.mmap:
+            array = np.memmap(
+                self.path, dtype=dtype, mode="r", offset=self.offset, shape=shape
+            )
+        else:
+            array = np.fromfile(
+                self.path, dtype=dtype, count=count, offset=self.offset
+            ).reshape(shape)
+        self.offset += size
+        return array
+
+
+def write_pairs(
+    path: str | Path, pairs: List[list], transpositions: List[str] = None
+) -> Path:
+    """
+    Writes [q_idx, s_idx, score, *transpositions] pairs in the binary format
+    (to a temporary file renamed into place)
+    """
+    n = len(pairs)
+
+    def column(i: int, dtype: str) -> np.ndarray:
+        return np.fromiter((p[i] for p in pairs), dtype=dtype, count=n)
+
+    q, s, score = column(0, "<i4"), column(1, "<i4"), column(2, "<f4")
+    tr, table = _transposition_codes(pairs, transpositions)
+
+    return _write_binary(
+        Path(path),
+        PAIRS_MAGIC,
+        {"n": n, "n_tr": tr.shape[1], "tr_none": TR_NONE, "transpositions": table},
+        [q, s, score, tr],
+    )
+
+
+def read_pairs(path: str | Path, mmap: bool = True) -> SimilarityPairs:
+    """
+    Reads a binary pairs file, memory-mapping its columns by default
+
+    Raises:
+        ValueError if the file is not in the expected format
+    """
+    reader = _BinaryReader(path, PAIRS_MAGIC, mmap)
+    n, n_tr = reader.header["n"], reader.header["n_tr"]
+    return SimilarityPairs(
+        q=reader.column("<i4", (n,)),
+        s=reader.column("<i4", (n,)),
+        score=reader.column("<f4", (n,)),
+        tr=reader.column("u1", (n, n_tr)),
+        transpositions=reader.header["transpositions"],
+        tr_none=reader.header.get("tr_none"),
+    )
+
+
+@dataclass
+class NeighborIndex:
+    """
+    Symmetric neighbor lists, sorted by decreasing score (CSR layout):
+    the neighbors of image i are targets[offsets[i] : offsets[i + 1]]
+    """
+
+    offsets: np.ndarray  # int64 (n_images + 1,)
+    targets: np.ndarray  # int32
+    scores: np.ndarray  # float32
+    # images having neighbors, in order of first appearance in the pairs
+    order: np.ndarray
+
+    @classmethod
+    def from_pairs(cls, pairs: SimilarityPairs, n_images: int = 0) -> "NeighborIndex":
+        n = len(pairs)
+        sources = np.concatenate([pairs.q, pairs.s])
+        targets = np.concatenate([pairs.s, pairs.q])
+        scores = np.concatenate([pairs.score, pairs.score])
+        # ties keep the order of the pairs (each pair as query, then as match)
+        rank = np.concatenate([np.arange(n) * 2, np.arange(n) * 2 + 1])
+        sort = np.lexsort((rank, -scores, sources))
+
+        n_images = max(n_images, int(sources.max()) + 1 if n else 0)
+        offsets = np.zeros(n_images + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=n_images), out=offsets[1:])
+
+        interleaved = np.stack([pairs.q, pairs.s], axis=1).ravel()
+        images, first = np.unique(interleaved, return_index=True)
+        return cls(
+            offsets=offsets,
+            targets=targets[sort],
+            scores=scores[sort],
+            order=images[np.argsort(first)],
+        )
+
+    def neighbors(self, image_idx: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (neighbor indices, scores) of an image, best first
+        """
+        if image_idx < 0 or image_idx + 1 >= len(self.offsets):
+            return self.targets[:0], self.scores[:0]
+        start, end = self.offsets[image_idx], self.offsets[image_idx + 1]
+        return self.targets[start:end], self.scores[start:end]
+
+    def top_k(self, k: int) -> "NeighborIndex":
+        """
+        Keeps the k best neighbors of each image
+        """
+        counts = np.diff(self.offsets)
+        kept = np.minimum(counts, k)
+        # rank of each neighbor in the list of its image
+        rank = np.arange(len(self.targets)) - np.repeat(self.offsets[:-1], counts)
+        offsets = np.zeros_like(self.offsets)
+        np.cumsum(kept, out=offsets[1:])
+        return NeighborIndex(
+            offsets=offsets,
+            targets=self.targets[rank < k],
+            scores=self.scores[rank < k],
+            order=self.order,
+        )
+
+
+def write_neighbors(path: str | Path, index: NeighborIndex, k: int) -> Path:
+    """
+    Writes the k best neighbors of each image in the binary format
+    """
+    index = index.top_k(k)
+    return _write_binary(
+        Path(path),
+        NEIGHBORS_MAGIC,
+        {
+            "n_images": len(index.offsets) - 1,
+            "n": len(index.targets),
+            "n_order": len(index.order),
+            "k": k,
+        },
+        [
+            index.offsets.astype("<i8"),
+            index.targets.astype("<i4"),
+            index.scores.astype("<f4"),
+            index.order.astype("<i4"),
+        ],
+    )
+
+
+def read_neighbors(path: str | Path, mmap: bool = True) -> Tuple[NeighborIndex, int]:
+    """
+    Reads a binary neighbors file
+
+    Returns:
+        (neighbor index, k)
+
+    Raises:
+        ValueError if the file is not in the expected format
+    """
+    reader = _BinaryReader(path, NEIGHBORS_MAGIC, mmap)
+    header = reader.header
+    index = NeighborIndex(
+        offsets=reader.column("<i8", (header["n_images"] + 1,)),
+        targets=reader.column("<i4", (header["n"],)),
+        scores=reader.column("<f4", (header["n"],)),
+        order=reader.column("<i4", (header["n_order"],)),
+    )
+    return index, header["k"]
@@ -1,7 +1,4 @@
 import dramatiq
-import requests
-from zipfile import ZipFile
-import traceback
 
 from .models import Similarity
 
@@ -11,5 +8,20 @@ All dramatiq tasks related to Similarity retrieval
 
 
 @dramatiq.actor
-def collect_results(experiment_id: str, result_url: str):
-    pass
+def collect_results(experiment_id: str):
+    """
+    Prepare the similarity results returned by the API once the task succeeded
+    """
+    try:
+        similarity = Similarity.objects.get(id=experiment_id)
+    except Similarity.DoesNotExist as e:
+        print(
+            f"[similarity.collect_results] Unknown Similarity: experiment_id doesn't match any record {e}"
+        )
+        return
+
+    if similarity.is_finished:
+        # message delivered twice: results were already collected
+        return
+
+    similarity.collect_results()
@@ -8,6 +8,11 @@ urlpatterns = [
     path("start", SimilarityStart.as_view(), name="start"),
     path("<uuid:pk>", SimilarityMixin.Status.as_view(), name="status"),
     path("<uuid:pk>/progress", SimilarityMixin.Progress.as_view(), name="progress"),
+    path(
+        "<uuid:pk>/progress/stream",
+        SimilarityMixin.ProgressStream.as_view(),
+        name="progress_stream",
+    ),
     path("<uuid:pk>/cancel", SimilarityMixin.Cancel.as_view(), name="cancel"),
     path("<uuid:pk>/watch", SimilarityMixin.Watcher.as_view(), name="notify"),
     path("<uuid:pk>/restart", SimilarityStartFrom.as_view(), name="restart"),
@@ -35,4 +40,10 @@ urlpatterns = [
         SimilarityDownloadJson.as_view(),
         name="download_json",
     ),
+    path(
+        "<uuid:pk>/neighbors/<int:image_idx>",
+        SimilarityNeighbors.as_view(),
+        name="neighbors",
+    ),
+    path("<uuid:pk>/browse", SimilarityBrowse.as_view(), name="browse"),
 ]
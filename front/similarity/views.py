@@ -1,11 +1,18 @@
-import json
-
 from django.views.generic import View
-from django.http import FileResponse, Http404, HttpResponse
+from django.views.generic.detail import SingleObjectMixin
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 
 from .forms import SimilarityForm, AVAILABLE_SIMILARITY_ALGORITHMS
 from .models import Similarity
-from tasking.views import task_view_set
+from tasking.views import LoginRequiredIfConfProtectedMixin, task_view_set
+
+# default number of matches returned by SimilarityNeighbors
+NEIGHBORS_K = 20
+# number of query images per page of SimilarityBrowse
+BROWSE_PAGE_SIZE = 30
+BROWSE_PAGE_SIZE_MAX = 200
 
 
 @task_view_set
@@ -36,18 +43,96 @@ class SimilarityStartFrom(SimilarityMixin.StartFrom, SimilarityStart):
 
 
 class SimilarityDownloadJson(View):
+    """
+    Downloads the similarity matrix for display, precomputed when results are
+    collected (supports If-None-Match / If-Modified-Since)
+    """
+
     def get(self, request, pk):
         try:
             similarity = Similarity.objects.get(pk=pk)
-            similarity_matrix_dict = similarity.get_similarity_matrix_for_display(
-                as_list=False
-            )
-            return FileResponse(
-                json.dumps(similarity_matrix_dict, indent=4),
+            path = similarity.get_matrix_download()
+        except (Similarity.DoesNotExist, FileNotFoundError):
+            raise Http404("Similarity not found")
+
+        stat = path.stat()
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        response = get_conditional_response(
+            request, etag=etag, last_modified=int(stat.st_mtime)
+        )
+        if response is None:
+            response = FileResponse(
+                open(path, "rb"),
                 as_attachment=True,
                 content_type="application/json",
                 filename=f"similarity_{similarity.pk}.json",
             )
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(stat.st_mtime)
+        return response
 
-        except Similarity.DoesNotExist:
-            raise Http404("Similarity not found")
+
+class SimilarityNeighbors(LoginRequiredIfConfProtectedMixin, SingleObjectMixin, View):
+    """
+    Best matches of one image of the similarity index (AJAX), ?k=20
+
+    k is capped by SIMILARITY_TOP_K (the matches kept per image in neighbors.bin):
+    the "k" of the answer is the number actually returned
+    """
+
+    model = Similarity
+
+    def get(self, *args, **kwargs):
+        self.object = self.get_object()
+        try:
+            k = max(1, int(self.request.GET.get("k", NEIGHBORS_K)))
+        except ValueError:
+            return JsonResponse({"error": "Invalid k"}, status=400)
+
+        try:
+            neighbors = self.object.get_neighbors(self.kwargs["image_idx"], k)
+        except FileNotFoundError:
+            raise Http404("Similarity results not found")
+        if neighbors is None:
+            raise Http404("Image not found")
+        return JsonResponse(neighbors)
+
+
+class SimilarityBrowse(LoginRequiredIfConfProtectedMixin, SingleObjectMixin, View):
+    """
+    One page of query images and their matches (AJAX),
+    ?page=1&page_size=30&filter_by_source=<doc_uid>&threshold=0.5&group_by_source=1&image=<idx>&k=5
+
+    Built on the top-k index: each query holds at most SIMILARITY_TOP_K matches
+    """
+
+    model = Similarity
+
+    def get(self, *args, **kwargs):
+        self.object = self.get_object()
+        params = self.request.GET
+        try:
+            page = int(params.get("page", 1))
+            page_size = min(
+                max(1, int(params.get("page_size", BROWSE_PAGE_SIZE))),
+                BROWSE_PAGE_SIZE_MAX,
+            )
+            threshold = float(params["threshold"]) if params.get("threshold") else None
+            image_idx = int(params["image"]) if params.get("image") else None
+            k = max(1, int(params["k"])) if params.get("k") else None
+        except ValueError:
+            return JsonResponse({"error": "Invalid parameters"}, status=400)
+
+        try:
+            matches = self.object.browse_matches(
+                page=page,
+                page_size=page_size,
+                source=params.get("filter_by_source") or None,
+                threshold=threshold,
+                group_by_source=params.get("group_by_source") in ("1", "true", "on"),
+                image_idx=image_idx,
+                k=k,
+            )
+        except FileNotFoundError:
+            raise Http404("Similarity results not found")
+        return JsonResponse(matches)
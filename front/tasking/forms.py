@@ -73,7 +73,8 @@ class AbstractTaskOnDatasetForm(AbstractTaskForm, AbstractDatasetForm):
 
         super().__init__(*args, **kwargs)
 
-        dataset_queryset = self.fields["dataset"].queryset
+        # only what the choice labels show
+        dataset_queryset = self.fields["dataset"].queryset.only("id", "name")
         if not self._user.is_superuser:
             dataset_queryset = dataset_queryset.filter(created_by=self._user)
 
@@ -159,12 +160,13 @@ class AbstractTaskOnCropsForm(AbstractTaskOnDatasetForm):
 
         super().__init__(*args, **kwargs)
         crops_queryset = self.fields["crops"].queryset.filter(
-            regions__isnull=False,
+            regions_count__gt=0,
             status="SUCCESS",
         )
         if not self._user.is_superuser:
             crops_queryset = crops_queryset.filter(requested_by=self._user)
-        self.fields["crops"].queryset = crops_queryset
+        # choice labels show the dataset name: joined, not queried per crops
+        self.fields["crops"].queryset = crops_queryset.for_list()
 
         self.order_fields(list(AbstractTaskOnDatasetForm.Meta.fields) + ["crops"])
 
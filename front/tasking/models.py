@@ -1,13 +1,15 @@
+import math
 import shutil
+import time
 import uuid
-import requests
 from requests.exceptions import RequestException
 import traceback
-from typing import Dict, Any
+from typing import Any, Dict, List
 from pathlib import Path
 
 from django.db import models
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.core.mail import send_mail, mail_admins
 from django.utils.functional import cached_property
 from django.utils import timezone
@@ -16,7 +18,8 @@ from django.dispatch.dispatcher import receiver
 from django.urls import reverse
 from django.conf import settings
 
-from datasets.models import Dataset
+from datasets.models import Dataset, get_extractions_in_progress
+from shared.api import api_get, api_max_request_time, api_post
 
 """
 MODELS: AbstractAPITask
@@ -33,6 +36,41 @@ User = get_user_model()
 
 API_URL = getattr(settings, "API_URL", "http://localhost:5000")
 BASE_URL = getattr(settings, "BASE_URL", "http://localhost:8000")
+# whole seconds: cache backends such as RedisCache truncate timeouts with int()
+PROGRESS_CACHE_TTL = max(1, int(getattr(settings, "PROGRESS_CACHE_TTL", 2)))
+NOTIFICATION_DEDUP_TTL = 24 * 3600
+# max time a poller waits for another poller's API query before serving stale data
+PROGRESS_WAIT = 1.0
+
+
+def heavy_fields(model) -> List[str]:
+    """
+    Columns that may hold large values (JSON, text), not needed to list rows
+    """
+    return [
+        f.name
+        for f in model._meta.concrete_fields
+        if isinstance(f, (models.JSONField, models.TextField))
+    ]
+
+
+class TaskQuerySet(models.QuerySet):
+    def for_list(self) -> "TaskQuerySet":
+        """
+        Rows for lists and choices: heavy columns are deferred, the user and
+        dataset shown with each task are joined instead of prefetched
+        """
+        related = [
+            f
+            for f in self.model._meta.concrete_fields
+            if f.name in ("requested_by", "dataset")
+        ]
+        deferred = heavy_fields(self.model) + [
+            f"{f.name}__{name}"
+            for f in related
+            for name in heavy_fields(f.related_model)
+        ]
+        return self.select_related(*[f.name for f in related]).defer(*deferred)
 
 
 def AbstractTask(task_prefix: str):
@@ -75,6 +113,8 @@ def AbstractTask(task_prefix: str):
             related_name=f"{task_prefix}_tasks",
         )
 
+        objects = TaskQuerySet.as_manager()
+
         class Meta:
             abstract = True
             ordering = ["-requested_on"]
@@ -205,6 +245,8 @@ def AbstractTask(task_prefix: str):
                 self.write_log(error)
             self.is_finished = True
             self.save()
+            # the progress streams only reload the task on events
+            self.clear_cached_progress()
 
             if notify and self.notify_email:
                 try:
@@ -226,14 +268,27 @@ def AbstractTask(task_prefix: str):
             Called by the API when tasks events happen (@notifying)
             """
             event = data["event"]
-            if event == "STARTED":
-                self.status = "PROGRESS"
-                self.save()
+
+            # the API retries notifications: only handle each event once
+            dedup_key = f"notification:{self.pk}:{event}"
+            if not cache.add(dedup_key, 1, timeout=NOTIFICATION_DEDUP_TTL):
                 return
-            elif event == "SUCCESS":
-                self.on_task_success(data)
-            elif event == "ERROR":
-                self.on_task_error(data)
+
+            self.clear_cached_progress()
+            try:
+                if event == "STARTED":
+                    self.status = "PROGRESS"
+                    self.save()
+                elif event == "SUCCESS":
+                    self.on_task_success(data)
+                elif event == "ERROR":
+                    self.on_task_error(data)
+            except Exception:
+                # let the API notify again
+                cache.delete(dedup_key)
+                raise
+            # wake up the progress streams once the new status is saved
+            self.clear_cached_progress()
 
         def get_progress(self):
             """
@@ -241,6 +296,53 @@ def AbstractTask(task_prefix: str):
             """
             raise NotImplementedError()
 
+        @property
+        def progress_cache_key(self) -> str:
+            return f"progress:{getattr(self, 'api_tracking_id', None) or self.pk}"
+
+        def get_cached_progress(self) -> dict:
+            """
+            Returns the task progress shared between all pollers of the task:
+            finished tasks are answered from the DB, running ones query the API
+            at most once every PROGRESS_CACHE_TTL seconds
+            """
+            if self.is_finished:
+                return {"status": self.status}
+
+            key = self.progress_cache_key
+            progress = cache.get(key)
+            if progress is not None:
+                return progress
+
+            # only one poller queries the API, the others wait for its answer
+            # held as long as the API request can last, retries included
+            lock_timeout = math.ceil(api_max_request_time())
+            if cache.add(f"{key}:lock", 1, timeout=lock_timeout):
+                try:
+                    progress = self.get_progress()
+                    cache.set(key, progress, timeout=PROGRESS_CACHE_TTL)
+                    cache.set(f"{key}:stale", progress, timeout=lock_timeout)
+                finally:
+                    cache.delete(f"{key}:lock")
+                return progress
+
+            deadline = time.monotonic() + PROGRESS_WAIT
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                progress = cache.get(key)
+                if progress is not None:
+                    return progress
+
+            return cache.get(f"{key}:stale") or {"status": self.status}
+
+        def clear_cached_progress(self):
+            """
+            Drops the cached API progress and wakes up the progress streams
+            """
+            key = self.progress_cache_key
+            cache.delete_many([key, f"{key}:stale"])
+            cache.set(f"{key}:event", time.time(), timeout=24 * 3600)
+
         @classmethod
         def get_frontend_monitoring(cls):
             """
@@ -259,6 +361,7 @@ def AbstractTask(task_prefix: str):
                 "total_size": total_size,
                 "n_datasets": n_datasets,
                 "n_experiments": n_experiments,
+                "extractions": get_extractions_in_progress(),
             }
 
         @classmethod
@@ -385,7 +488,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
                 **self.get_task_kwargs(),
             }
             try:
-                api_query = requests.post(
+                api_query = api_post(
                     f"{self.api_endpoint_prefix}/{endpoint}",
                     json=data,
                     files=self.get_task_files(),
@@ -425,7 +528,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
             Cancel the task
             """
             try:
-                api_query = requests.post(
+                api_query = api_post(
                     f"{self.api_endpoint_prefix}/{self.api_tracking_id}/{endpoint}",
                 )
             except (ConnectionError, RequestException):
@@ -448,7 +551,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
             Queries the API to get the task progress
             """
             try:
-                api_res = requests.get(
+                api_res = api_get(
                     f"{self.api_endpoint_prefix}/{self.api_tracking_id}/status",
                 )
             except (ConnectionError, RequestException):
@@ -471,7 +574,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
             Returns a dict with the monitoring data
             """
             try:
-                api_query = requests.get(
+                api_query = api_get(
                     f"{cls.api_endpoint_prefix}/monitor",
                 )
             except (ConnectionError, RequestException):
@@ -490,7 +593,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
             Clears all tasks older than days_before days from the API server
             """
             try:
-                api_query = requests.post(
+                api_query = api_post(
                     f"{cls.api_endpoint_prefix}/monitor/clear",
                     data={
                         "days_before": days_before,
@@ -515,7 +618,7 @@ def AbstractAPITaskOnDataset(task_prefix: str):
             Clears the files generated during this task on the API server
             """
             try:
-                api_query = requests.post(
+                api_query = api_post(
                     f"{cls.api_endpoint_prefix}/monitor/clear/{tracking_id}",
                 )
             except (ConnectionError, RequestException):
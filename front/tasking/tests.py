@@ -1,3 +1,245 @@
-from django.test import TestCase
+import json
+import tempfile
+import uuid
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import NoReverseMatch, resolve, reverse
+
+from datasets.models import Dataset
+from regions.models import Regions
+from similarity.forms import SimilarityForm
+from similarity.models import Similarity
+from tasking.models import heavy_fields
+from tasking.views import TaskProgressStreamView
+from watermarks.models import WatermarkProcessing
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class TaskListQueriesTest(TestCase):
+    """
+    Task lists and choices must run a constant number of queries,
+    whatever the number of rows
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_tasks(self, n: int):
+        for i in range(n):
+            dataset = Dataset.objects.create(
+                name=f"dataset {i}",
+                created_by=self.user,
+                iiif_manifests=[f"https://example.com/{i}/manifest.json"],
+            )
+            crops = Regions.objects.create(
+                dataset=dataset,
+                requested_by=self.user,
+                status="SUCCESS",
+                regions_count=1,
+                parameters={"model": "test"},
+            )
+            Similarity.objects.create(
+                crops=crops, requested_by=self.user, parameters={"algorithm": "test"}
+            )
+
+    def count_queries(self, fn) -> int:
+        with CaptureQueriesContext(connection) as context:
+            fn()
+        return len(context.captured_queries)
+
+    def assert_constant_queries(self, fn):
+        self.add_tasks(2)
+        expected = self.count_queries(fn)
+        self.add_tasks(10)
+        self.assertEqual(self.count_queries(fn), expected)
+
+    def get_ok(self, url: str):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_for_list_defers_heavy_fields(self):
+        self.add_tasks(1)
+        task = Regions.objects.for_list().get()
+        self.assertIn("parameters", task.get_deferred_fields())
+        self.assertIn("iiif_manifests", task.dataset.get_deferred_fields())
+        with self.assertNumQueries(0):
+            self.assertEqual(task.requested_by.username, "admin")
+            self.assertEqual(task.dataset.name, "dataset 0")
+
+    def test_list_views_defer_heavy_fields(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        for app in (
+            "regions",
+            "similarity",
+            "dticlustering",
+            "watermarks",
+            "pipelines",
+        ):
+            for name, kwargs in [
+                ("list", {}),
+                ("list_perdataset", {"dataset_pk": uuid.uuid4()}),
+            ]:
+                try:
+                    match = resolve(reverse(f"{app}:{name}", kwargs=kwargs))
+                except NoReverseMatch:
+                    continue
+                with self.subTest(view=f"{app}:{name}"):
+                    view = match.func.view_class()
+                    view.setup(request, **match.kwargs)
+                    queryset = view.get_queryset()
+                    model = queryset.model
+
+                    expected = set(heavy_fields(model))
+                    if any(f.name == "dataset" for f in model._meta.concrete_fields):
+                        expected |= {f"dataset__{f}" for f in heavy_fields(Dataset)}
+                    self.assertTrue(expected)
+                    deferred, is_defer = queryset.query.deferred_loading
+                    self.assertTrue(is_defer)
+                    self.assertLessEqual(expected, set(deferred))
+
+    def test_regions_list(self):
+        self.assert_constant_queries(lambda: self.get_ok("/regions/"))
+
+    def test_similarity_list(self):
+        self.assert_constant_queries(lambda: self.get_ok("/similarity/"))
+
+    def test_datasets_list(self):
+        self.assert_constant_queries(lambda: self.get_ok("/datasets/"))
+
+    def test_form_choices(self):
+        def render_choices():
+            form = SimilarityForm(user=self.user)
+            str(form["dataset"]), str(form["crops"])
+
+        self.assert_constant_queries(render_choices)
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class TaskProgressStreamTest(TestCase):
+    """
+    An open progress stream must end with the final status of the task
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+        dataset = Dataset.objects.create(name="dataset", created_by=cls.user)
+        cls.task = Regions.objects.create(
+            dataset=dataset, requested_by=cls.user, status="PROGRESS"
+        )
+
+    @mock.patch("tasking.views.PROGRESS_STREAM_INTERVAL", 0)
+    @mock.patch("tasking.views.PROGRESS_STREAM_DURATION", 2)
+    async def test_stream_sees_success(self):
+        view = TaskProgressStreamView()
+        view.object = self.task
+        running = {"status": "PROGRESS", "log": {"infos": ["running"]}}
+        with mock.patch.object(self.task, "get_progress", return_value=running):
+            stream = view.stream_progress()
+            await anext(stream)  # retry delay
+
+            first = json.loads((await anext(stream))[len("data: ") :])
+            self.assertFalse(first["is_finished"])
+
+            # finished by another process (dramatiq worker)
+            other = await Regions.objects.aget(pk=self.task.pk)
+            await sync_to_async(other.terminate_task)("SUCCESS", notify=False)
+
+            events = [event async for event in stream if event.startswith("data: ")]
+
+        self.assertTrue(events, "the stream never sent the final status")
+        last = json.loads(events[-1][len("data: ") :])
+        self.assertTrue(last["is_finished"])
+        self.assertEqual(last["status"], "SUCCESS")
+
+
+@override_settings(
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class WatermarkResultsTest(TestCase):
+    """
+    Collecting the results must always leave a compressed image,
+    and the crops must come from the original upload
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser("admin", "admin@example.com", "pw")
+
+    def create_processing(self, annotations=None) -> WatermarkProcessing:
+        processing = WatermarkProcessing(
+            requested_by=self.user,
+            status="PROCESSING RESULTS",
+            annotations=annotations,
+        )
+        image = Image.new("RGB", (2000, 1500), "white")
+        image.paste((0, 0, 0), (800, 600, 1200, 900))
+        content = ContentFile(b"")
+        image.save(content, format="JPEG")
+        processing.image.save("query.jpg", content, save=False)
+        processing.save()
+        return processing
+
+    def crop_path(self, processing, k=0) -> Path:
+        return Path(f"{processing.image.path.rsplit('.', 1)[0]}+{k}.jpg")
+
+    def test_success(self):
+        processing = self.create_processing(
+            {"detection": {"boxes": [[0.4, 0.4, 0.6, 0.6]], "scores": [0.9]}}
+        )
+        processing.collect_results()
+
+        processing.refresh_from_db()
+        self.assertEqual(processing.status, "SUCCESS")
+        self.assertTrue(processing.is_finished)
+        with Image.open(processing.image.path) as image:
+            self.assertLessEqual(max(image.size), 1000)
+        with Image.open(self.crop_path(processing)) as crop:
+            # cropped from the 2000px upload, not from the preview
+            self.assertEqual(crop.size, (480, 480))
+
+        # redelivered message: the crops are not redone from the preview
+        mtime = self.crop_path(processing).stat().st_mtime_ns
+        processing.collect_results()
+        self.assertEqual(self.crop_path(processing).stat().st_mtime_ns, mtime)
+
+    def test_error(self):
+        processing = self.create_processing(
+            {"detection": {"boxes": [[0.4, 0.4, 0.6, 0.6]], "scores": [0.9]}}
+        )
+        processing.collect_results("API failure")
+
+        processing.refresh_from_db()
+        self.assertEqual(processing.status, "ERROR")
+        self.assertTrue(processing.is_finished)
+        self.assertIn("API failure", processing.log_file_path.read_text())
+        with Image.open(processing.image.path) as image:
+            self.assertLessEqual(max(image.size), 1000)
+        self.assertFalse(self.crop_path(processing).exists())
+
+    def test_invalid_boxes(self):
+        processing = self.create_processing({"detection": {"boxes": 1}})
+        processing.collect_results()
+
+        processing.refresh_from_db()
+        self.assertEqual(processing.status, "SUCCESS")
+        with Image.open(processing.image.path) as image:
+            self.assertLessEqual(max(image.size), 1000)
@@ -1,20 +1,27 @@
+import asyncio
 from typing import Any
+from asgiref.sync import sync_to_async
 from django.views.generic import CreateView, DetailView, View, ListView, TemplateView
 from django.views.generic.detail import SingleObjectMixin
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import AccessMixin
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.core.cache import cache
 import json
 
 from .models import AbstractTask
 from datasets.forms import DATASET_FIELDS
 
 LOGIN_REQUIRED = getattr(settings, "LOGIN_REQUIRED", True)
+# seconds between two progress events, and lifetime of a stream before the browser reconnects
+PROGRESS_STREAM_INTERVAL = getattr(settings, "PROGRESS_STREAM_INTERVAL", 1)
+PROGRESS_STREAM_DURATION = getattr(settings, "PROGRESS_STREAM_DURATION", 600)
 
 
 class TaskMixin:
@@ -47,6 +54,9 @@ def task_view_set(mixin):
     mixin.StartFrom = create_view(TaskStartFromView, f"{model_name}StartFrom")
     mixin.Status = create_view(TaskStatusView, f"{model_name}Status")
     mixin.Progress = create_view(TaskProgressView, f"{model_name}Progress")
+    mixin.ProgressStream = create_view(
+        TaskProgressStreamView, f"{model_name}ProgressStream"
+    )
     mixin.Cancel = create_view(TaskCancelView, f"{model_name}Cancel")
     mixin.Watcher = create_view(TaskWatcherView, f"{model_name}Watcher")
     mixin.Delete = create_view(TaskDeleteView, f"{model_name}Delete")
@@ -158,11 +168,104 @@ class TaskProgressView(
         return JsonResponse(
             {
                 "is_finished": self.object.is_finished,
-                **self.object.get_progress(),
+                **self.object.get_cached_progress(),
             }
         )
 
 
+def progress_delta(previous: dict, current: dict) -> dict:
+    """
+    Returns what changed between two progress states: new lines of the log lists
+    (with the offset where they start) and the progress counters that moved
+    """
+    delta = {
+        k: v
+        for k, v in current.items()
+        if k != "log" and (k not in previous or previous[k] != v)
+    }
+
+    log, previous_log = current.get("log") or {}, previous.get("log") or {}
+    log_delta = {}
+    for k in ("infos", "errors"):
+        lines, previous_lines = log.get(k) or [], previous_log.get(k) or []
+        # log rewritten upstream: send it again from the start
+        offset = (
+            len(previous_lines) if lines[: len(previous_lines)] == previous_lines else 0
+        )
+        if len(lines) > offset or offset < len(previous_lines):
+            log_delta[k] = lines[offset:]
+            log_delta[f"{k}_offset"] = offset
+
+    bars, previous_bars = log.get("progress") or [], previous_log.get("progress") or []
+    changed = {
+        i: bar
+        for i, bar in enumerate(bars)
+        if i >= len(previous_bars) or previous_bars[i] != bar
+    }
+    if changed or len(bars) != len(previous_bars):
+        log_delta["progress"] = changed
+        log_delta["progress_length"] = len(bars)
+
+    if log_delta:
+        delta["log"] = log_delta
+    return delta
+
+
+class TaskProgressStreamView(
+    LoginRequiredIfConfProtectedMixin, TaskMixin, SingleObjectMixin, View
+):
+    """
+    Task progress pushed as Server-Sent Events (needs the ASGI server)
+
+    Sends the full state first, then only deltas (see progress_delta); refreshes
+    the task from the DB when the API notifies the front (see TaskWatcherView)
+    """
+
+    def get(self, *args, **kwargs):
+        if not isinstance(self.request, ASGIRequest):
+            # a WSGI worker would be held for the whole task: client falls back to polling
+            return HttpResponse("Progress streaming requires ASGI", status=501)
+
+        self.object = self.get_object()
+        response = StreamingHttpResponse(
+            self.stream_progress(), content_type="text/event-stream"
+        )
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    async def stream_progress(self):
+        task = self.object
+        event_key = f"{task.progress_cache_key}:event"
+        get_progress = sync_to_async(task.get_cached_progress, thread_sensitive=False)
+        refresh = sync_to_async(task.refresh_from_db)
+
+        yield f"retry: {PROGRESS_STREAM_INTERVAL * 1000}\n\n"
+
+        sent, last_event = {}, None
+        loop = asyncio.get_running_loop()
+        end = loop.time() + PROGRESS_STREAM_DURATION
+        while loop.time() < end:
+            event = await cache.aget(event_key)
+            if event != last_event:
+                await refresh(fields=["status", "is_finished"])
+                last_event = event
+
+            state = {"is_finished": task.is_finished, **(await get_progress())}
+            delta = progress_delta(sent, state)
+            if not sent:
+                delta["reset"] = True
+            if delta:
+                yield f"data: {json.dumps(delta)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            sent = state
+
+            if task.is_finished:
+                return
+            await asyncio.sleep(PROGRESS_STREAM_INTERVAL)
+
+
 class TaskCancelView(LoginRequiredIfConfProtectedMixin, TaskMixin, DetailView):
     """
     Cancel a task
@@ -184,7 +287,8 @@ class TaskWatcherView(SingleObjectMixin, View):
     """
     Receive notifications (start, success, error) from an API task
 
-    Expects data in the request JSON body
+    Expects data in the request JSON body. Answers right away: results are
+    collected by the dramatiq workers (see <app>.tasks.collect_results)
     """
 
     def get(self, *args, **kwargs):
@@ -253,7 +357,7 @@ class TaskListView(LoginRequiredIfConfProtectedMixin, TaskMixin, ListView):
             super()
             .get_queryset()
             .order_by("-requested_on")
-            .prefetch_related("requested_by")  # "dataset" for AbstractAPITaskOnDataset
+            .for_list()  # joins "dataset" for AbstractTaskOnDataset
         )
         if not self.request.user.is_authenticated:
             return qset.none()
@@ -2,12 +2,15 @@ from django.db import models
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from django.conf import settings
-import requests
 from PIL import Image, ImageOps
+from pathlib import Path
+import os
+import uuid
 import zipfile
 import json
 
 from datasets.utils import PathAndRename
+from shared.api import api_get
 from tasking.models import AbstractAPITaskOnDataset
 
 User = get_user_model()
@@ -18,6 +21,20 @@ WATERMARKS_API_URL = getattr(settings, "API_URL", "http://localhost:5000")
 SOURCE_API_BASE_URL = f"{WATERMARKS_API_URL}/watermarks/sources"
 
 
+def save_image(image: Image.Image, path: Path, **kwargs):
+    """
+    Saves to a temporary file renamed into place, so that the image is never
+    served half-written (the format is taken from the extension)
+    """
+    tmp_path = path.with_name(f".{uuid.uuid4().hex}{path.suffix}")
+    try:
+        image.save(tmp_path, **kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
 class WatermarkProcessing(AbstractAPITaskOnDataset("watermarks")):
     notify_email = False
 
@@ -52,16 +69,36 @@ class WatermarkProcessing(AbstractAPITaskOnDataset("watermarks")):
     def on_task_success(self, data):
         if data is not None:
             self.annotations = data.get("output", {})
-            if self.detect:
-                self.crop_boxes()
+        self.status = "PROCESSING RESULTS"
+        self.save()
 
-        self.compress_image()
+        # decoding the upload can take a while: done by the dramatiq worker
+        from .tasks import collect_results
 
-        return super().on_task_success(data)
+        collect_results.send(str(self.pk))
 
     def on_task_error(self, error):
-        self.compress_image()
-        return super().on_task_error(error)
+        self.status = "PROCESSING RESULTS"
+        self.save()
+
+        from .tasks import collect_results
+
+        collect_results.send(str(self.pk), error.get("error", "Unknown error"))
+
+    def collect_results(self, error: str = None):
+        """
+        Crops the watermarks and compresses the image, then ends the task
+        (called by watermarks.tasks.collect_results)
+        """
+        try:
+            # a failed task only gets its image compressed, as no box is trusted
+            self.process_image(with_crops=error is None)
+        except Exception as e:
+            self.write_log(f"Error processing {self.image.name}: {e}\n")
+        if error is not None:
+            self.terminate_task("ERROR", error)
+        else:
+            self.terminate_task()
 
     def get_task_files(self):
         return {"image": open(self.image.path, "rb")}
@@ -106,17 +143,33 @@ class WatermarkProcessing(AbstractAPITaskOnDataset("watermarks")):
         image_base_url = self.image.url.rsplit(".", 1)[0]
         return [f"{image_base_url}+{i}.jpg" for i in range(k)]
 
-    def crop_boxes(self):
+    def process_image(self, with_crops: bool = True):
         """
-        Return the cropped image from the annotations
+        Decodes the image once, writes the crops of the detected watermarks, then
+        replaces the image with a compressed preview (each file written atomically)
+
+        The preview is written last: if the crops already exist, the image may be
+        the preview of a previous run, and they are not cropped again from it
         """
-        boxes = self.get_bounding_boxes()
-        if not boxes:
-            return []
-        image = Image.open(self.image)
-        image = ImageOps.exif_transpose(image)
+        boxes = []
+        if with_crops and self.detect:
+            try:
+                boxes = self.get_bounding_boxes()
+            except Exception as e:
+                # the preview is still needed
+                self.write_log(f"Error reading the boxes of {self.image.name}: {e}\n")
+        image_path = Path(self.image.path)
         image_base_path = self.image.path.rsplit(".", 1)[0]
-        crops = []
+        crop_paths = [Path(f"{image_base_path}+{k}.jpg") for k in range(len(boxes))]
+        if all(path.exists() for path in crop_paths):
+            boxes = []
+
+        with Image.open(image_path) as img:
+            if not boxes:
+                # only the preview is needed: reduced decoding (JPEG only)
+                img.draft("RGB", (1000, 1000))
+            image = ImageOps.exif_transpose(img).convert("RGB")
+
         for k, (box, score) in enumerate(boxes):
             box = [
                 box[0] * image.width,
@@ -134,18 +187,10 @@ class WatermarkProcessing(AbstractAPITaskOnDataset("watermarks")):
             )
             crop = image.crop((x0, y0, x1, y1))
             crop.thumbnail((512, 512))
-            crop.save(f"{image_base_path}+{k}.jpg", quality=85)
-
-    def compress_image(self):
-        """
-        Compress the image to a smaller size
-        """
+            save_image(crop, crop_paths[k], quality=85)
 
-        img = Image.open(self.image)
-        img = ImageOps.exif_transpose(img)
-        img = img.convert("RGB")
-        img.thumbnail((1000, 1000))
-        img.save(self.image.path, quality=60)
+        image.thumbnail((1000, 1000))
+        save_image(image, image_path, quality=60)
 
 
 class WatermarksSource(models.Model):
@@ -179,7 +224,7 @@ class WatermarksSource(models.Model):
         """
         Download the images from the API
         """
-        response = requests.get(f"{SOURCE_API_BASE_URL}/{self.uid}/images.zip")
+        response = api_get(f"{SOURCE_API_BASE_URL}/{self.uid}/images.zip")
         response.raise_for_status()
 
         zip_file = self.data_folder_path / "images.zip"
@@ -190,7 +235,7 @@ class WatermarksSource(models.Model):
             z.extractall(self.data_folder_path)
         zip_file.unlink()
 
-        response = requests.get(f"{SOURCE_API_BASE_URL}/{self.uid}/index.json")
+        response = api_get(f"{SOURCE_API_BASE_URL}/{self.uid}/index.json")
         response.raise_for_status()
         index = response.json()
         with open(self.data_folder_path / "index.json", "w") as f:
@@ -221,6 +266,6 @@ class WatermarksSource(models.Model):
         """
         Get the available sources from the API
         """
-        response = requests.get(SOURCE_API_BASE_URL)
+        response = api_get(SOURCE_API_BASE_URL)
         response.raise_for_status()
         return response.json()
@@ -0,0 +1,27 @@
+import dramatiq
+
+from .models import WatermarkProcessing
+
+"""
+All dramatiq tasks related to watermarks processing
+"""
+
+
+@dramatiq.actor
+def collect_results(experiment_id: str, error: str = None):
+    """
+    Crop the watermarks and compress the image once the API task ended
+    """
+    try:
+        processing = WatermarkProcessing.objects.get(id=experiment_id)
+    except WatermarkProcessing.DoesNotExist as e:
+        print(
+            f"[watermarks.collect_results] Unknown WatermarkProcessing: experiment_id doesn't match any record {e}"
+        )
+        return
+
+    if processing.is_finished:
+        # message delivered twice: results were already collected
+        return
+
+    processing.collect_results(error)
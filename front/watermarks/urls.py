@@ -12,6 +12,11 @@ urlpatterns = [
         WatermarkProcessingProgress.as_view(),
         name="progress",
     ),
+    path(
+        "<uuid:pk>/progress/stream",
+        WatermarkProcessingProgressStream.as_view(),
+        name="progress_stream",
+    ),
     path("<uuid:pk>/cancel", WatermarkProcessingCancel.as_view(), name="cancel"),
     path("<uuid:pk>/watch", WatermarkProcessingWatcher.as_view(), name="notify"),
     path("<uuid:pk>/delete", WatermarkProcessingDelete.as_view(), name="delete"),
@@ -10,6 +10,7 @@ from tasking.views import (
     TaskStartView,
     TaskStatusView,
     TaskProgressView,
+    TaskProgressStreamView,
     TaskCancelView,
     TaskWatcherView,
     TaskDeleteView,
@@ -47,6 +48,12 @@ class WatermarkProcessingProgress(WatermarkProcessingMixin, TaskProgressView):
     pass
 
 
+class WatermarkProcessingProgressStream(
+    WatermarkProcessingMixin, TaskProgressStreamView
+):
+    pass
+
+
 class WatermarkProcessingCancel(WatermarkProcessingMixin, TaskCancelView):
     pass
 
@@ -1,4 +1,4 @@
-import { EditorContext, EditorState, EditorAction, ClusterImageInfo, ClusterInfo } from "./types";
+import { EditorContext, EditorState, EditorAction, ClusterImageInfo, ClusterInfo, ClusterImagesPageRaw, unserializeImageInfo } from "./types";
 import React from "react";
 
 /*
@@ -15,6 +15,32 @@ function eraseImagesMetadata(images: ClusterImageInfo[]): ClusterImageInfo[] {
   });
 }
 
+export function loadWholeClusters(context: EditorContext, cluster_ids: number[]): Promise<void> {
+  /*
+  Lazy mode: fetches the images of some clusters that are not loaded yet,
+  so that an edit applies to all of their images. Edited clusters are then
+  never fetched again, as the server doesn't know the unsaved edits.
+  */
+  const clusters_url = context.state.clusters_url;
+  return Promise.all(cluster_ids.map((cluster_id) => {
+    const cluster = context.state.content.clusters.get(cluster_id);
+    if (!clusters_url || !cluster?.next_page) return;
+    const images: ClusterImageInfo[] = [];
+    const fetchFrom = (page: number): Promise<void> =>
+      fetch(`${clusters_url}/${cluster_id}?page=${page}`)
+        .then((response) => {
+          if (!response.ok) throw new Error(response.statusText);
+          return response.json();
+        })
+        .then((data: ClusterImagesPageRaw) => {
+          images.push(...data.images.map(unserializeImageInfo));
+          if (data.next_page) return fetchFrom(data.next_page);
+        });
+    return fetchFrom(cluster.next_page)
+      .then(() => context.dispatch({ type: "viewer_load_images", cluster_id, images, next_page: null }));
+  })).then(() => undefined);
+}
+
 export const editorReducer = (state: EditorState, action: EditorAction) : EditorState => {
   const action_prefix = action.type.split("_")[0];
   if (!state.editing && action_prefix != "viewer") return state;
@@ -53,6 +79,24 @@ function handleViewerAction(state: EditorState, action: EditorAction): EditorSta
 
     case "viewer_focus":
       return { ...state, editingCluster: action.cluster_id, image_selection: new Set<ClusterImageInfo>() };
+
+    case "viewer_load":
+      return { ...state, content: action.content };
+
+    case "viewer_saved":
+      // operations made while saving are kept for the next save
+      return { ...state, operations: state.operations.slice(action.count) };
+
+    case "viewer_load_images":
+      // pages arriving once a cluster is whole (or edited) are outdated
+      const cluster = state.content.clusters.get(action.cluster_id);
+      if (!cluster?.next_page) return state;
+      const loaded = new Set(cluster.images.map((image) => image.num));
+      const new_images = action.images.filter((image) => !loaded.has(image.num));
+      const next_page = action.next_page && Math.max(action.next_page, cluster.next_page);
+      const new_clusters = new Map(state.content.clusters);
+      new_clusters.set(action.cluster_id, { ...cluster, images: [...cluster.images, ...new_images], next_page: next_page });
+      return { ...state, content: { ...state.content, clusters: new_clusters } };
   }
   throw new Error("Invalid action type " + action.type);
 }
@@ -66,7 +110,10 @@ function handleClusterAction(state: EditorState, action: EditorAction): EditorSt
   switch (action.type) {
     case "cluster_rename":
       new_clusters.set(action.cluster_id, { ...new_clusters.get(action.cluster_id!)!, name: action.name! });
-      return { ...state, content: { ...state.content, clusters: new_clusters } };
+      return {
+        ...state, content: { ...state.content, clusters: new_clusters },
+        operations: [...state.operations, { type: "rename", cluster_id: action.cluster_id, name: action.name }]
+      };
 
     case "cluster_merge":
       // move images from cluster2 to cluster1
@@ -75,7 +122,10 @@ function handleClusterAction(state: EditorState, action: EditorAction): EditorSt
       const new_cluster1 = { ...cluster1, images: [...cluster1.images, ...eraseImagesMetadata(cluster2.images)] };
       new_clusters.delete(action.other);
       new_clusters.set(action.cluster_id, new_cluster1);
-      return { ...state, content: { ...state.content, clusters: new_clusters }, editingCluster: cluster1.id, askingCluster: null };
+      return {
+        ...state, content: { ...state.content, clusters: new_clusters }, editingCluster: cluster1.id, askingCluster: null,
+        operations: [...state.operations, { type: "merge", cluster_id: action.cluster_id, other: action.other }]
+      };
 
     case "cluster_ask":
       return {
@@ -151,7 +201,11 @@ function handleSelectionAction(state: EditorState, action: EditorAction): Editor
         content: { ...state.content, clusters: new_clusters },
         editingCluster: null,
         image_selection: new Set<ClusterImageInfo>(),
-        askingCluster: null
+        askingCluster: null,
+        operations: [...state.operations, {
+          type: "move", cluster_id: orig_cluster.id, other: action.cluster_id,
+          images: Array.from(selection).map((image) => image.num)
+        }]
       };
   }
   throw new Error("Invalid action type "+action.type);
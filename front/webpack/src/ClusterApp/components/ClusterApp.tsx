@@ -1,6 +1,6 @@
-import React, { useReducer } from "react";
+import React, { useEffect, useReducer } from "react";
 import { ClusterElement } from "./ClusterElement";
-import { ClusterImageInfo, serializeClusterFile, ClusterAppProps, ClusterInfo } from "../types";
+import { ClusterImageInfo, ClusterAppProps, ClusterInfo, clusterSize, unserializeClusterSummary } from "../types";
 import { ClusterEditorContext, editorReducer } from "../actions";
 import { ClusterAskModale } from "./ClusterAskModale";
 import { IconBtn } from "../../shared/IconBtn";
@@ -10,27 +10,58 @@ import { ClusterCSVExporter } from "./ClusterExporter";
   This file contains the main React component for the ClusterEditor app.
 */
 
-export function ClusterApp({ clustering_data, viewer_sort="size", editing = false, editable = false, formfield, base_url }: ClusterAppProps) {
+export function ClusterApp({ clustering_data, clusters_url, viewer_sort="size", editing = false, editable = false, formfield, patch_url, base_url }: ClusterAppProps) {
   const [editorState, dispatchEditor] = useReducer(
     editorReducer, {
     editing: editable && editing,
     editingCluster: null,
     askingCluster: null,
-    content: clustering_data,
+    content: clustering_data || { clusters: new Map(), background_urls: [] },
     base_url: base_url,
+    clusters_url: clusters_url,
     image_selection: new Set<ClusterImageInfo>(),
+    operations: [],
     viewer_sort: viewer_sort,
     viewer_display: "grid",
   });
 
+  // lazy mode: fetch the cluster list, images are fetched by each cluster
+  useEffect(() => {
+    if (clustering_data || !clusters_url) return;
+    fetch(clusters_url)
+      .then((response) => response.json())
+      .then((data) => dispatchEditor({ type: "viewer_load", content: unserializeClusterSummary(data) }))
+      .catch((error) => console.error("Could not load clusters", error));
+  }, [clusters_url]);
+
   const updateFormField = () => {
+    // the server applies the edits to the clustering it was loaded from
     if (formfield) {
-      formfield.value = JSON.stringify(serializeClusterFile(editorState.content));
+      formfield.value = JSON.stringify(editorState.operations);
     }
   };
 
+  const saveOperations = () => {
+    // send only the edits made since the last save
+    const operations = editorState.operations;
+    if (operations.length == 0) return;
+    const csrf_input = formfield!.form!.querySelector<HTMLInputElement>("input[name=csrfmiddlewaretoken]");
+    fetch(patch_url!, {
+      method: "POST",
+      headers: { "Content-Type": "application/json", "X-CSRFToken": csrf_input?.value || "" },
+      body: JSON.stringify({ operations: operations }),
+    })
+      .then((response) => {
+        if (!response.ok) throw new Error(response.statusText);
+        dispatchEditor({ type: "viewer_saved", count: operations.length });
+      })
+      .catch((error) => console.error("Could not save the clustering", error));
+  };
+
   const save = () => {
-    if (formfield) {
+    if (formfield && patch_url) {
+      saveOperations();
+    } else if (formfield) {
       updateFormField();
       formfield.form!.submit();
     }
@@ -39,7 +70,7 @@ export function ClusterApp({ clustering_data, viewer_sort="size", editing = fals
 
   // sort clusters
   const cluster_sorting = {
-    "size": (a: ClusterInfo, b: ClusterInfo) => b.images.length - a.images.length,
+    "size": (a: ClusterInfo, b: ClusterInfo) => clusterSize(b) - clusterSize(a),
     "id": (a: ClusterInfo, b: ClusterInfo) => a.id - b.id,
     "name": (a: ClusterInfo, b: ClusterInfo) => a.name.localeCompare(b.name)
   }[editorState.viewer_sort];
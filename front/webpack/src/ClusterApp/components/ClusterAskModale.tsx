@@ -1,7 +1,7 @@
 import React, { useState } from "react";
 import { MiniClusterElement } from "./ClusterElement";
-import { ClusterInfo } from "../types";
-import { ClusterEditorContext } from "../actions";
+import { ClusterInfo, clusterSize } from "../types";
+import { ClusterEditorContext, loadWholeClusters } from "../actions";
 import { IconBtn } from "../../shared/IconBtn";
 import { MagnifyingContext } from "../../shared/ImageMagnifier";
 
@@ -15,15 +15,25 @@ export function ClusterAskModale(props: { for_action: "cluster_merge" | "selecti
     const cluster = editorContext!.state.content.clusters.get(props.not_cluster_id)!;
     const selection = editorContext!.state.image_selection;
     const [selected, setSelected] = useState<ClusterInfo | null>(null);
+    const [loading, setLoading] = useState(false);
     const magnifyingContext = React.useContext(MagnifyingContext);
 
     const doAction = () => {
-        editorContext!.dispatch({
-            type: props.for_action,
-            cluster_id: selected!.id,
-            other: props.not_cluster_id
-        });
-        editorContext!.dispatch({ type: "cluster_ask", cluster_id: null });
+        if (selected === null || loading) return;
+        const target_id = selected.id;
+        setLoading(true);
+        // lazy mode: the edited clusters must be whole first
+        loadWholeClusters(editorContext!, target_id >= 0 ? [props.not_cluster_id, target_id] : [props.not_cluster_id])
+            .then(() => {
+                editorContext!.dispatch({
+                    type: props.for_action,
+                    cluster_id: target_id,
+                    other: props.not_cluster_id
+                });
+                editorContext!.dispatch({ type: "cluster_ask", cluster_id: null });
+            })
+            .catch((error) => console.error("Could not load the clusters to edit", error))
+            .finally(() => setLoading(false));
     };
     let action_icon: string, action_title: string, action_label: string, action_cluster: ClusterInfo;
     if (props.for_action == "cluster_merge") {
@@ -41,7 +51,7 @@ export function ClusterAskModale(props: { for_action: "cluster_merge" | "selecti
     // sort clusters and add one last new cluster
     const additional_cluster = { id: -1, name: "New cluster", images: [] };
     const cluster_sorting = {
-        "size": (a: ClusterInfo, b: ClusterInfo) => b.images.length - a.images.length,
+        "size": (a: ClusterInfo, b: ClusterInfo) => clusterSize(b) - clusterSize(a),
         "id": (a: ClusterInfo, b: ClusterInfo) => a.id - b.id,
         "name": (a: ClusterInfo, b: ClusterInfo) => a.name.localeCompare(b.name)
     }[editorContext!.state.viewer_sort];
@@ -73,7 +83,7 @@ export function ClusterAskModale(props: { for_action: "cluster_merge" | "selecti
                     <div className="cl-modale-actions">
                         <p>
                             <IconBtn onClick={() => { editorContext!.dispatch({ type: "cluster_ask", cluster_id: null }); }} icon="mdi:close" label="Cancel" className="is-outline" />
-                            <IconBtn onClick={doAction} icon={action_icon} label={action_label}  disabled={selected === null} />
+                            <IconBtn onClick={doAction} icon={action_icon} label={action_label}  disabled={selected === null || loading} />
                         </p>
                     </div>
                 </div>
@@ -1,7 +1,7 @@
 import React, { useEffect, useState } from "react";
 import { ClusterEditorContext } from "../actions";
 import { Icon } from "@iconify/react";
-import { ClusterInfo, ClusterProps } from "../types";
+import { ClusterImagesPageRaw, ClusterInfo, ClusterProps, clusterSize, unserializeImageInfo } from "../types";
 import { BasicImageList, SelectableImageList } from "./ImageLists";
 import { IconBtn } from "../../shared/IconBtn";
 import { ClusterCSVExporter } from "./ClusterExporter";
@@ -26,7 +26,7 @@ export function MiniClusterElement(props: { info: ClusterInfo; selected: boolean
       <div className="cl-props">
         <div className="cl-propcontent">
           <h3>{cluster.name}</h3>
-          <p>{cluster.id >= 0 && <React.Fragment>Cluster #{cluster.id}, {cluster.images.length} images</React.Fragment>} </p>
+          <p>{cluster.id >= 0 && <React.Fragment>Cluster #{cluster.id}, {clusterSize(cluster)} images</React.Fragment>} </p>
         </div>
       </div>
       <div className="cl-samples">
@@ -45,10 +45,30 @@ export function ClusterElement(props: ClusterProps) {
   const nameInput = React.createRef<HTMLInputElement>();
   const editorContext = React.useContext(ClusterEditorContext);
   const elRef = React.useRef<HTMLDivElement>(null);
+  const boxRef = React.useRef<HTMLDivElement>(null);
+  const loading = React.useRef(false);
 
   const cluster = props.info;
   const editable = editorContext?.state.editing;
   const n_shown = N_SHOWN[editorContext!.state.viewer_display];
+  const size = clusterSize(cluster);
+
+  // lazy mode: fetch the next page of images of the cluster
+  const loadNextPage = () => {
+    const clusters_url = editorContext?.state.clusters_url;
+    if (!clusters_url || !cluster.next_page || loading.current) return;
+    loading.current = true;
+    fetch(`${clusters_url}/${cluster.id}?page=${cluster.next_page}`)
+      .then((response) => response.json())
+      .then((data: ClusterImagesPageRaw) => {
+        editorContext?.dispatch({
+          type: "viewer_load_images", cluster_id: cluster.id,
+          images: data.images.map(unserializeImageInfo), next_page: data.next_page
+        });
+      })
+      .catch((error) => console.error(`Could not load cluster ${cluster.id}`, error))
+      .finally(() => { loading.current = false; });
+  };
 
   // useful functions
   const scrollIntoView = () => {
@@ -79,14 +99,32 @@ export function ClusterElement(props: ClusterProps) {
     if (expanded || props.editing) scrollIntoView();
   }, [expanded, props.editing]);
 
+  // lazy mode: fetch the first page when the cluster scrolls into view
+  useEffect(() => {
+    if (!cluster.next_page || cluster.images.length > 0 || !boxRef.current) return;
+    const observer = new IntersectionObserver((entries) => {
+      if (entries.some((entry) => entry.isIntersecting)) {
+        observer.disconnect();
+        loadNextPage();
+      }
+    }, { rootMargin: "200px" });
+    observer.observe(boxRef.current);
+    return () => observer.disconnect();
+  }, [cluster.next_page]);
+
+  // lazy mode: fetch the remaining pages when expanded
+  useEffect(() => {
+    if ((expanded || props.editing) && cluster.next_page && cluster.images.length > 0) loadNextPage();
+  }, [expanded, props.editing, cluster.next_page]);
+
   // sub components
-  const btnMore = (cluster.images.length > n_shown &&
+  const btnMore = (size > n_shown &&
     <a className="cl-more card cl-placeholder" href="javascript:void(0)" onClick={() => {setExpanded(!expanded); scrollIntoView();}}>
-      {expanded ? "–" : "+"}{cluster.images.length - n_shown}
+      {expanded ? "–" : "+"}{size - n_shown}
     </a>
   );
 
-  const btnExpand = (cluster.images.length > n_shown &&
+  const btnExpand = (size > n_shown &&
     (expanded ?
       <p><IconBtn icon="mdi:chevron-up" label="Collapse" onClick={() => {setExpanded(false); scrollIntoView();}} /></p> :
       <p><IconBtn icon="mdi:chevron-down" label="Expand" onClick={() => {setExpanded(true)}} /></p>)
@@ -94,7 +132,7 @@ export function ClusterElement(props: ClusterProps) {
 
   // render
   return (
-    <div className={"cl-cluster box" + (expanded || props.editing ? " cl-expanded" : "")}>
+    <div className={"cl-cluster box" + (expanded || props.editing ? " cl-expanded" : "")} ref={boxRef}>
       <div className="cl-anchor" ref={elRef}></div>
       <div className="cl-props">
         <div className="cl-propcontent">
@@ -112,7 +150,7 @@ export function ClusterElement(props: ClusterProps) {
             }
             </div>
 
-            <p>{cluster.id >= 0 && <React.Fragment>Cluster #{cluster.id}, {cluster.images.length} images</React.Fragment>}</p>
+            <p>{cluster.id >= 0 && <React.Fragment>Cluster #{cluster.id}, {size} images</React.Fragment>}</p>
 
 
             {editable ?
@@ -125,7 +163,7 @@ export function ClusterElement(props: ClusterProps) {
                 <IconBtn icon="mdi:edit" label="Edit cluster" onClick={() => toggleEdition(true)} />}
             </p> :
               <p>
-                <ClusterCSVExporter clusters={[cluster]} />
+                {!cluster.next_page && <ClusterCSVExporter clusters={[cluster]} />}
                 {btnExpand}
               </p>}
           </div>
@@ -24,6 +24,23 @@ export interface ClusterInfoRaw {
     images: ClusterImageInfoRaw[];
 }
 
+// cluster as listed by the clusters API (images are fetched by page)
+export interface ClusterSummaryRaw {
+    id: number;
+    name: string;
+    proto_url?: string;
+    mask_url?: string;
+    size: number;
+}
+
+export interface ClusterImagesPageRaw {
+    id: number;
+    count: number;
+    page: number;
+    next_page: number | null;
+    images: ClusterImageInfoRaw[];
+}
+
 export interface ClusteringFileRaw {
     clusters: { [key: string]: ClusterInfoRaw };
     background_urls: string[];
@@ -42,6 +59,8 @@ export interface ClusterInfo {
     proto_url?: string;
     mask_url?: string;
     images: ClusterImageInfo[];
+    size?: number; // total number of images, when lazy-loaded
+    next_page?: number | null; // next page of images to fetch, when lazy-loaded
 }
 
 export interface ClusterProps {
@@ -54,12 +73,20 @@ export interface ClusteringFile {
     background_urls: string[];
 }
 
+// edits sent to the saved clustering patch API
+export type ClusteringOperation =
+    { type: "rename", cluster_id: number, name: string } |
+    { type: "merge", cluster_id: number, other: number } |
+    { type: "move", cluster_id: number, other: number, images: number[] };
+
 export interface ClusterAppProps {
-    clustering_data: ClusteringFile;
+    clustering_data?: ClusteringFile;
+    clusters_url?: string; // lazy mode: clusters and their images are fetched from this API
     base_url?: string;
     editing?: boolean;
     editable?: boolean;
     formfield?: HTMLInputElement;
+    patch_url?: string; // when set, edits are saved as operations instead of submitting the form
     viewer_sort?: "size" | "id" | "name";
 }
 
@@ -71,7 +98,9 @@ export interface EditorState {
     askingCluster: { not_cluster_id: number, for_action: ActionRequiringAsk } | null;
     content: ClusteringFile;
     base_url?: string;
+    clusters_url?: string;
     image_selection: Set<ClusterImageInfo>;
+    operations: ClusteringOperation[]; // edits not saved yet
     viewer_sort: "size" | "id" | "name";
     viewer_display: "grid" | "rows";
 }
@@ -86,6 +115,9 @@ export type EditorAction =
     { type: "viewer_focus", cluster_id: number | null } |
     { type: "viewer_sort", sort: string } |
     { type: "viewer_display", display: string } |
+    { type: "viewer_load", content: ClusteringFile } |
+    { type: "viewer_saved", count: number } |
+    { type: "viewer_load_images", cluster_id: number, images: ClusterImageInfo[], next_page: number | null } |
     { type: "selection_change", images: ClusterImageInfo[], selected: boolean } |
     { type: "selection_invert" } |
     { type: "selection_clear" } |
@@ -125,6 +157,21 @@ export function unserializeClusterFile(file: ClusteringFileRaw): ClusteringFile
   };
 }
 
+export function unserializeClusterSummary(file: { clusters: ClusterSummaryRaw[], background_urls: string[] }): ClusteringFile {
+  return {
+    clusters: new Map(file.clusters.map((cluster) => [cluster.id, {
+      ...cluster,
+      images: [],
+      next_page: 1
+    }])),
+    background_urls: file.background_urls
+  };
+}
+
+export function clusterSize(cluster: ClusterInfo): number {
+  return cluster.next_page ? cluster.size! : cluster.images.length;
+}
+
 export function serializeClusterFile(file: ClusteringFile): ClusteringFileRaw {
   return {
     clusters: Object.fromEntries(Array.from(file.clusters.entries()).map(([key, value]) => [key.toString(), {
@@ -1,18 +1,84 @@
 import React from "react";
 
+interface ProgressBar {context: string, current: number, total: number}
+
 interface ProgressStatus {
     status: string;
     log: {
         infos?: string[];
-        progress?: {context: string, current: number, total: number}[];
+        progress?: ProgressBar[];
         errors?: string[];
     };
 }
 
-export function TaskProgressTracker (props: {tracking_url: string}) {
+interface ProgressDelta {
+    reset?: boolean;
+    status?: string;
+    is_finished?: boolean;
+    log?: {
+        infos?: string[];
+        infos_offset?: number;
+        errors?: string[];
+        errors_offset?: number;
+        progress?: {[index: string]: ProgressBar};
+        progress_length?: number;
+    };
+}
+
+function applyDelta(previous: ProgressStatus | null, delta: ProgressDelta): ProgressStatus {
+    /*
+    Merge a progress event sent by the stream endpoint into the current status
+    */
+    const base = (delta.reset || !previous) ? {status: "", log: {}} : previous;
+    const {log: log_delta, reset, is_finished, ...fields} = delta;
+    const log = {...base.log};
+
+    if (log_delta) {
+        for (const key of ["infos", "errors"] as const) {
+            const lines = log_delta[key];
+            if (lines !== undefined)
+                log[key] = (log[key] || []).slice(0, log_delta[`${key}_offset` as const] || 0).concat(lines);
+        }
+        if (log_delta.progress !== undefined) {
+            const bars = (log.progress || []).slice(0, log_delta.progress_length);
+            for (const [index, bar] of Object.entries(log_delta.progress))
+                bars[parseInt(index)] = bar;
+            log.progress = bars;
+        }
+    }
+    return {...base, ...fields, log};
+}
+
+export function TaskProgressTracker (props: {tracking_url: string, stream_url?: string}) {
     const [status, setStatus] = React.useState<ProgressStatus | null>(null);
     const [is_finished, setFinished] = React.useState(false);
     const [error, setError] = React.useState<string | null>(null);
+    const [streaming, setStreaming] = React.useState(!!props.stream_url && !!window.EventSource);
+
+    // push-based updates: one connection receiving only what changed
+    React.useEffect(() => {
+        if (!streaming || !props.stream_url) return;
+        const source = new EventSource(props.stream_url);
+        let received = false;
+
+        source.onmessage = (event) => {
+            received = true;
+            const delta: ProgressDelta = JSON.parse(event.data);
+            setStatus(previous => applyDelta(previous, delta));
+            if (delta.is_finished) {
+                source.close();
+                setFinished(true);
+            }
+        };
+        source.onerror = () => {
+            // server without streaming support: go back to polling
+            if (!received || source.readyState === EventSource.CLOSED) {
+                source.close();
+                setStreaming(false);
+            }
+        };
+        return () => source.close();
+    }, [streaming, props.stream_url]);
 
     // regular polling using setTimeout after results
     const poll = React.useCallback(() => {
@@ -34,8 +100,8 @@ export function TaskProgressTracker (props: {tracking_url: string}) {
     }, [props.tracking_url]);
 
     React.useEffect(() => {
-        poll();
-    }, [poll]);
+        if (!streaming) poll();
+    }, [poll, streaming]);
 
 
     if (error)
@@ -1,5 +1,6 @@
 import React, { useReducer } from "react";
-import { SimilarityMatches, SimilarityIndex } from "../types";
+import { SimilarityMatches, SimilarityIndex, SimilarityBrowsePage } from "../types";
+import { fetchSimilarityNeighbors, fetchSimilarityPage } from "../utils/serialization";
 import { NameProvider } from "../../shared/types";
 import { ImageInfo, Document } from "../../shared/types";
 import { MatchRow } from "./MatchRow";
@@ -10,27 +11,48 @@ import { SimilarityProps } from "./SimilarityApp";
 
 interface SimilarityHref {
     matchesHref?: (watermark: ImageInfo) => string;
+    // loads the matches of a query left out of a browse page
+    loadAllMatches?: (query: ImageInfo, count: number) => Promise<SimilarityMatches>;
 }
 
+// matches of each query in a browse page, the others are fetched on demand
+const PREVIEW_MATCHES = 5;
+
 export const SimilarityHrefContext = React.createContext<SimilarityHref>({});
 
-export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index: SimilarityIndex, matches: SimilarityMatches[], extra_toolbar_items?: React.ReactNode }) {
+function scoreRange(matches: SimilarityMatches[]): [number, number] {
+    let min = Infinity, max = -Infinity;
+    for (const match of matches) {
+        for (const m of match.matches) {
+            if (m.similarity < min) min = m.similarity;
+            if (m.similarity > max) max = m.similarity;
+        }
+    }
+    return min <= max ? [min, max] : [0, 1];
+}
+
+export function ImageSimBrowser({ index, matches, browse_url, neighbors_url, extra_toolbar_items }: { index: SimilarityIndex, matches: SimilarityMatches[], browse_url?: string, neighbors_url?: string, extra_toolbar_items?: React.ReactNode }) {
     /*
     Component to render a list of watermark matches.
+
+    browse_url: if given, pages are fetched from the server instead of paginating matches
+    neighbors_url: if given (with browse_url), pages only hold the best matches of
+        each query, the others are fetched from it when a row is expanded
     */
 
     const [group_by_source, toggleGroupBySource] = useReducer((group_by_source) => !group_by_source, false);
     const [filter_by_source, setFilterBySource] = React.useState<Document | null>(null);
     const [page, setPage] = React.useState(1);
     const [highlit, setHighlit] = React.useState<ImageInfo | null>(null);
-    const minThreshold = Math.min(...matches.map(match => Math.min(...match.matches.map(m => m.similarity))));
-    const maxThreshold = Math.max(...matches.map(match => Math.max(...match.matches.map(m => m.similarity))));
-    const [threshold, setThreshold] = React.useState(minThreshold + 0.5*(maxThreshold-minThreshold));
+    const [remote, setRemote] = React.useState<SimilarityBrowsePage | null>(null);
+    const [minThreshold, maxThreshold] = remote ? [remote.min_score, remote.max_score] : scoreRange(matches);
+    const [threshold, setThreshold] = React.useState<number | null>(null);
+    const actual_threshold = threshold ?? minThreshold + 0.5*(maxThreshold-minThreshold);
     const nameProvider = React.useContext(NameProviderContext);
 
     const matches_filtered = filter_by_source ? matches.filter(match => match.query.document === filter_by_source) : matches;
     const PAGINATE_BY = 30;
-    const total_pages = Math.ceil(matches_filtered.length / PAGINATE_BY);
+    const total_pages = remote ? remote.num_pages : Math.ceil(matches_filtered.length / PAGINATE_BY);
 
     const hashchange = () => {
         const loc = window.location.hash;
@@ -52,6 +74,10 @@ export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index
         return `#match-${watermark_index}`;
     }
 
+    const loadAllMatches = (browse_url && neighbors_url) ? (
+        (query: ImageInfo, count: number) => fetchSimilarityNeighbors(neighbors_url!, query.num!, index, count)
+    ) : undefined;
+
     const toPage = (page: number) => {
         window.location.hash = `#page-${page}`;
     }
@@ -62,7 +88,36 @@ export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index
         if (actual_index === -1) return false;
         return Math.floor(actual_index / PAGINATE_BY) + 1;
     }
-    const actual_page = find_page(highlit) || Math.min(page, total_pages);
+    const actual_page = remote ? remote.page : find_page(highlit) || Math.min(page, total_pages);
+    const page_matches = remote ? remote.matches : matches_filtered.slice((actual_page - 1) * PAGINATE_BY, (actual_page) * PAGINATE_BY);
+
+    // filtered server-side once the score range is known, so that pages and totals
+    // only count the matches above the threshold
+    const remote_threshold = (remote || threshold !== null) ? actual_threshold : undefined;
+
+    React.useEffect(() => {
+        if (!browse_url) return;
+        let cancelled = false;
+        // debounced: the threshold slider changes on every step
+        const timeout = window.setTimeout(() => {
+            fetchSimilarityPage(browse_url, {
+                page,
+                page_size: PAGINATE_BY,
+                filter_by_source: filter_by_source?.uid,
+                threshold: remote_threshold,
+                group_by_source: group_by_source ? 1 : undefined,
+                // grouped rows show the best match of each document: all are needed
+                k: (neighbors_url && !group_by_source) ? PREVIEW_MATCHES : undefined,
+                image: highlit?.num,
+            }, index).then(remote_page => {
+                if (!cancelled) setRemote(remote_page);
+            });
+        }, 150);
+        return () => {
+            cancelled = true;
+            window.clearTimeout(timeout);
+        };
+    }, [browse_url, neighbors_url, page, filter_by_source, highlit, remote_threshold, group_by_source]);
 
 
     React.useEffect(() => {
@@ -77,7 +132,7 @@ export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index
     }, []);
 
     return (
-        <SimilarityHrefContext.Provider value={{matchesHref}}>
+        <SimilarityHrefContext.Provider value={{matchesHref, loadAllMatches}}>
             <div className="toolbar">
                 <div className="toolbar-content">
                     {extra_toolbar_items}
@@ -86,8 +141,8 @@ export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index
                             Similarity threshold:
                         </label>
                         <div className="field">
-                            <input type="range" min={minThreshold} max={maxThreshold} step={0.01} value={threshold} onChange={(e) => setThreshold(parseFloat(e.target.value))} />
-                            <span className="m-3">{threshold.toPrecision(4)}</span>
+                            <input type="range" min={minThreshold} max={maxThreshold} step={0.01} value={actual_threshold} onChange={(e) => setThreshold(parseFloat(e.target.value))} />
+                            <span className="m-3">{actual_threshold.toPrecision(4)}</span>
                         </div>
                     </div>
                     {index.sources.length > 1 &&
@@ -119,8 +174,8 @@ export function ImageSimBrowser({ index, matches, extra_toolbar_items }: { index
             </div>
             <div className="viewer-table">
 
-                {matches_filtered.slice((actual_page - 1) * PAGINATE_BY, (actual_page) * PAGINATE_BY).map((matches, idx) => (
-                    <MatchRow key={idx} matches={matches} group_by_source={group_by_source} highlit={highlit == matches.query} threshold={threshold} />
+                {page_matches.map((matches, idx) => (
+                    <MatchRow key={idx} matches={matches} group_by_source={group_by_source} highlit={highlit == matches.query} threshold={actual_threshold} />
                 ))}
             </div>
             <div className="mt-4"></div>
@@ -19,10 +19,30 @@ export function MatchRow({matches, group_by_source, highlit, threshold}: MatchRo
     Component to render a single watermark match.
     */
     const [showAll, toggleShowAll] = React.useReducer((showAll) => !showAll, false);
-    const groups = group_by_source ? matches.matches_by_document : matches.matches.map(m => [m]);
+    // all the matches, when the row only received the best ones
+    const [allMatches, setAllMatches] = React.useState<SimilarityMatches | null>(null);
+    const shown = allMatches || matches;
+    const groups = group_by_source ? shown.matches_by_document : shown.matches.map(m => [m]);
     const scrollRef = React.useRef<HTMLDivElement>(null);
     const nameProvider = React.useContext(NameProviderContext);
-    const matchesRef = React.useContext(SimilarityHrefContext).matchesHref || (() => undefined);
+    const { matchesHref, loadAllMatches } = React.useContext(SimilarityHrefContext);
+    const matchesRef = matchesHref || (() => undefined);
+    const has_more = !allMatches && !!loadAllMatches && (matches.count ?? 0) > matches.matches.length;
+
+    useEffect(() => {
+        setAllMatches(null);
+    }, [matches]);
+
+    const onShowAll = () => {
+        if (!showAll && has_more) {
+            loadAllMatches!(matches.query, matches.count!).then(loaded => {
+                setAllMatches(loaded);
+                toggleShowAll();
+            });
+            return;
+        }
+        toggleShowAll();
+    };
 
     useEffect(() => {
         if (highlit) {
@@ -37,12 +57,12 @@ export function MatchRow({matches, group_by_source, highlit, threshold}: MatchRo
                 <div className="columns is-multiline match-items is-centered">
                     <ImageDisplay image={matches.query} href={matchesRef(matches.query)}/>
                 </div>
-                {groups.length > 5 && <p>
-                    <a href="javascript:void(0)" onClick={toggleShowAll}>
+                {(groups.length > 5 || has_more) && <p>
+                    <a href="javascript:void(0)" onClick={onShowAll}>
                         {showAll ? "Show only 5 best" : `Show all results`}
                     </a>
                 </p>}
-                <MatchCSVExporter matches={matches} threshold={threshold}/>
+                <MatchCSVExporter matches={shown} threshold={threshold}/>
             </div>
             <div className="column columns match-results">
                 {groups.slice(0, showAll ? groups.length : 5).map((grouped_by_source, k) => (
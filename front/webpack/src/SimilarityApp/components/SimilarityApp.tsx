@@ -11,8 +11,11 @@ import { ImageTooltip, TooltipContext, TooltipProps } from "../../shared/ImageTo
 
 export interface SimilarityProps {
     index: SimilarityIndex;
-    matches: SimilarityMatches[];
+    matches: SimilarityMatches[] | null; // null: browsed through browse_url, loaded for clustering
     mode?: SimilarityMode;
+    browse_url?: string;
+    neighbors_url?: string;
+    loadMatches?: () => Promise<SimilarityMatches[]>;
 }
 
 export type SimilarityMode = "cluster" | "browse";
@@ -23,6 +26,13 @@ export function SimilarityApp(props: SimilarityProps) {
     const [magnifying, setMagnifying] = React.useState<MagnifyProps | null>(null);
     const [mode, setMode] = React.useState<SimilarityMode>(props.mode || "cluster");
     const [tooltip, setTooltip] = React.useState<TooltipProps | undefined>(undefined);
+    const [matches, setMatches] = React.useState<SimilarityMatches[] | null>(props.matches);
+
+    React.useEffect(() => {
+        if (mode == "cluster" && !matches && props.loadMatches) {
+            props.loadMatches().then(setMatches);
+        }
+    }, [mode]);
 
     React.useEffect(() => {
         fetchIIIFNames(props.index.sources, (ncontext: NameProvider) => setContext({ ...nameProvider, ...ncontext }));
@@ -39,8 +49,8 @@ export function SimilarityApp(props: SimilarityProps) {
     <NameProviderContext.Provider value={nameProvider}>
         <TooltipContext.Provider value={{ setTooltip }}>
             <MagnifyingContext.Provider value={{ magnify: setMagnifying }}>
-                {mode === "browse" && <ImageSimBrowser index={props.index} matches={props.matches} extra_toolbar_items={addtitional_toolbar} />}
-                <ClusteringTool index={props.index} matches={props.matches} visible={mode == "cluster"} extra_toolbar_items={addtitional_toolbar} />
+                {mode === "browse" && <ImageSimBrowser index={props.index} matches={matches || []} browse_url={matches ? undefined : props.browse_url} neighbors_url={props.neighbors_url} extra_toolbar_items={addtitional_toolbar} />}
+                {matches && <ClusteringTool index={props.index} matches={matches} visible={mode == "cluster"} extra_toolbar_items={addtitional_toolbar} />}
                 {magnifying && <ImageMagnifier {...magnifying} />}
                 {tooltip && <ImageTooltip {...tooltip} />}
             </MagnifyingContext.Provider>
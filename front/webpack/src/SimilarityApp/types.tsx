@@ -27,6 +27,36 @@ export interface SimilarityIndexRaw {
 
 export type SimpleSimilarityMatchRaw = [number, number, number] // [source_index, query_index, similarity]
 
+// columns of the binary pairs file (pairs.bin, see similarity/pairs.py)
+export interface SimilarityPairsColumns {
+    n: number;
+    q: Int32Array;
+    s: Int32Array;
+    score: Float32Array;
+    tr: Uint8Array; // n_tr transposition codes per pair
+    n_tr: number;
+    transpositions: string[];
+}
+
+// best matches of one image (similarity/<pk>/neighbors/<image_idx>)
+export interface SimilarityNeighborsRaw {
+    image: number;
+    k?: number;
+    count?: number; // in browse pages: number of matches, neighbors holding only the k best
+    neighbors: number[]; // indices in the similarity index, best first
+    scores: number[];
+}
+
+// one page of similarity/<pk>/browse
+export interface SimilarityBrowsePageRaw {
+    page: number;
+    num_pages: number;
+    count: number; // number of query images
+    min_score: number;
+    max_score: number;
+    results: SimilarityNeighborsRaw[];
+}
+
 export interface SimilarityMatchRaw {
     similarity: number;
     best_source_flip: number;
@@ -69,4 +99,13 @@ export interface SimilarityMatches {
     query: ImageInfo;
     matches: SimilarityMatch[];
     matches_by_document: SimilarityMatch[][];
+    count?: number; // number of matches, if only the best ones were loaded
+}
+
+export interface SimilarityBrowsePage {
+    page: number;
+    num_pages: number;
+    min_score: number;
+    max_score: number;
+    matches: SimilarityMatches[];
 }
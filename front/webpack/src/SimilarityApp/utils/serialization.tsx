@@ -1,4 +1,4 @@
-import { SimilarityIndexRaw, SimilarityIndex, SimpleSimilarityMatchRaw, SimilarityMatches, SimilarityMatchRaw, SimilarityOutputRaw, SimilarityMatch } from "../types";
+import { SimilarityIndexRaw, SimilarityIndex, SimpleSimilarityMatchRaw, SimilarityMatches, SimilarityMatchRaw, SimilarityOutputRaw, SimilarityMatch, SimilarityPairsColumns, SimilarityNeighborsRaw, SimilarityBrowsePage, SimilarityBrowsePageRaw } from "../types";
 import { ImageInfo } from "../../shared/types";
 
 
@@ -25,17 +25,100 @@ export function unserializeSimilarityIndex(index: SimilarityIndexRaw): Similarit
     };
 }
 
-export function unserializeSimilarityMatrix(raw_matches: SimpleSimilarityMatchRaw[], index_raw: SimilarityIndexRaw): { matches: SimilarityMatches[]; index: SimilarityIndex; } {
-    const index = unserializeSimilarityIndex(index_raw);
+const PAIRS_MAGIC = "SIMPAIRS";
+
+export function parseSimilarityPairs(buffer: ArrayBuffer): SimilarityPairsColumns {
+    /*
+    Views the columns of a binary pairs file as typed arrays (no copy)
+    */
+    const view = new DataView(buffer);
+    if (new TextDecoder().decode(new Uint8Array(buffer, 0, 8)) !== PAIRS_MAGIC) {
+        throw new Error("Not a similarity pairs file");
+    }
+    const header_size = view.getUint32(12, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 16, header_size)));
+    const n: number = header.n;
+    let offset = 16 + header_size;
+    const q = new Int32Array(buffer, offset, n);
+    offset += 4 * n;
+    const s = new Int32Array(buffer, offset, n);
+    offset += 4 * n;
+    const score = new Float32Array(buffer, offset, n);
+    offset += 4 * n;
+    const tr = new Uint8Array(buffer, offset, n * header.n_tr);
+    return { n, q, s, score, tr, n_tr: header.n_tr, transpositions: header.transpositions };
+}
+
+export function unserializeSimilarityMatrix(raw_matches: SimpleSimilarityMatchRaw[] | SimilarityPairsColumns, index_raw: SimilarityIndexRaw, parsed_index?: SimilarityIndex): { matches: SimilarityMatches[]; index: SimilarityIndex; } {
+    const index = parsed_index || unserializeSimilarityIndex(index_raw);
     const complex_matches: SimilarityMatchRaw[][] = index.images.map(() => []);
-    raw_matches.forEach(([source_index, query_index, similarity]) => {
+    const addMatch = (source_index: number, query_index: number, similarity: number) => {
         // Create a symmetric matrix
         complex_matches[query_index].push({ similarity, best_source_flip: 0, best_query_flip: 0, query_index: query_index, source_index: source_index });
         complex_matches[source_index].push({ similarity, best_source_flip: 0, best_query_flip: 0, query_index: source_index, source_index: query_index });
-    });
+    };
+    if (Array.isArray(raw_matches)) {
+        raw_matches.forEach(([source_index, query_index, similarity]) => addMatch(source_index, query_index, similarity));
+    } else {
+        for (let i = 0; i < raw_matches.n; i++) {
+            addMatch(raw_matches.q[i], raw_matches.s[i], raw_matches.score[i]);
+        }
+    }
     return { matches: unserializeImageMatches(index.images, { matches: complex_matches, query_transpositions: index.transpositions }, index), index };
 }
 
+export function unserializeNeighbors(raw: SimilarityNeighborsRaw, index: SimilarityIndex): SimilarityMatches {
+    const matches: SimilarityMatchRaw[] = raw.neighbors.map((source_index, i) => (
+        { similarity: raw.scores[i], best_source_flip: 0, best_query_flip: 0, query_index: raw.image, source_index }
+    ));
+    const image_matches = unserializeImageMatches([index.images[raw.image]], { matches: [matches], query_transpositions: index.transpositions }, index)[0];
+    return raw.count === undefined ? image_matches : { ...image_matches, count: raw.count };
+}
+
+export function fetchSimilarityNeighbors(neighbors_url: string, image_idx: number, index: SimilarityIndex, k?: number): Promise<SimilarityMatches> {
+    /*
+    Fetches the best matches of a single image instead of the whole matrix
+
+    neighbors_url: the neighbors endpoint of the similarity task, without the image index
+    k: capped by the server to SIMILARITY_TOP_K
+    */
+    const url = `${neighbors_url}/${image_idx}` + (k ? `?k=${k}` : "");
+    return fetch(url).then(response => {
+        if (!response.ok) throw new Error(response.statusText);
+        return response.json();
+    }).then((raw: SimilarityNeighborsRaw) => unserializeNeighbors(raw, index));
+}
+
+export interface SimilarityBrowseQuery {
+    page: number;
+    page_size: number;
+    filter_by_source?: string;
+    threshold?: number;
+    group_by_source?: number; // 1 to also get the matches grouped by document
+    k?: number; // only the k best matches of each image
+    image?: number; // to get the page of this image instead
+}
+
+export function fetchSimilarityPage(browse_url: string, query: SimilarityBrowseQuery, index: SimilarityIndex): Promise<SimilarityBrowsePage> {
+    /*
+    Fetches one page of query images and their matches, sorted server-side
+    */
+    const params = new URLSearchParams();
+    Object.entries(query).forEach(([key, value]) => {
+        if (value !== undefined && value !== null && value !== "") params.set(key, String(value));
+    });
+    return fetch(`${browse_url}?${params}`).then(response => {
+        if (!response.ok) throw new Error(response.statusText);
+        return response.json();
+    }).then((raw: SimilarityBrowsePageRaw) => ({
+        page: raw.page,
+        num_pages: raw.num_pages,
+        min_score: raw.min_score,
+        max_score: raw.max_score,
+        matches: raw.results.map(result => unserializeNeighbors(result, index))
+    }));
+}
+
 export function unserializeImageMatches(queries: ImageInfo[], raw_matches: SimilarityOutputRaw, index: SimilarityIndex): SimilarityMatches[] {
     const matches: SimilarityMatches[] = [];
     for (let i = 0; i < raw_matches.matches.length; i++) {
@@ -5,60 +5,84 @@ import "./sass/style.scss";
 import { MatchViewer, WatermarkSimBrowser } from './WatermarkMatches';
 import { unserializeSingleWatermarkMatches, unserializeWatermarkSimilarity } from './WatermarkMatches/types';
 import { SimilarityApp } from './SimilarityApp';
-import { unserializeSimilarityMatrix } from "./SimilarityApp/utils/serialization";
-import { unserializeClusterFile } from './ClusterApp/types';
+import { parseSimilarityPairs, unserializeSimilarityIndex, unserializeSimilarityMatrix } from "./SimilarityApp/utils/serialization";
 import { SimilarityMode } from './SimilarityApp/components/SimilarityApp';
 
-function initClusterViewer(
+function initClusterViewerLazy(
   target_root: HTMLElement,
-  clustering_data: any,
+  clusters_url: string,
   base_media_url: string,
   editable?: boolean,
   editing?: boolean,
-  formfield?: HTMLInputElement) {
+  formfield?: HTMLInputElement,
+  patch_url?: string) {
   /*
-  Main entry point for the clustering viewer app.
+  Clustering viewer fetching clusters from the clusters API,
+  and the images of each cluster by page as it scrolls into view.
 
   target_root: the root element to render the app in
-  clustering_data: the clustering data to render
+  clusters_url: the URL of the clusters API
   base_media_url: the base url for media files
   editable: whether the app should be editable
   editing: whether the app should be in editing mode
-  formfield: the form field to update with the current clustering data
+  formfield: the form field to update with the edits (operations)
+  patch_url: if given, edits are sent to this URL instead of submitting the form
   */
 
   createRoot(target_root).render(
-    <ClusterApp clustering_data={unserializeClusterFile(clustering_data)} base_url={base_media_url}
-                editable={editable} editing={editing} formfield={formfield} />
+    <ClusterApp clusters_url={clusters_url} base_url={base_media_url}
+                editable={editable} editing={editing} formfield={formfield} patch_url={patch_url} />
   );
 }
 
-function initProgressTracker(target_root: HTMLElement, tracking_url: string) {
+function initProgressTracker(target_root: HTMLElement, tracking_url: string, stream_url?: string) {
   /*
   Main entry point for the progress tracker app.
 
   target_root: the root element to render the app in
   tracking_url: the url to track
+  stream_url: the url of the progress event stream (falls back to polling tracking_url)
   */
 
   createRoot(target_root).render(
-    <TaskProgressTracker tracking_url={tracking_url} />
+    <TaskProgressTracker tracking_url={tracking_url} stream_url={stream_url} />
   );
 }
 
-function initSimilaritySimBrowser(target_root: HTMLElement, source_index_url: string, sim_matrix_url: string, mode: string) {
+function initSimilaritySimBrowser(target_root: HTMLElement, source_index_url: string, sim_matrix_url: string, mode: string, sim_pairs_url?: string, browse_url?: string) {
   /*
   Main entry point for the similarity browser app.
 
   target_root: the root element to render the app in
   source_index_url: the url to fetch the sources from
   sim_matrix_url: the url to fetch the similarity matrix from
+  sim_pairs_url: the url of the binary version of the matrix, preferred if available
+  browse_url: if given, the browser fetches pages from the server and the matrix is only loaded for clustering
+  The neighbors endpoint is read from the data-neighbors-url attribute of target_root:
+  if set, browse pages only hold the best matches of each image, the others are fetched on demand
   */
+  const fetchMatrix = () => fetch(sim_matrix_url).then(response => response.json());
+  const fetchPairs = () => fetch(sim_pairs_url!).then(response => {
+    if (!response.ok) throw new Error(response.statusText);
+    return response.arrayBuffer();
+  }).then(parseSimilarityPairs);
+  const loadMatrix = () => sim_pairs_url ? fetchPairs().catch(fetchMatrix) : fetchMatrix();
+
   fetch(source_index_url).then(response => response.json()).then(source_index => {
-    fetch(sim_matrix_url).then(response => response.json()).then(sim_matrix => {
+    const app_mode = (mode as SimilarityMode) || "browse";
+    if (browse_url && app_mode == "browse") {
+      const index = unserializeSimilarityIndex(source_index);
+      const loadMatches = () => loadMatrix().then(sim_matrix => unserializeSimilarityMatrix(sim_matrix, source_index, index).matches);
+      createRoot(target_root).render(
+        <SimilarityApp index={index} matches={null} mode={app_mode} browse_url={browse_url}
+                       neighbors_url={target_root.dataset.neighborsUrl} loadMatches={loadMatches} />
+      );
+      return;
+    }
+    loadMatrix().then(sim_matrix => {
       const all_matches = unserializeSimilarityMatrix(sim_matrix, source_index);
       createRoot(target_root).render(
-        <SimilarityApp index={all_matches.index} matches={all_matches.matches} mode={(mode as SimilarityMode) || "browse"} />
+        <SimilarityApp index={all_matches.index} matches={all_matches.matches} mode={app_mode} />
       );
     });
   });
@@ -99,7 +123,7 @@ function initWatermarkSimBrowser(target_root: HTMLElement, source_url: string) {
 }
 
 export {
-  initClusterViewer,
+  initClusterViewerLazy,
   initProgressTracker,
   initSimilaritySimBrowser,
   initWatermarkMatches,